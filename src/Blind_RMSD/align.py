@@ -3,18 +3,28 @@ from itertools import product, groupby, permutations
 from functools import partial
 from copy import deepcopy
 from collections import namedtuple
-from typing import Optional, Any
+from typing import Optional, Any, Sequence
 from functools import reduce
 
 from Blind_RMSD.helpers.log import log, pformat
 from Blind_RMSD.helpers.Vector import Vector, rotmat, m2rotaxis
-from Blind_RMSD.helpers.ChemicalPoint import ChemicalPoint, on_coords, on_flavour, ELEMENT_NUMBERS
+from Blind_RMSD.helpers.ChemicalPoint import ELEMENT_NUMBERS
+from Blind_RMSD.helpers.PointSet import PointSet, point_sets_for
+from Blind_RMSD.helpers.PreparedReference import PreparedReference
 from Blind_RMSD.helpers.moldata import group_by
 from Blind_RMSD.helpers.permutations import N_amongst_array
 from Blind_RMSD.helpers.scoring import rmsd_array, ad_array, rmsd, ad, rmsd_array_for_loop, NULL_RMSD, INFINITE_RMSD
 from Blind_RMSD.helpers.assertions import do_assert, assert_array_equal, assert_found_permutation_array, do_assert_is_isometry, distance_matrix, pdist, is_close, assert_blind_rmsd_symmetry
 from Blind_RMSD.helpers.exceptions import Topology_Error
 from Blind_RMSD.helpers.kabsch import kabsch, centroid, Kabsch_Error
+from Blind_RMSD.helpers.flavour_index import Flavoured_Scorer
+from Blind_RMSD.helpers.icp import icp_refinement, DEFAULT_ICP_MAX_ITERATIONS
+from Blind_RMSD.helpers.ransac import ransac_alignment, DEFAULT_RANSAC_TIME_BUDGET, DEFAULT_RANSAC_MAX_HYPOTHESES
+from Blind_RMSD.helpers.geometric_hashing import hashing_alignment
+from Blind_RMSD.helpers.stats import Alignment_Stats
+from Blind_RMSD.helpers.portfolio import run_portfolio, Scheduled_Method, PORTFOLIO_POLICIES, DEFAULT_PORTFOLIO_POLICY, STOP_SCORE_TOLERANCE
+from Blind_RMSD.helpers.symmetry import is_symmetry_permutation, symmetry_group
+from Blind_RMSD.helpers.ambiguous_search import batched_kabsch_search, selection_kabsch_search, shortlisted_kabsch_search, permutation_array_for, total_number_candidates, DEFAULT_CHUNK_SIZE, SEARCH_EARLY_SUCCESS, SEARCH_KABSCH_ERROR
 
 on_self, on_first_object, on_second_object = lambda x: x, lambda x: x[0], lambda x: x[1]
 on_third_object, on_fourth_object = lambda x: x[2], lambda x: x[3]
@@ -30,6 +40,33 @@ DEFAULT_SCORE_TOLERANCE = 0.01
 
 DISABLE_BRUTEFORCE_METHOD = True
 
+# Validation levels of pointsOnPoints():
+# - 'none': no defensive check at all (no copies of the inputs, no extra scoring)
+# - 'cheap': O(N) sanity checks of the centered and aligned centers of geometry
+# - 'paranoid': 'cheap', plus checks that inputs are not modified in place, that the final score is symmetric, and that
+#   the alignment is an isometry
+VALIDATION_NONE, VALIDATION_CHEAP, VALIDATION_PARANOID = 'none', 'cheap', 'paranoid'
+VALIDATION_LEVELS = (VALIDATION_NONE, VALIDATION_CHEAP, VALIDATION_PARANOID)
+DEFAULT_VALIDATION = VALIDATION_CHEAP
+
+# Exit reasons of pointsOnPoints() (Alignment_Stats.exit_reason)
+EXIT_FEWER_THAN_3_POINTS = 'fewer_than_3_points'
+EXIT_TRANSLATION = 'translation_within_tolerance'
+EXIT_NOT_ENOUGH_POINTS = 'not_enough_points_to_disambiguate'
+EXIT_KABSCH_ERROR = 'kabsch_error'
+EXIT_SCORE_TOLERANCE = 'score_within_tolerance'
+EXIT_METHOD_WITHIN_TOLERANCE = 'method_within_tolerance'
+EXIT_COMPLETED = 'completed'
+EXIT_REASONS = (EXIT_FEWER_THAN_3_POINTS, EXIT_TRANSLATION, EXIT_NOT_ENOUGH_POINTS, EXIT_KABSCH_ERROR, EXIT_SCORE_TOLERANCE, EXIT_METHOD_WITHIN_TOLERANCE, EXIT_COMPLETED)
+
+# Search over the permutations of ambiguous points in flavoured_kabsch_method
+# ('batched' is exhaustive, 'anchor_rmsd_shortlist' only scores the best fitting anchors)
+AMBIGUOUS_SEARCH_FUNCTIONS = {
+    'batched': batched_kabsch_search,
+    'anchor_rmsd_shortlist': shortlisted_kabsch_search,
+}
+DEFAULT_AMBIGUOUS_SEARCH = 'batched'
+
 ORIGIN, ZERO_VECTOR = array([0.,0.,0.]), array([0.,0.,0.])
 
 DEFAULT_MATRICES = (np.identity(3), ZERO_VECTOR, ZERO_VECTOR)
@@ -50,13 +87,14 @@ NULL_PDB_WRITING_FCT = lambda alignment, file_name: None
 
 DUMMY_DUMP_PDB = lambda point_list, transform, file_name: None
 
-def transform_mapping(P: Array, Q: Array, verbosity: int = 0):
+def transform_mapping(P: Array, Q: Array, verbosity: int = 0, validation: str = DEFAULT_VALIDATION):
     assert len(P) == len(Q)
 
-    old_P, old_Q = list(map(
-        deepcopy,
-        (P, Q),
-    ))
+    if validation == VALIDATION_PARANOID:
+        old_P, old_Q = list(map(
+            deepcopy,
+            (P, Q),
+        ))
 
     U, Pc, Qc = rotation_matrix_kabsch_on_points(P, Q)
 
@@ -85,9 +123,16 @@ def transform_mapping(P: Array, Q: Array, verbosity: int = 0):
 
         return new_point_array
 
-    # Make sure the arrays were not modified
-    assert_array_equal(P, old_P)
-    assert_array_equal(Q, old_Q)
+    if validation == VALIDATION_PARANOID:
+        # Make sure the arrays were not modified
+        assert_array_equal(P, old_P)
+        assert_array_equal(Q, old_Q)
+
+    return transform
+
+def transform_for(U: Array, Pc: Array, Qc: Array):
+    def transform(point_array):
+        return np.dot(point_array - Pc, U) + Qc
 
     return transform
 
@@ -104,11 +149,76 @@ def pointsOnPoints(
     verbosity=0,
     pdb_writing_fct=None,
     flavoured_kabsch_min_n_unique_points: int = DEFAULT_FLAVOURED_KABSCH_MIN_N_UNIQUE_POINTS,
+    kabsch_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ambiguous_search: str = DEFAULT_AMBIGUOUS_SEARCH,
+    automorphisms: Optional[Sequence[Sequence[int]]] = None,
+    icp_refinement_stage: bool = False,
+    icp_max_iterations: int = DEFAULT_ICP_MAX_ITERATIONS,
+    prepared_reference: Optional[PreparedReference] = None,
+    validation: str = DEFAULT_VALIDATION,
+    stats: Optional[Alignment_Stats] = None,
+    ransac_stage: bool = False,
+    ransac_time_budget: float = DEFAULT_RANSAC_TIME_BUDGET,
+    ransac_max_hypotheses: int = DEFAULT_RANSAC_MAX_HYPOTHESES,
+    hashing_stage: bool = False,
+    method_policy: str = DEFAULT_PORTFOLIO_POLICY,
+    method_threads: int = 1,
 ):
     '''
+    method_policy: one of PORTFOLIO_POLICIES (see helpers.portfolio). The methods are run cheapest first; with
+    'early_exit', the first one scoring within score_tolerance stops the alignment (the exit_reason of stats is then
+    EXIT_TRANSLATION or EXIT_METHOD_WITHIN_TOLERANCE, and its skipped_methods lists the methods that were not run),
+    whereas 'run_all' (the default) runs them all and keeps the best.
+    method_threads: with more than 1, the methods (except the ICP refinement, which refines their best result) run
+    concurrently in as many threads. The stage_times of stats are then the waits for each result, and with 'early_exit'
+    the method that stops the alignment is the first to finish within tolerance, which is not reproducible; the
+    methods still running then keep running in the background (using CPU, but not stats) after pointsOnPoints() returns.
+    hashing_stage: also try geometric hashing (see helpers.geometric_hashing): local flavoured triplets of the first
+    structure vote for the rotations mapping them onto similar triplets of the second one, in O(N) time whatever the
+    number of equivalent points. The hash table of a prepared_reference is shared by all the alignments on it.
+    ransac_stage: also try a randomized alignment from flavour compatible triplets (see helpers.ransac), which does not
+    enumerate permutations of ambiguous points, within ransac_time_budget seconds and ransac_max_hypotheses hypotheses
+    (e.g. for weak flavours, with a low flavoured_kabsch_min_n_unique_points).
+    stats: if given, filled with the performance counters of the alignment (see helpers.stats). Its exit_reason is one
+    of EXIT_REASONS.
+    validation: level of defensive checks, one of VALIDATION_LEVELS ('none', 'cheap' or 'paranoid', see above).
+    assert_is_isometry=True checks the isometry of the alignment whatever the level.
+    prepared_reference: reference-side preprocessing shared by several alignments on the same structure
+    (point_lists[1] and flavour_lists[1] are then taken from it, and can be None, but flavour_lists[0] is required).
+    automorphisms: permutations of the points of the first structure (e.g. PDB_Data.automorphisms).
+    The ones that are symmetries of its conformation are used to skip the equivalent ambiguous permutations.
+    icp_refinement_stage: refine the best alignment with iterative closest point fits on the whole structure
+    (see helpers.icp), which allows using fewer flavoured_kabsch_min_n_unique_points.
     '''
 
+    do_assert(
+        validation in VALIDATION_LEVELS,
+        'Unknown validation level: {0} (should be one of {1})'.format(validation, VALIDATION_LEVELS),
+    )
+    check_isometry = assert_is_isometry or validation == VALIDATION_PARANOID
+    do_assert(
+        method_policy in PORTFOLIO_POLICIES,
+        'Unknown method policy: {0} (should be one of {1})'.format(method_policy, PORTFOLIO_POLICIES),
+    )
+    do_assert(
+        ambiguous_search in AMBIGUOUS_SEARCH_FUNCTIONS,
+        'Unknown ambiguous search: {0} (should be one of {1})'.format(ambiguous_search, tuple(AMBIGUOUS_SEARCH_FUNCTIONS)),
+    )
+
+    if stats is not None:
+        stats.start()
+
     # Initializers
+    if prepared_reference is not None:
+        # The prepared reference encodes the flavours of the reference, which the fallback flavours (point numbers) would not match
+        do_assert(
+            bool(flavour_lists) and bool(flavour_lists[FIRST_STRUCTURE]),
+            'Aligning on a prepared_reference requires the flavours of the first structure (flavour_lists[0])',
+        )
+        point_lists = [point_lists[FIRST_STRUCTURE], prepared_reference.point_list]
+        if flavour_lists:
+            flavour_lists = [flavour_lists[FIRST_STRUCTURE], prepared_reference.flavour_list]
+
     has_flavours = True if flavour_lists and all(flavour_lists) else False
 
     if verbosity >= 3:
@@ -142,7 +252,7 @@ def pointsOnPoints(
             "Size of flavour lists doesn't match size of point lists: {0} and {1}".format(*list(map(len, [flavour_lists[FIRST_STRUCTURE], point_lists[SECOND_STRUCTURE]]))),
         )
         do_assert(
-            sorted(flavour_lists[FIRST_STRUCTURE]) == sorted(flavour_lists[SECOND_STRUCTURE]),
+            sorted(flavour_lists[FIRST_STRUCTURE]) == (prepared_reference.sorted_flavour_list if prepared_reference is not None else sorted(flavour_lists[SECOND_STRUCTURE])),
             "There is not a one to one mapping between the sorted flavour of the sets: {0}".format([(a, b) for (a, b) in zip(*list(map(sorted, flavour_lists))) if a != b]),
             exception_type=Topology_Error,
         )
@@ -156,55 +266,39 @@ def pointsOnPoints(
         point_arrays,
     ))
 
+    if prepared_reference is not None:
+        point_arrays[SECOND_STRUCTURE] = prepared_reference.point_array
+        center_of_geometries[SECOND_STRUCTURE] = prepared_reference.center_of_geometry
+
     if verbosity >= 4:
         log.debug(point_arrays[0])
         log.debug(point_arrays[1])
         log.debug(point_arrays[2])
 
     if has_flavours:
-        grouped_flavours_lists = list(map(
-            lambda index: group_by(flavour_lists[index], lambda x:x ),
-            ON_BOTH_LISTS,
-        ))
-        chemical_points_lists = get_chemical_points_lists(
-            point_lists,
-            flavour_lists,
-            has_flavours,
-        )
-
-        mask_array = np.zeros(
-            (
-                len(flavour_lists[FIRST_STRUCTURE]),
-                len(flavour_lists[SECOND_STRUCTURE]),
-            ),
-        )
-
-        dumb_array = np.chararray(
-            (len(flavour_lists[FIRST_STRUCTURE]), len(flavour_lists[FIRST_STRUCTURE])),
-            itemsize=60,
-        )
-
-        for i, chemical_point_0 in enumerate(chemical_points_lists[FIRST_STRUCTURE]):
-            for j, chemical_point_1 in enumerate(chemical_points_lists[SECOND_STRUCTURE]):
-                mask_array[i, j] = 0. if chemical_point_0.flavour == chemical_point_1.flavour else float('inf')
-                dumb_array[i, j] = "{0} =?= {1}".format(chemical_point_0.flavour, chemical_point_1.flavour)
+        if prepared_reference is not None:
+            point_sets = [prepared_reference.point_set_for(point_lists[FIRST_STRUCTURE], flavour_lists[FIRST_STRUCTURE]), prepared_reference.point_set]
+        else:
+            point_sets = point_sets_for(point_lists, flavour_lists)
 
         if verbosity >= 5:
-            log.debug('chemical_points_lists:')
-            log.debug(chemical_points_lists)
-        if verbosity >= 5:
-            log.debug('dumb_array:')
-            log.debug(dumb_array)
+            log.debug('point_sets:')
+            log.debug(point_sets)
+
+        if stats is not None:
+            stats.n_points = len(point_sets[FIRST_STRUCTURE])
+            stats.n_unique_points = len(point_sets[FIRST_STRUCTURE].unique_positions())
+            stats.n_ambiguous_points = stats.n_points - stats.n_unique_points
     else:
-        mask_array = None
-        chemical_points_lists = None
+        point_sets = None
 
     if not use_AD:
-        distance_array_function = lambda array_1, array_2, transpose_mask_array=False: rmsd_array_for_loop(
-            array_1,
-            array_2,
-            mask_array=(np.transpose(mask_array) if transpose_mask_array else mask_array) if mask_array is not None else None,
-            verbosity=verbosity,
+        # Flavour-constrained closest point RMSD (equivalent to rmsd_array() with a flavour mask_array)
+        distance_array_function = Flavoured_Scorer(
+            flavour_lists,
+            flavour_codes=[point_set.flavour_codes for point_set in point_sets],
+            prepared_reference=prepared_reference,
+            stats=stats,
         )
     else:
         raise AssertionError('This has not been implemented yet.')
@@ -241,23 +335,34 @@ def pointsOnPoints(
         )
     ]
 
-    # Assert than the center of geometry of the translated point list are now on (0,0,0)
-    [ assert_array_equal( center_of_geometry(array), ORIGIN) for array in centered_point_arrays[FIRST_STRUCTURE:UNTIL_SECOND_STRUCTURE] ]
+    if prepared_reference is not None:
+        centered_point_arrays[SECOND_STRUCTURE] = prepared_reference.centered_point_array
+
+    if validation != VALIDATION_NONE:
+        # Assert than the center of geometry of the translated point list are now on (0,0,0)
+        [ assert_array_equal( center_of_geometry(array), ORIGIN) for array in centered_point_arrays[FIRST_STRUCTURE:UNTIL_SECOND_STRUCTURE] ]
 
     def center_on_second_structure(point_array):
         return point_array + center_of_geometries[SECOND_STRUCTURE]
 
+    if stats is not None:
+        stats.lap('preprocessing')
+
     # Break now if the molecule has less than 3 atoms
     if len(point_lists[FIRST_STRUCTURE]) < 3 :
+        if stats is not None:
+            stats.exit_reason = EXIT_FEWER_THAN_3_POINTS
         return formatted_and_validated_Aligment(
             center_on_second_structure(centered_point_arrays[FIRST_STRUCTURE]),
             point_arrays[SECOND_STRUCTURE],
             distance_array_function,
             aligned_extra_points=centered_point_arrays[EXTRA_POINTS] if has_extra_points else None,
-            chemical_points_lists=chemical_points_lists,
-            mask_array=mask_array,
+            point_sets=point_sets,
+            flavour_scorer=distance_array_function,
             verbosity=verbosity,
             hard_fail=not soft_fail,
+            validation=validation,
+            stats=stats,
         )
 
     # Break now if there are no rotational component
@@ -270,78 +375,198 @@ def pointsOnPoints(
         if verbosity >= 1:
             log.debug('A simple translation was enough to match the two set of points. Exiting successfully.')
 
+        if stats is not None:
+            stats.exit_reason = EXIT_TRANSLATION
+
         return formatted_and_validated_Aligment(
             center_on_second_structure(centered_point_arrays[FIRST_STRUCTURE]),
             point_arrays[SECOND_STRUCTURE],
             distance_array_function,
             aligned_extra_points=center_on_second_structure(centered_point_arrays[EXTRA_POINTS]),
-            chemical_points_lists=chemical_points_lists,
-            mask_array=mask_array,
+            point_sets=point_sets,
+            flavour_scorer=distance_array_function,
             verbosity=verbosity,
             hard_fail=not soft_fail,
+            validation=validation,
+            stats=stats,
         )
 
     method_results = {}
 
     def add_method_result(method_result):
         method_results[method_result.method_name] = method_result.method_result
+        if stats is not None:
+            stats.lap(method_result.method_name)
+
+    def with_own_stats(method, *args, takes_stats=True, **kwargs):
+        '''
+        Scheduled run of method (with distance_array_function), returning its result along with Alignment_Stats of its
+        own (counted by its own view of the scorer), which add_scheduled_result() merges into stats from the calling
+        thread: with method_threads > 1, the methods never update shared counters concurrently, and the ones still
+        running after an early exit cannot update stats after pointsOnPoints() has returned.
+        '''
+        def run():
+            if stats is None:
+                return (method(*args, distance_array_function=distance_array_function, **kwargs), None)
+
+            method_stats = Alignment_Stats()
+            method_kwargs = dict(kwargs, stats=method_stats) if takes_stats else kwargs
+            return (method(*args, distance_array_function=distance_array_function.counting_into(method_stats), **method_kwargs), method_stats)
+        return run
+
+    def add_scheduled_result(scheduled_result):
+        method_result, method_stats = scheduled_result
+        if method_stats is not None:
+            stats.merge(method_stats)
+        add_method_result(method_result)
+
+    if automorphisms:
+        symmetries = symmetry_group(
+            [
+                automorphism
+                for automorphism in automorphisms
+                if is_symmetry_permutation(point_arrays[FIRST_STRUCTURE], flavour_lists[FIRST_STRUCTURE], automorphism)
+            ],
+        )
+        if symmetries is None:
+            symmetries = []
+        if verbosity >= 3:
+            log.debug('Using {0} symmetries (out of {1} automorphisms) to prune ambiguous permutations'.format(len(symmetries), len(automorphisms)))
+    else:
+        symmetries = []
 
-    add_method_result(
-        Alignment_Method_Result(
-            'translation',
-            {
-                'array': point_arrays[FIRST_STRUCTURE],
-                'score': current_score,
-                'reference_array': centered_point_arrays[SECOND_STRUCTURE],
-                'transform': NO_TRANSFORM,
-            },
-        ),
+    if stats is not None:
+        stats.lap('symmetries')
+
+    translation_result = Alignment_Method_Result(
+        'translation',
+        {
+            'array': point_arrays[FIRST_STRUCTURE],
+            'score': current_score,
+            'reference_array': centered_point_arrays[SECOND_STRUCTURE],
+            'transform': NO_TRANSFORM,
+        },
     )
 
-    if not DISABLE_BRUTEFORCE_METHOD:
-        add_method_result(
-            bruteforce_aligning_vectors_method(
-                point_arrays[FIRST_STRUCTURE:UNTIL_SECOND_STRUCTURE],
-                distance_array_function,
-                score_tolerance=score_tolerance,
-                verbosity=verbosity,
+    # Cheapest first: the translation is already scored, the flavoured Kabsch method uses unique anchors (or a bounded
+    # ambiguous search), then come the randomized methods and the bruteforce ones
+    scheduled_methods = [Scheduled_Method('translation', lambda: (translation_result, None))]
+
+    if has_flavours:
+        scheduled_methods.append(
+            Scheduled_Method(
+                'flavoured_kabsch',
+                with_own_stats(
+                    flavoured_kabsch_method,
+                    point_arrays[FIRST_STRUCTURE:UNTIL_SECOND_STRUCTURE],
+                    flavour_lists=flavour_lists,
+                    score_tolerance=score_tolerance,
+                    show_graph=show_graph,
+                    verbosity=verbosity,
+                    dump_pdb=dump_pdb,
+                    flavoured_kabsch_min_n_unique_points=flavoured_kabsch_min_n_unique_points,
+                    kabsch_chunk_size=kabsch_chunk_size,
+                    ambiguous_search=ambiguous_search,
+                    symmetries=symmetries,
+                    point_sets=point_sets,
+                    validation=validation,
+                ),
             ),
         )
 
-        add_method_result(
-            lucky_kabsch_method(
-                point_lists,
-                distance_array_function,
-                flavour_lists=flavour_lists,
-                score_tolerance=score_tolerance,
-                show_graph=show_graph,
-                verbosity=verbosity,
+    if hashing_stage and has_flavours:
+        scheduled_methods.append(
+            Scheduled_Method(
+                'geometric_hashing',
+                with_own_stats(
+                    geometric_hashing_method,
+                    point_arrays[FIRST_STRUCTURE],
+                    point_arrays[SECOND_STRUCTURE],
+                    hash_table=prepared_reference.triplet_hash_table() if prepared_reference is not None else None,
+                    verbosity=verbosity,
+                ),
             ),
         )
 
-        add_method_result(
-            bruteforce_kabsch_method(
-                point_lists,
-                distance_array_function,
-                flavour_lists=flavour_lists,
-                score_tolerance=score_tolerance,
-                show_graph=show_graph,
-                verbosity=verbosity,
+    if ransac_stage and has_flavours:
+        scheduled_methods.append(
+            Scheduled_Method(
+                'ransac_kabsch',
+                with_own_stats(
+                    ransac_kabsch_method,
+                    point_arrays[FIRST_STRUCTURE],
+                    point_arrays[SECOND_STRUCTURE],
+                    score_tolerance=score_tolerance,
+                    time_budget=ransac_time_budget,
+                    max_hypotheses=ransac_max_hypotheses,
+                    verbosity=verbosity,
+                ),
             ),
         )
 
-    # Try the flavoured Kabsch method if we have flavours
-    if has_flavours:
+    if not DISABLE_BRUTEFORCE_METHOD:
+        scheduled_methods += [
+            Scheduled_Method(
+                'bruteforce_aligning_vectors',
+                with_own_stats(
+                    bruteforce_aligning_vectors_method,
+                    point_arrays[FIRST_STRUCTURE:UNTIL_SECOND_STRUCTURE],
+                    score_tolerance=score_tolerance,
+                    verbosity=verbosity,
+                    takes_stats=False,
+                ),
+            ),
+            Scheduled_Method(
+                'lucky_kabsch',
+                with_own_stats(
+                    lucky_kabsch_method,
+                    point_lists,
+                    flavour_lists=flavour_lists,
+                    score_tolerance=score_tolerance,
+                    show_graph=show_graph,
+                    verbosity=verbosity,
+                    takes_stats=False,
+                ),
+            ),
+            Scheduled_Method(
+                'bruteforce_kabsch',
+                with_own_stats(
+                    bruteforce_kabsch_method,
+                    point_lists,
+                    flavour_lists=flavour_lists,
+                    score_tolerance=score_tolerance,
+                    show_graph=show_graph,
+                    verbosity=verbosity,
+                ),
+            ),
+        ]
+
+    portfolio_result = run_portfolio(
+        scheduled_methods,
+        score_of=lambda scheduled_result: scheduled_result[0].method_result['score'] if 'score' in scheduled_result[0].method_result else INFINITE_RMSD,
+        on_result=add_scheduled_result,
+        score_tolerance=score_tolerance,
+        policy=method_policy,
+        n_threads=method_threads,
+    )
+
+    if portfolio_result.stop_reason == STOP_SCORE_TOLERANCE:
+        if verbosity >= 1:
+            log.debug('Method {0} scored within tolerance, skipping: {1}'.format(portfolio_result.stopping_method, portfolio_result.skipped_methods))
+        if stats is not None:
+            stats.exit_reason = EXIT_TRANSLATION if portfolio_result.stopping_method == 'translation' else EXIT_METHOD_WITHIN_TOLERANCE
+            stats.skipped_methods = portfolio_result.skipped_methods + (['icp_refinement'] if icp_refinement_stage else [])
+
+    if icp_refinement_stage and portfolio_result.stop_reason != STOP_SCORE_TOLERANCE:
         add_method_result(
-            flavoured_kabsch_method(
-                point_lists,
+            icp_refinement_method(
+                method_results,
+                point_arrays[FIRST_STRUCTURE],
+                point_arrays[SECOND_STRUCTURE],
                 distance_array_function,
-                flavour_lists=flavour_lists,
-                score_tolerance=score_tolerance,
-                show_graph=show_graph,
+                max_iterations=icp_max_iterations,
                 verbosity=verbosity,
-                dump_pdb=dump_pdb,
-                flavoured_kabsch_min_n_unique_points=flavoured_kabsch_min_n_unique_points,
+                stats=stats,
             ),
         )
 
@@ -358,6 +583,11 @@ def pointsOnPoints(
     if verbosity >= 1:
         log.debug("Best score was achieved with method: {0}".format(best_method))
 
+    if stats is not None:
+        stats.best_method = best_method
+        if stats.exit_reason is None:
+            stats.exit_reason = EXIT_COMPLETED
+
     if has_extra_points:
         transform_function = method_results[best_method]['transform']
         aligned_extra_points_array = transform_function(point_arrays[EXTRA_POINTS])
@@ -387,6 +617,8 @@ def pointsOnPoints(
         if not soft_fail:
             raise AssertionError("Best match is None. Something went wrong.")
         else:
+            if stats is not None:
+                stats.lap('validation')
             return FAILED_ALIGNMENT
 
     def corrected(points_array):
@@ -410,7 +642,7 @@ def pointsOnPoints(
         complete_molecule_before = np.concatenate((point_arrays[FIRST_STRUCTURE], point_arrays[EXTRA_POINTS]))
         complete_molecule_after = np.concatenate((corrected_best_match, corrected_extra_points))
 
-        if assert_is_isometry:
+        if check_isometry:
 
             do_assert_is_isometry(
                 point_arrays[FIRST_STRUCTURE],
@@ -435,33 +667,46 @@ def pointsOnPoints(
     else:
         corrected_extra_points = None
 
+        if check_isometry:
+            do_assert_is_isometry(
+                point_arrays[FIRST_STRUCTURE],
+                corrected_best_match,
+                verbosity=verbosity,
+                success_msg='aligned_points is isometric',
+            )
+
     return formatted_and_validated_Aligment(
         corrected_best_match,
         point_arrays[SECOND_STRUCTURE],
         distance_array_function,
         aligned_extra_points=corrected_extra_points,
-        chemical_points_lists=chemical_points_lists,
-        mask_array=mask_array,
+        point_sets=point_sets,
+        flavour_scorer=distance_array_function,
         verbosity=verbosity,
         dump_pdb=dump_pdb,
         hard_fail=not soft_fail,
+        validation=validation,
+        stats=stats,
     )
 
 def formatted_and_validated_Aligment(
     aligned_point_array: Array,
     reference_point_array: Array,
     distance_array_function: Any,
-    chemical_points_lists: Optional[Any] = None,
+    point_sets: Optional[Any] = None,
     aligned_extra_points: Optional[Any] = None,
-    mask_array=None,
+    flavour_scorer: Optional[Flavoured_Scorer] = None,
     verbosity=0,
     dump_pdb=DUMMY_DUMP_PDB,
     hard_fail: bool = False,
+    validation: str = DEFAULT_VALIDATION,
+    stats: Optional[Alignment_Stats] = None,
 ):
-    assert_array_equal(*
-        list(map(center_of_geometry, (aligned_point_array, reference_point_array,))),
-        message="{0} != {1}"
-    )
+    if validation != VALIDATION_NONE:
+        assert_array_equal(*
+            list(map(center_of_geometry, (aligned_point_array, reference_point_array,))),
+            message="{0} != {1}"
+        )
 
     dump_pdb(
         aligned_point_array,
@@ -472,13 +717,15 @@ def formatted_and_validated_Aligment(
     final_permutation = assert_found_permutation_array(
         aligned_point_array,
         reference_point_array,
-        chemical_points_lists=chemical_points_lists,
-        mask_array=mask_array if mask_array is not None else None,
+        point_sets=point_sets,
+        flavour_scorer=flavour_scorer,
         verbosity=verbosity,
         hard_fail=hard_fail,
+        # Alignment.final_permutation is a list of (point index, reference point index) pairs
+        as_tuples=True,
     )
 
-    if final_permutation is not None:
+    if final_permutation is not None and validation == VALIDATION_PARANOID:
         assert_blind_rmsd_symmetry(
             aligned_point_array,
             reference_point_array,
@@ -486,7 +733,7 @@ def formatted_and_validated_Aligment(
             verbosity=verbosity,
         )
 
-    return Alignment(
+    alignment = Alignment(
         aligned_point_array.tolist(),
         distance_array_function( #FIXME
             aligned_point_array,
@@ -496,6 +743,11 @@ def formatted_and_validated_Aligment(
         final_permutation,
     )
 
+    if stats is not None:
+        stats.lap('validation')
+
+    return alignment
+
 ### METHODS ###
 
 def bruteforce_aligning_vectors_method(centered_arrays, distance_array_function, score_tolerance=DEFAULT_SCORE_TOLERANCE, verbosity=0):
@@ -563,21 +815,6 @@ def bruteforce_aligning_vectors_method(centered_arrays, distance_array_function,
         },
     )
 
-def get_chemical_points_lists(point_lists, flavour_lists, has_flavours):
-    N_points = len(point_lists[FIRST_STRUCTURE])
-    chemical_points_lists = list(map(
-        lambda index: [
-            ChemicalPoint(*zipped_point)
-            for zipped_point in zip(
-                point_lists[index],
-                list(range(N_points)),
-                flavour_lists[index] if has_flavours else [None] * N_points,
-            )
-        ],
-        ON_BOTH_LISTS,
-    ))
-    return chemical_points_lists
-
 def flavoured_kabsch_method(
     point_lists,
     distance_array_function,
@@ -588,16 +825,29 @@ def flavoured_kabsch_method(
     verbosity=0,
     dump_pdb=DUMMY_DUMP_PDB,
     flavoured_kabsch_min_n_unique_points: int = DEFAULT_FLAVOURED_KABSCH_MIN_N_UNIQUE_POINTS,
+    kabsch_chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ambiguous_search: str = DEFAULT_AMBIGUOUS_SEARCH,
+    symmetries: Sequence[Array] = (),
+    point_sets: Optional[Sequence[PointSet]] = None,
+    validation: str = DEFAULT_VALIDATION,
+    stats: Optional[Alignment_Stats] = None,
 ):
+    do_assert(
+        ambiguous_search in AMBIGUOUS_SEARCH_FUNCTIONS,
+        'Unknown ambiguous search: {0} (should be one of {1})'.format(ambiguous_search, tuple(AMBIGUOUS_SEARCH_FUNCTIONS)),
+    )
+
     point_arrays = list(map(
-        array,
+        np.asarray,
         point_lists,
     ))
     has_flavours= bool(flavour_lists)
 
-    old_point_arrays = deepcopy(point_arrays)
+    old_point_arrays = deepcopy(point_arrays) if validation == VALIDATION_PARANOID else None
 
     def assert_constant_point_arrays():
+        if old_point_arrays is None:
+            return
         for an_array, old_array in zip(point_arrays, old_point_arrays):
             assert_array_equal(
                 an_array,
@@ -617,39 +867,15 @@ def flavoured_kabsch_method(
     if verbosity >= 3:
         log.debug("Found flavours. Trying flavoured {0}-point Kabsch algorithm on flavoured types ...".format(MIN_N_UNIQUE_POINTS))
 
-    grouped_flavours_lists = list(map(
-        lambda index: group_by(flavour_lists[index], lambda x:x ),
-        ON_BOTH_LISTS,
-    ))
-    chemical_points_lists = get_chemical_points_lists(
-        point_lists,
-        flavour_lists,
-        has_flavours,
-    )
+    if point_sets is None:
+        point_sets = point_sets_for(point_lists, flavour_lists)
 
-    grouped_chemical_points_lists = list(map(
-        lambda chemical_points: group_by(chemical_points, on_flavour),
-        chemical_points_lists,
-    ))
-    # Try to find MIN_N_UNIQUE_POINTS uniquely-flavoured type points
-    unique_points_lists = list(map(
-        lambda grouped_chemical_points: [group[0] for group in list(grouped_chemical_points.values()) if len(group) == 1],
-        grouped_chemical_points_lists,
-    ))
-    # Order them by (decreasing flavour)
-    unique_points_lists = list(map(
-        lambda index: sorted(
-            unique_points_lists[index],
-            key=lambda x: (x.flavour,),
-            reverse=True,
-        ),
-        ON_BOTH_LISTS,
-    ))
+    # Try to find MIN_N_UNIQUE_POINTS uniquely-flavoured type points, ordered by (decreasing flavour)
+    unique_indexes_lists = [point_set.unique_positions() for point_set in point_sets]
 
-    if not len(unique_points_lists[FIRST_STRUCTURE]) == len(unique_points_lists[SECOND_STRUCTURE]):
+    if not len(unique_indexes_lists[FIRST_STRUCTURE]) == len(unique_indexes_lists[SECOND_STRUCTURE]):
         import yaml
-        flavours = [list(map(on_flavour, unique_points_list)) for unique_points_list in unique_points_lists]
-        total_flavours = set(flavours[0] + flavours[1])
+        flavours = [[flavour_lists[index][i] for i in unique_indexes_lists[index]] for index in ON_BOTH_LISTS]
         raise AssertionError( '''
 Non matching number of unique points in
 {0}
@@ -667,32 +893,26 @@ and
 
 {5}
 '''.format(
-        yaml.dump(sorted(unique_points_lists[FIRST_STRUCTURE], key=lambda x: x.flavour)),
-        len(unique_points_lists[FIRST_STRUCTURE]),
-        yaml.dump(sorted(unique_points_lists[SECOND_STRUCTURE], key=lambda x: x.flavour)),
-        len(unique_points_lists[SECOND_STRUCTURE]),
-        '\n'.join([ str(chem_point) for chem_point in unique_points_lists[FIRST_STRUCTURE] if on_flavour(chem_point) not in flavours[1] ]),
-        '\n'.join([ str(chem_point) for chem_point in unique_points_lists[SECOND_STRUCTURE] if on_flavour(chem_point) not in flavours[0] ]),
+        yaml.dump(sorted(flavours[FIRST_STRUCTURE])),
+        len(unique_indexes_lists[FIRST_STRUCTURE]),
+        yaml.dump(sorted(flavours[SECOND_STRUCTURE])),
+        len(unique_indexes_lists[SECOND_STRUCTURE]),
+        '\n'.join([ 'index={0}, flavour={1}'.format(i, flavour_lists[FIRST_STRUCTURE][i]) for i in unique_indexes_lists[FIRST_STRUCTURE] if flavour_lists[FIRST_STRUCTURE][i] not in flavours[1] ]),
+        '\n'.join([ 'index={0}, flavour={1}'.format(i, flavour_lists[SECOND_STRUCTURE][i]) for i in unique_indexes_lists[SECOND_STRUCTURE] if flavour_lists[SECOND_STRUCTURE][i] not in flavours[0] ]),
     ))
 
     if verbosity >= 3:
         log.debug('Unique groups found based on flavours:')
-        log.debug(pformat(unique_points_lists[0]))
+        log.debug(pformat([flavour_lists[FIRST_STRUCTURE][i] for i in unique_indexes_lists[FIRST_STRUCTURE]]))
 
-    if len(unique_points_lists[FIRST_STRUCTURE]) < MIN_N_UNIQUE_POINTS:
+    if len(unique_indexes_lists[FIRST_STRUCTURE]) < MIN_N_UNIQUE_POINTS:
         if verbosity >= 3:
             log.warning("Unable to find at least {N} unique point with the flavoured points provided. Trying to disambiguate enough points to make a fit...".format(N=MIN_N_UNIQUE_POINTS))
 
-        missing_points = MIN_N_UNIQUE_POINTS - len(unique_points_lists[FIRST_STRUCTURE])
+        missing_points = MIN_N_UNIQUE_POINTS - len(unique_indexes_lists[FIRST_STRUCTURE])
 
         # Order groups by length, and then flavour
-        ambiguous_point_groups = list(map(
-            lambda grouped_chemical_points: sorted(
-                [group for group in list(grouped_chemical_points.values()) if 1 < len(group) <= MAX_N_COMPLEXITY ],
-                key= lambda group: (len(group), group[0].flavour),
-            ),
-            grouped_chemical_points_lists,
-        ))
+        ambiguous_point_groups = [point_set.ambiguous_groups(max_group_size=MAX_N_COMPLEXITY) for point_set in point_sets]
 
         N_ambiguous_points = sum(
             list(map(
@@ -705,10 +925,13 @@ and
             if verbosity >= 1:
                 log.error("Couldn'd find enough point to disambiguate: {M} (unique points) + {P} (ambiguous points) < {N} (required points). Returning best found match ...".format(
                     P=N_ambiguous_points,
-                    M=len(unique_points_lists[0]),
+                    M=len(unique_indexes_lists[0]),
                     N=MIN_N_UNIQUE_POINTS,
                 ))
 
+            if stats is not None:
+                stats.exit_reason = EXIT_NOT_ENOUGH_POINTS
+
             return Alignment_Method_Result(
                 'flavoured_kabsch_failed',
                 {
@@ -722,9 +945,6 @@ and
         if verbosity >= 2:
             log.debug("Found enough additional points ({N}) to disambiguate. Trying kabsch algorithm ...".format(N=N_ambiguous_points))
 
-        permutations_list = []
-        atom_indexes = lambda chemical_points: [chemical_point.index for chemical_point in chemical_points]
-
         # For each ambiguous group
         ambiguous_points = 0
         N_list = []
@@ -742,135 +962,117 @@ and
 
         if verbosity >= 3:
             log.debug('Ambiguous groups are:')
-            log.debug(pformat(ambiguous_point_groups[0]))
+            log.debug(pformat([[flavour_lists[FIRST_STRUCTURE][i] for i in group] for group in ambiguous_point_groups[FIRST_STRUCTURE]]))
             log.debug('(number of points taken in each group: {0})'.format(
                 N_list,
             ))
 
-        permutation_lists = list(map(
-            lambda group, N: list(permutations(atom_indexes(group), r=N)),
+        permutation_arrays = list(map(
+            lambda group, N: permutation_array_for(point_sets[FIRST_STRUCTURE].indexes[group], N),
             ambiguous_point_groups[FIRST_STRUCTURE],
             N_list,
         ))
 
-        complete_permutation_list = product(*permutation_lists)
-        total_number_permutation = reduce(lambda acc, e: acc * len(e), permutation_lists, 1)
+        total_number_permutation = total_number_candidates(permutation_arrays)
 
-        for (group, N) in zip(ambiguous_point_groups[SECOND_STRUCTURE], N_list):
-            unique_points_lists[SECOND_STRUCTURE] += group[0:N]
+        if stats is not None:
+            stats.total_number_permutation = total_number_permutation
 
-        best_match, best_score = [None]*2
-        for (i, group_permutations) in enumerate(complete_permutation_list, start=1):
-            ambiguous_unique_points = [deepcopy(unique_points_lists[FIRST_STRUCTURE])]
-
-            for group in group_permutations:
-                for index in group:
-                    new_point = chemical_points_lists[0][index]
-                    ambiguous_unique_points[FIRST_STRUCTURE].append(new_point)
-
-            if verbosity >= 5:
-                log.debug('({0}/{1}) Attempting a fit between points:'.format(i, total_number_permutation))
-                log.debug(pformat(ambiguous_unique_points[FIRST_STRUCTURE]))
-                log.debug('and:')
-                log.debug(pformat(unique_points_lists[SECOND_STRUCTURE]))
+        reference_anchor_indexes = np.concatenate(
+            [unique_indexes_lists[SECOND_STRUCTURE]] + [group[0:N] for (group, N) in zip(ambiguous_point_groups[SECOND_STRUCTURE], N_list)],
+        )
 
-            do_assert(
-                list(map(on_flavour, ambiguous_unique_points[0])) == list(map(on_flavour, unique_points_lists[SECOND_STRUCTURE])),
-                "Trying to match points whose flavours don't match: {0} != {1}".format(
-                    list(map(
-                        on_flavour,
-                        ambiguous_unique_points[FIRST_STRUCTURE],
-                    )),
-                    list(map(
-                        on_flavour,
-                        unique_points_lists[SECOND_STRUCTURE],
-                    )),
-                ),
-            )
+        do_assert(
+            [point_sets[FIRST_STRUCTURE].flavour_codes[group[0]] for (group, N) in zip(ambiguous_point_groups[FIRST_STRUCTURE], N_list) if N > 0] == [point_sets[SECOND_STRUCTURE].flavour_codes[group[0]] for (group, N) in zip(ambiguous_point_groups[SECOND_STRUCTURE], N_list) if N > 0],
+            "Trying to match points whose flavours don't match: {0} != {1}".format(
+                [flavour_lists[FIRST_STRUCTURE][group[0]] for group in ambiguous_point_groups[FIRST_STRUCTURE]],
+                [flavour_lists[SECOND_STRUCTURE][group[0]] for group in ambiguous_point_groups[SECOND_STRUCTURE]],
+            ),
+        )
 
-            try:
-                transform = transform_mapping(
-                    list(map(on_coords, ambiguous_unique_points[FIRST_STRUCTURE])),
-                    list(map(on_coords, unique_points_lists[SECOND_STRUCTURE])),
-                )
-            except Kabsch_Error as e:
-                if verbosity >= 1:
-                    log.error(e)
-                return Alignment_Method_Result('flavoured_kabsch', FAILED_ALIGNMENT)
+        if verbosity >= 3:
+            log.debug('Attempting {0} fits between ambiguous points (search: {1}, by chunks of {2})'.format(total_number_permutation, ambiguous_search, kabsch_chunk_size))
 
-            kabsched_list1 = transform(point_arrays[FIRST_STRUCTURE])
+        batch_distance_array_function = batch_distance_array_function_for(distance_array_function)
 
-            current_score = distance_array_function(
-                kabsched_list1,
-                point_arrays[SECOND_STRUCTURE],
-            )
+        if dump_pdb is not DUMMY_DUMP_PDB:
+            on_candidate = lambda i, kabsched_array, matrices: dump_pdb(kabsched_array, transform_for(*matrices), 'kabsch_{0}.pdb'.format(i))
+        else:
+            on_candidate = None
 
-            dump_pdb(
-                kabsched_list1,
-                transform,
-                'kabsch_{0}.pdb'.format(i),
-            )
+        search_result = AMBIGUOUS_SEARCH_FUNCTIONS[ambiguous_search](
+            point_arrays[FIRST_STRUCTURE],
+            point_arrays[SECOND_STRUCTURE],
+            point_sets[FIRST_STRUCTURE].indexes[unique_indexes_lists[FIRST_STRUCTURE]],
+            point_sets[SECOND_STRUCTURE].coords[reference_anchor_indexes],
+            permutation_arrays,
+            batch_distance_array_function,
+            score_tolerance,
+            chunk_size=kabsch_chunk_size,
+            on_candidate=on_candidate,
+            symmetries=symmetries,
+            verbosity=verbosity,
+            stats=stats,
+        )
 
-            if (best_score is None) or current_score <= best_score:
-                best_match, best_score, best_transform = kabsched_list1, current_score, transform
+        if stats is not None:
+            stats.search_status = search_result.status
+            stats.exit_reason = {SEARCH_EARLY_SUCCESS: EXIT_SCORE_TOLERANCE, SEARCH_KABSCH_ERROR: EXIT_KABSCH_ERROR}.get(search_result.status, EXIT_COMPLETED)
 
-                if verbosity >= 5:
-                    log.debug("Best score so far with random {0}-point Kabsch fitting: {1}".format(MIN_N_UNIQUE_POINTS, best_score))
-
-                if current_score <= score_tolerance:
-                    return Alignment_Method_Result(
-                        'flavoured_kabsch_ambiguous_early_success',
-                        {
-                            'array': best_match.tolist(),
-                            'score': best_score,
-                            'reference_array': point_arrays[SECOND_STRUCTURE],
-                            'transform': best_transform,
-                        },
-                    )
+        if search_result.status == SEARCH_KABSCH_ERROR or search_result.aligned_array is None:
+            return Alignment_Method_Result('flavoured_kabsch', FAILED_ALIGNMENT)
 
         if verbosity >= 5:
-            log.debug("Returning best match with random {0}-point Kabsch fitting (Score: {1})".format(
+            log.debug("Returning best match with random {0}-point Kabsch fitting (Score: {1}, candidate {2}/{3})".format(
                 MIN_N_UNIQUE_POINTS,
-                best_score,
+                search_result.score,
+                search_result.candidate_number,
+                total_number_permutation,
             ))
 
         assert_constant_point_arrays()
         return Alignment_Method_Result(
-            'flavoured_kabsch_ambiguous',
+            'flavoured_kabsch_ambiguous_early_success' if search_result.status == SEARCH_EARLY_SUCCESS else 'flavoured_kabsch_ambiguous',
             {
-                'array': best_match.tolist(),
-                'score': best_score,
+                'array': search_result.aligned_array.tolist(),
+                'score': search_result.score,
                 'reference_array': point_arrays[SECOND_STRUCTURE],
-                'transform': best_transform,
+                'transform': transform_for(*search_result.matrices),
             },
         )
     else:
         do_assert(
-            list(map(on_flavour, unique_points_lists[FIRST_STRUCTURE])) == list(map(on_flavour, unique_points_lists[SECOND_STRUCTURE])),
+            [flavour_lists[FIRST_STRUCTURE][i] for i in unique_indexes_lists[FIRST_STRUCTURE]] == [flavour_lists[SECOND_STRUCTURE][i] for i in unique_indexes_lists[SECOND_STRUCTURE]],
             "Unique points have not been ordered properly: {0} and {1}".format(
-                list(map(on_flavour, unique_points_lists[0])),
-                list(map(on_flavour, unique_points_lists[1])),
+                [flavour_lists[FIRST_STRUCTURE][i] for i in unique_indexes_lists[FIRST_STRUCTURE]],
+                [flavour_lists[SECOND_STRUCTURE][i] for i in unique_indexes_lists[SECOND_STRUCTURE]],
             ),
         )
 
         do_assert(
-            list(map(on_flavour, unique_points_lists[FIRST_STRUCTURE])) == list(map(on_flavour, unique_points_lists[SECOND_STRUCTURE])),
+            np.array_equal(point_sets[FIRST_STRUCTURE].flavour_codes[unique_indexes_lists[FIRST_STRUCTURE]], point_sets[SECOND_STRUCTURE].flavour_codes[unique_indexes_lists[SECOND_STRUCTURE]]),
             'Canonical representation of unique points do not match: {0} != {1}'.format(
-                list(map(on_flavour, unique_points_lists[FIRST_STRUCTURE])),
-                list(map(on_flavour, unique_points_lists[SECOND_STRUCTURE])),
+                point_sets[FIRST_STRUCTURE].flavour_codes[unique_indexes_lists[FIRST_STRUCTURE]],
+                point_sets[SECOND_STRUCTURE].flavour_codes[unique_indexes_lists[SECOND_STRUCTURE]],
             ),
         )
 
         # Align all unique_points using Kabsch algorithm
         try:
             current_transform = transform_mapping(
-                list(map(on_coords, unique_points_lists[FIRST_STRUCTURE])),
-                list(map(on_coords, unique_points_lists[SECOND_STRUCTURE])),
+                point_sets[FIRST_STRUCTURE].coords[unique_indexes_lists[FIRST_STRUCTURE]],
+                point_sets[SECOND_STRUCTURE].coords[unique_indexes_lists[SECOND_STRUCTURE]],
+                validation=validation,
             )
         except Kabsch_Error as e:
             if verbosity >= 1:
                 log.error(e)
+            if stats is not None:
+                stats.exit_reason = EXIT_KABSCH_ERROR
             return Alignment_Method_Result('flavoured_kabsch', FAILED_ALIGNMENT)
+        finally:
+            if stats is not None:
+                stats.n_svd_calls += 1
 
         kabsched_list1 = current_transform(point_arrays[FIRST_STRUCTURE])
 
@@ -907,6 +1109,111 @@ and
             }
         )
 
+def icp_refinement_method(method_results, point_array, reference_array, distance_array_function, max_iterations=DEFAULT_ICP_MAX_ITERATIONS, verbosity=0, stats=None):
+    best_method_result = min(
+        [method_result for method_result in method_results.values() if isinstance(method_result, dict) and method_result.get('array') is not None],
+        key=lambda method_result: method_result['score'],
+        default=None,
+    )
+
+    icp_result = None
+    if best_method_result is not None and isinstance(distance_array_function, Flavoured_Scorer):
+        icp_result = icp_refinement(
+            point_array,
+            reference_array,
+            array(best_method_result['array']),
+            distance_array_function,
+            max_iterations=max_iterations,
+            verbosity=verbosity,
+            stats=stats,
+        )
+
+    if icp_result is None:
+        return Alignment_Method_Result('icp_refinement', {})
+
+    if verbosity >= 2:
+        log.debug("ICP refinement improved the best score from {0} to {1} in {2} iterations".format(
+            best_method_result['score'],
+            icp_result.score,
+            icp_result.n_iterations,
+        ))
+
+    return Alignment_Method_Result(
+        'icp_refinement',
+        {
+            'array': icp_result.aligned_array.tolist(),
+            'score': icp_result.score,
+            'reference_array': reference_array,
+            'transform': transform_for(*icp_result.matrices),
+        },
+    )
+
+def geometric_hashing_method(point_array, reference_array, distance_array_function, hash_table=None, verbosity=0, stats=None):
+    hashing_result = hashing_alignment(
+        point_array,
+        reference_array,
+        distance_array_function,
+        hash_table=hash_table,
+        verbosity=verbosity,
+        stats=stats,
+    )
+
+    if hashing_result is None:
+        if verbosity >= 1:
+            log.error('Geometric hashing found no matching triplets')
+        return Alignment_Method_Result('geometric_hashing', FAILED_ALIGNMENT)
+
+    if verbosity >= 2:
+        log.debug("Minimum Score from geometric hashing method is: {0} ({1}/{2} votes)".format(
+            hashing_result.score,
+            hashing_result.n_winning_votes,
+            hashing_result.n_votes,
+        ))
+
+    return Alignment_Method_Result(
+        'geometric_hashing',
+        {
+            'array': hashing_result.aligned_array.tolist(),
+            'score': hashing_result.score,
+            'reference_array': reference_array,
+            'transform': transform_for(*hashing_result.matrices),
+        },
+    )
+
+def ransac_kabsch_method(point_array, reference_array, distance_array_function, score_tolerance=DEFAULT_SCORE_TOLERANCE, time_budget=DEFAULT_RANSAC_TIME_BUDGET, max_hypotheses=DEFAULT_RANSAC_MAX_HYPOTHESES, verbosity=0, stats=None):
+    ransac_result = ransac_alignment(
+        point_array,
+        reference_array,
+        distance_array_function,
+        time_budget=time_budget,
+        max_hypotheses=max_hypotheses,
+        score_tolerance=score_tolerance,
+        verbosity=verbosity,
+        stats=stats,
+    )
+
+    if ransac_result is None:
+        if verbosity >= 1:
+            log.error('RANSAC could not draw any valid sample of {0} compatible points'.format(len(point_array)))
+        return Alignment_Method_Result('ransac_kabsch', FAILED_ALIGNMENT)
+
+    if verbosity >= 2:
+        log.debug("Minimum Score from RANSAC Kabsch method is: {0} ({1} hypotheses, stopped on {2})".format(
+            ransac_result.score,
+            ransac_result.n_hypotheses,
+            ransac_result.stop_reason,
+        ))
+
+    return Alignment_Method_Result(
+        'ransac_kabsch',
+        {
+            'array': ransac_result.aligned_array.tolist(),
+            'score': ransac_result.score,
+            'reference_array': reference_array,
+            'transform': transform_for(*ransac_result.matrices),
+        },
+    )
+
 def lucky_kabsch_method(point_lists, distance_array_function, flavour_lists=None, show_graph=False, score_tolerance=DEFAULT_SCORE_TOLERANCE, verbosity=0):
     point_arrays = list(map(
         array,
@@ -941,7 +1248,7 @@ def lucky_kabsch_method(point_lists, distance_array_function, flavour_lists=None
         },
     )
 
-def bruteforce_kabsch_method(point_lists, distance_array_function, flavour_lists=None, show_graph=False, score_tolerance=DEFAULT_SCORE_TOLERANCE, verbosity=0):
+def bruteforce_kabsch_method(point_lists, distance_array_function, flavour_lists=None, show_graph=False, score_tolerance=DEFAULT_SCORE_TOLERANCE, kabsch_chunk_size: int = DEFAULT_CHUNK_SIZE, verbosity=0, stats: Optional[Alignment_Stats] = None):
     N_BRUTEFORCE_KABSCH = 4
 
     point_arrays = list(map(
@@ -949,53 +1256,37 @@ def bruteforce_kabsch_method(point_lists, distance_array_function, flavour_lists
         point_lists,
     ))
 
-    unique_points = list(map(
-        deepcopy,
-        [None, point_arrays[SECOND_STRUCTURE][0:N_BRUTEFORCE_KABSCH, 0:3] ],
-    ))
-
-    best_match, best_score = None, None
-
-    for permutation in N_amongst_array(point_arrays[FIRST_STRUCTURE], N_BRUTEFORCE_KABSCH):
-        unique_points[FIRST_STRUCTURE] = list(map(
-            lambda index: point_arrays[FIRST_STRUCTURE][index, 0:3],
-            permutation,
-        ))
-
-        try:
-            transform = transform_mapping(*unique_points)
-        except Kabsch_Error as e:
-            if verbosity >= 1:
-                log.error(e)
-            return Alignment_Method_Result('bruteforce_kabsch_method', FAILED_ALIGNMENT)
-
-        kabsched_list1 = transform(point_arrays[FIRST_STRUCTURE])
-
-        current_match = kabsched_list1
-
-        current_score = distance_array_function(
-            kabsched_list1,
-            point_arrays[SECOND_STRUCTURE],
-        )
+    # Every selection of N_BRUTEFORCE_KABSCH points, generated lazily and evaluated kabsch_chunk_size at a time
+    search_result = selection_kabsch_search(
+        point_arrays[FIRST_STRUCTURE],
+        point_arrays[SECOND_STRUCTURE],
+        point_arrays[SECOND_STRUCTURE][0:N_BRUTEFORCE_KABSCH, 0:3],
+        N_amongst_array(point_arrays[FIRST_STRUCTURE], N_BRUTEFORCE_KABSCH),
+        batch_distance_array_function_for(distance_array_function),
+        score_tolerance,
+        chunk_size=kabsch_chunk_size,
+        verbosity=verbosity,
+        stats=stats,
+    )
 
-        if (best_score is None) or current_score <= best_score:
-            best_match, best_score = kabsched_list1, current_score
-            if verbosity >= 3:
-                log.debug("Best score so far with bruteforce {N}-point Kabsch fitting: {best_score}".format(
-                    best_score=best_score,
-                    N=N_BRUTEFORCE_KABSCH,
-                ))
+    if search_result.status == SEARCH_KABSCH_ERROR or search_result.aligned_array is None:
+        if verbosity >= 1:
+            log.error("ERROR: Kabsch points are either coplanar or colinear. Algorithm won't work")
+        return Alignment_Method_Result('bruteforce_kabsch_method', FAILED_ALIGNMENT)
 
     if verbosity >= 3:
-        log.debug("Minimum Score from bruteforce Kabsch method is: {0}".format(
-            best_score,
+        log.debug("Minimum Score from bruteforce {N}-point Kabsch method is: {0} (candidate {1})".format(
+            search_result.score,
+            search_result.candidate_number,
+            N=N_BRUTEFORCE_KABSCH,
         ))
 
     return Alignment_Method_Result(
         'bruteforce_kabsch',
         {
-            'array': current_match.tolist(),
-            'score': best_score,
+            'array': search_result.aligned_array.tolist(),
+            'score': search_result.score,
+            'transform': transform_for(*search_result.matrices),
         },
     )
 
@@ -1003,6 +1294,12 @@ def bruteforce_kabsch_method(point_lists, distance_array_function, flavour_lists
 #### HELPERS ####
 #################
 
+def batch_distance_array_function_for(distance_array_function):
+    '''Scores of a stack of point arrays, as expected by the searches of helpers.ambiguous_search.'''
+    if isinstance(distance_array_function, Flavoured_Scorer):
+        return distance_array_function.bounded_batch
+    return lambda point_arrays, reference_array, bound=None, tolerance=0.: array([distance_array_function(a_point_array, reference_array) for a_point_array in point_arrays])
+
 def rotation_matrix_kabsch_on_points(points1, points2):
     # Align those points using Kabsch algorithm
     P, Q = array(points1), array(points2)
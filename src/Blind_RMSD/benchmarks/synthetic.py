@@ -0,0 +1,193 @@
+from argparse import ArgumentParser, Namespace
+from json import dump, load
+from platform import python_version
+from statistics import median
+from subprocess import check_output, CalledProcessError, DEVNULL
+from time import perf_counter
+from tracemalloc import start as start_tracemalloc, stop as stop_tracemalloc, get_traced_memory, reset_peak
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from Blind_RMSD.align import pointsOnPoints
+from Blind_RMSD.helpers.kabsch import kabsch
+from Blind_RMSD.helpers.scoring import rmsd_array, rmsd_array_for_loop
+from Blind_RMSD.helpers.assertions import assert_found_permutation_array
+from Blind_RMSD.helpers.flavour_index import Flavoured_Scorer
+from Blind_RMSD.helpers.moldata import flavour_list
+
+DEFAULT_REPEATS = 7
+DEFAULT_OUTPUT = 'benchmark_synthetic.json'
+
+# Noise (in Angstrom) added to the rotated and permuted copy of every structure
+NOISE = 0.05
+
+ELEMENTS = ('C', 'C', 'C', 'H', 'H', 'O', 'N')
+
+Synthetic_Case = NamedTuple(
+    'Synthetic_Case',
+    [
+        ('name', str),
+        ('n_unique', int),
+        ('group_sizes', Tuple[int, ...]),
+        ('seed', int),
+    ],
+)
+
+SYNTHETIC_CASES = (
+    Synthetic_Case('small_unique', 8, (), 0),
+    Synthetic_Case('small_ambiguous', 2, (3, 3, 2), 1),
+    Synthetic_Case('medium', 6, (2, 2, 3, 3, 4, 4, 6), 2),
+    Synthetic_Case('medium_few_unique', 1, (3, 3, 4, 4, 4), 3),
+    Synthetic_Case('large', 12, (2,) * 20 + (3,) * 20 + (6,) * 10, 4),
+    Synthetic_Case('large_big_groups', 4, (24, 36, 40, 3, 3), 5),
+)
+
+def random_rotation(rng: Any) -> np.ndarray:
+    q = rng.normal(size=4)
+    a, b, c, d = q / np.linalg.norm(q)
+    return np.array([
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+        [2 * (b * c + a * d), a * a - b * b + c * c - d * d, 2 * (c * d - a * b)],
+        [2 * (b * d - a * c), 2 * (c * d + a * b), a * a - b * b - c * c + d * d],
+    ])
+
+def synthetic_structures(case: Synthetic_Case) -> Tuple[List[np.ndarray], List[List[str]]]:
+    '''
+    (moving, reference) point arrays and flavour lists: n_unique uniquely flavoured points, one group of equivalent
+    points per group size, and a noisy copy of the reference that is randomly rotated, translated and permuted.
+    '''
+    rng = np.random.default_rng(case.seed)
+    flavours = ['U{0}'.format(i) for i in range(case.n_unique)]
+    for (group, size) in enumerate(case.group_sizes):
+        flavours += ['G{0}'.format(group)] * size
+
+    reference = rng.normal(scale=np.cbrt(len(flavours)), size=(len(flavours), 3))
+    permutation = rng.permutation(len(flavours))
+    moving = np.dot(reference[permutation], random_rotation(rng).T) + rng.normal(scale=5., size=3) + rng.normal(scale=NOISE, size=reference.shape)
+
+    return [moving, reference], [[flavours[i] for i in permutation], flavours]
+
+def synthetic_molecule_data(case: Synthetic_Case) -> Dict[str, Any]:
+    '''Molecular data (as returned by chemical_equivalence) of a random tree shaped molecule, as input of flavour_list().'''
+    rng = np.random.default_rng(case.seed)
+    (_, reference), (_, flavours) = synthetic_structures(case)
+
+    group_ids = {flavour: group_id for (group_id, flavour) in enumerate(sorted(set(flavours)))}
+    parents = [None] + [int(rng.integers(0, i)) for i in range(1, len(flavours))]
+    atoms = {
+        i + 1: {
+            'type': ELEMENTS[i % len(ELEMENTS)],
+            'conn': [],
+            'equivalenceGroup': group_ids[flavour] if flavour.startswith('G') else -1,
+            'coord': (reference[i] / 10.).tolist(),
+        }
+        for (i, flavour) in enumerate(flavours)
+    }
+    for (i, parent) in enumerate(parents):
+        if parent is not None:
+            atoms[i + 1]['conn'].append(parent + 1)
+            atoms[parent + 1]['conn'].append(i + 1)
+    return {'atoms': atoms}
+
+def timed(function: Callable[[], Any], repeats: int) -> Dict[str, float]:
+    '''Median and minimum wall times (in seconds) over repeats calls, then peak traced memory (in bytes) of one call.'''
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+
+    start_tracemalloc()
+    try:
+        reset_peak()
+        function()
+        _, peak_memory = get_traced_memory()
+    finally:
+        stop_tracemalloc()
+
+    return {'median_s': median(times), 'min_s': min(times), 'peak_memory_bytes': peak_memory}
+
+def benchmarks_for(case: Synthetic_Case) -> Tuple[Dict[str, Callable[[], Any]], float]:
+    '''The functions to time on case, and the score of pointsOnPoints() on it (to spot accuracy changes across runs).'''
+    (moving, reference), flavour_lists = synthetic_structures(case)
+    data = synthetic_molecule_data(case)
+
+    P, Q = moving - moving.mean(axis=0), reference - reference.mean(axis=0)
+    scorer = Flavoured_Scorer(flavour_lists)
+    codes = np.array(flavour_lists[0])[:, np.newaxis] == np.array(flavour_lists[1])[np.newaxis, :]
+    mask_array = np.where(codes, 0., np.inf)
+
+    alignment = pointsOnPoints([moving.tolist(), reference.tolist()], flavour_lists=flavour_lists, soft_fail=True)
+    aligned = np.array(alignment.aligned_points)
+
+    return ({
+        'pointsOnPoints': lambda: pointsOnPoints([moving.tolist(), reference.tolist()], flavour_lists=flavour_lists, soft_fail=True),
+        'kabsch': lambda: kabsch(P, Q),
+        'rmsd_array_for_loop': lambda: rmsd_array_for_loop(aligned, reference, mask_array=mask_array.copy()),
+        'rmsd_array': lambda: rmsd_array(aligned, reference, mask_array=mask_array.copy()),
+        'Flavoured_Scorer': lambda: scorer(aligned, reference),
+        'assert_found_permutation_array': lambda: assert_found_permutation_array(aligned, reference, mask_array=mask_array.copy()),
+        'flavour_list': lambda: flavour_list(data),
+    }, float(alignment.score))
+
+def git_revision() -> str:
+    try:
+        return check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=DEVNULL).decode().strip()
+    except (CalledProcessError, OSError):
+        return 'unknown'
+
+def run(cases: Sequence[Synthetic_Case], repeats: int, only: Sequence[str] = ()) -> Dict[str, Any]:
+    results, scores = [], {}
+    for case in cases:
+        benchmarks, scores[case.name] = benchmarks_for(case)
+        for (function_name, function) in benchmarks.items():
+            if only and function_name not in only:
+                continue
+            result = dict(case=case.name, function=function_name, n_points=sum(case.group_sizes) + case.n_unique, **timed(function, repeats))
+            print('{case:>20} {function:>32}: median {median_s:.6f} s, peak {peak_memory_bytes:>10d} B'.format(**result))
+            results.append(result)
+
+    return {
+        'revision': git_revision(),
+        'python': python_version(),
+        'numpy': np.__version__,
+        'repeats': repeats,
+        'scores': scores,
+        'results': results,
+    }
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    '''Print the median time ratio (current / baseline) of every benchmark present in both, and any changed score.'''
+    baseline_times = {(result['case'], result['function']): result['median_s'] for result in baseline['results']}
+    print('Compared with revision {0}:'.format(baseline['revision']))
+    for (case_name, score) in results['scores'].items():
+        if case_name in baseline.get('scores', {}) and baseline['scores'][case_name] != score:
+            print('{0:>20}: score changed from {1} to {2}'.format(case_name, baseline['scores'][case_name], score))
+    for result in results['results']:
+        key = (result['case'], result['function'])
+        if key in baseline_times and baseline_times[key] > 0.:
+            print('{0:>20} {1:>32}: x{2:.2f}'.format(key[0], key[1], result['median_s'] / baseline_times[key]))
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Micro-benchmarks of the alignment engine on synthetic structures.')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON file to write the results to')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare with')
+    parser.add_argument('--only', nargs='*', default=(), help='Only run these functions')
+    parser.add_argument('--cases', nargs='*', default=None, help='Only run these cases: {0}'.format([case.name for case in SYNTHETIC_CASES]))
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    cases = [case for case in SYNTHETIC_CASES if args.cases is None or case.name in args.cases]
+    results = run(cases, args.repeats, only=args.only)
+
+    with open(args.output, 'w') as fh:
+        dump(results, fh, indent=2)
+    print('Results written to {0}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, load(fh))
@@ -0,0 +1,56 @@
+from typing import Any, Dict, List, Optional, Sequence
+
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.flavour_index import flavour_codes_for
+
+class PointSet:
+    '''
+    Structure of arrays replacing lists of ChemicalPoint: contiguous (N, 3) float64 coords, (N,) int32 indexes and
+    (N,) int32 flavour codes (see helpers.flavour_index.flavour_codes_for()).
+    '''
+    __slots__ = ('coords', 'indexes', 'flavour_codes', '_groups')
+
+    def __init__(self, coords: Array, indexes: Array, flavour_codes: Array):
+        self.coords = np.ascontiguousarray(coords, dtype=np.float64).reshape(len(indexes), 3)
+        self.indexes = np.asarray(indexes, dtype=np.int32)
+        self.flavour_codes = np.asarray(flavour_codes, dtype=np.int32)
+        self._groups = None
+
+    def __len__(self) -> int:
+        return len(self.indexes)
+
+    def __repr__(self) -> str:
+        return 'PointSet(N={0}, flavours={1})'.format(len(self), len(self.groups()))
+
+    def groups(self) -> Dict[int, Array]:
+        '''Positions of the points of every flavour code (in increasing position order), grouped with a stable argsort.'''
+        if self._groups is None:
+            order = np.argsort(self.flavour_codes, kind='stable')
+            codes, starts = np.unique(self.flavour_codes[order], return_index=True)
+            self._groups = dict(zip(codes.tolist(), np.split(order, starts[1:])))
+        return self._groups
+
+    def group_sizes(self) -> Dict[int, int]:
+        return {code: len(positions) for (code, positions) in self.groups().items()}
+
+    def unique_positions(self) -> Array:
+        '''Positions of the points with a unique flavour, by decreasing flavour.'''
+        return np.array(
+            [positions[0] for (code, positions) in sorted(self.groups().items(), reverse=True) if len(positions) == 1],
+            dtype=int,
+        )
+
+    def ambiguous_groups(self, max_group_size: Optional[int] = None) -> List[Array]:
+        '''Positions of the points of every flavour shared by several points (at most max_group_size), by (size, flavour).'''
+        return [
+            positions
+            for (code, positions) in sorted(self.groups().items(), key=lambda item: (len(item[1]), item[0]))
+            if 1 < len(positions) and (max_group_size is None or len(positions) <= max_group_size)
+        ]
+
+def point_sets_for(point_lists: Sequence[Any], flavour_lists: Sequence[Sequence[Any]]) -> List[PointSet]:
+    '''One PointSet per structure, with flavour codes shared by all structures.'''
+    return [
+        PointSet(point_list, np.arange(len(point_list)), flavour_codes)
+        for (point_list, flavour_codes) in zip(point_lists, flavour_codes_for(flavour_lists))
+    ]
@@ -0,0 +1,69 @@
+from threading import Lock
+from typing import Any, Dict, List, Optional, Sequence
+
+from scipy.spatial import cKDTree
+
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.PointSet import PointSet
+from Blind_RMSD.helpers.flavour_index import flavour_ranks, flavour_codes_for
+from Blind_RMSD.helpers.geometric_hashing import Triplet_Hash_Table
+
+class PreparedReference:
+    '''
+    Reference-side preprocessing of pointsOnPoints(), computed once and shared by all the alignments on the same
+    reference structure: coordinates and their centroid, sorted flavours, flavour codes and groups (PointSet), and the
+    cKDTrees of the large flavour groups and the Triplet_Hash_Table of geometric hashing (built on first use, under a
+    lock, so that alignments running in several threads can share it).
+    '''
+    def __init__(self, point_list: Sequence[Sequence[float]], flavour_list: Sequence[Any], data: Any = None):
+        self.point_list = point_list
+        self.flavour_list = list(flavour_list)
+        self.data = data
+
+        self.point_array = array(point_list, dtype=float)
+        self.center_of_geometry = np.mean(self.point_array, axis=0)
+        self.centered_point_array = self.point_array - self.center_of_geometry
+
+        self.sorted_flavour_list = sorted(self.flavour_list)
+        self.flavour_ranks = flavour_ranks([self.flavour_list])
+
+        self.point_set = PointSet(
+            self.point_array,
+            np.arange(len(self.point_array)),
+            flavour_codes_for([self.flavour_list], self.flavour_ranks)[0],
+        )
+        self.point_set.groups()
+
+        self._trees = {id(self.point_array): {}, id(self.centered_point_array): {}}
+        self._triplet_hash_table = None
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.point_array)
+
+    def point_set_for(self, point_list: Sequence[Sequence[float]], flavour_list: Sequence[Any]) -> PointSet:
+        '''PointSet of a structure to align on the reference, with the flavour codes of the reference.'''
+        return PointSet(
+            point_list,
+            np.arange(len(point_list)),
+            flavour_codes_for([flavour_list], self.flavour_ranks)[0],
+        )
+
+    def tree_for(self, reference_array: Array, reference_indices: Array) -> Optional[cKDTree]:
+        '''Cached cKDTree of reference_array[reference_indices], if reference_array is one of the reference arrays.'''
+        if reference_array is not self.point_array and reference_array is not self.centered_point_array:
+            return None
+
+        trees = self._trees[id(reference_array)]
+        key = reference_indices.tobytes()
+        with self._lock:
+            if key not in trees:
+                trees[key] = cKDTree(reference_array[reference_indices])
+            return trees[key]
+
+    def triplet_hash_table(self) -> Triplet_Hash_Table:
+        '''Triplet_Hash_Table of the centered reference structure (see helpers.geometric_hashing).'''
+        with self._lock:
+            if self._triplet_hash_table is None:
+                self._triplet_hash_table = Triplet_Hash_Table(self.centered_point_array, self.point_set.flavour_codes)
+            return self._triplet_hash_table
@@ -0,0 +1,499 @@
+from itertools import permutations, islice
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.kabsch import kabsch_batch, kabsch_from_covariances
+from Blind_RMSD.helpers.qcp import qcp_rmsd, qcp_degenerate
+from Blind_RMSD.helpers.scoring import INFINITE_RMSD
+
+# Number of candidate permutations evaluated at once; bounds memory to O(DEFAULT_CHUNK_SIZE * N) floats
+DEFAULT_CHUNK_SIZE = 256
+
+Search_Result = NamedTuple(
+    'Search_Result',
+    [
+        ('status', str),
+        ('candidate_number', Optional[int]),
+        ('aligned_array', Optional[Array]),
+        ('score', float),
+        ('matrices', Optional[Any]),
+    ],
+)
+
+SEARCH_SUCCESS, SEARCH_EARLY_SUCCESS, SEARCH_KABSCH_ERROR = 'success', 'early_success', 'kabsch_error'
+
+def permutation_array_for(atom_indexes: Sequence[int], N: int) -> Array:
+    '''All the ordered selections of N indexes amongst atom_indexes, as a (len, N) array, in itertools.permutations() order.'''
+    selections = list(permutations(atom_indexes, r=N))
+    return np.array(selections, dtype=int).reshape(len(selections), N)
+
+def total_number_candidates(permutation_arrays: Sequence[Array]) -> int:
+    return int(np.prod([len(permutation_array) for permutation_array in permutation_arrays], dtype=np.int64))
+
+Covariance_Tables = NamedTuple(
+    'Covariance_Tables',
+    [
+        ('shape', Tuple[int, ...]),
+        ('origin', Array),
+        ('n_anchors', int),
+        ('fixed_sum', Array),
+        ('fixed_covariance', Array),
+        ('selection_sums', List[Array]),
+        ('selection_covariances', List[Array]),
+    ],
+)
+
+def covariance_tables_for(
+    point_array: Array,
+    reference_anchor_array: Array,
+    fixed_anchor_indexes: Array,
+    permutation_arrays: Sequence[Array],
+) -> Covariance_Tables:
+    '''
+    Contributions of the fixed anchors and of every selection of every group to the covariance matrix (and to the sum
+    of the anchors) of the candidates, so that candidate_covariances() assembles them with one addition per group.
+
+    Since the centered reference anchors sum to zero, the covariance (P - Pc)^T (Q - Qc) of a candidate equals
+    P^T (Q - Qc), a sum of independent terms over its anchor slots. Points are taken relative to their centroid (origin)
+    to avoid cancellation errors far from the origin.
+    '''
+    origin = point_array.mean(axis=0)
+    centered_point_array = point_array - origin
+    centered_reference_anchor_array = reference_anchor_array - reference_anchor_array.mean(axis=0)
+
+    P = centered_point_array[fixed_anchor_indexes]
+    first_slot = len(fixed_anchor_indexes)
+    fixed_sum, fixed_covariance = P.sum(axis=0), np.dot(P.T, centered_reference_anchor_array[:first_slot])
+
+    selection_sums, selection_covariances = [], []
+    for permutation_array in permutation_arrays:
+        n_slots = permutation_array.shape[1]
+        P = centered_point_array[permutation_array]
+        selection_sums.append(P.sum(axis=1))
+        selection_covariances.append(np.matmul(np.swapaxes(P, -1, -2), centered_reference_anchor_array[first_slot:first_slot + n_slots]))
+        first_slot += n_slots
+
+    return Covariance_Tables(
+        tuple(len(permutation_array) for permutation_array in permutation_arrays),
+        origin,
+        first_slot,
+        fixed_sum,
+        fixed_covariance,
+        selection_sums,
+        selection_covariances,
+    )
+
+def candidate_covariances(covariance_tables: Covariance_Tables, candidate_numbers: Array) -> Tuple[Array, Array]:
+    '''(K, 3, 3) covariance matrices and (K, 3) anchor centroids of the candidates numbered candidate_numbers.'''
+    C = np.broadcast_to(covariance_tables.fixed_covariance, (len(candidate_numbers), 3, 3))
+    sums = np.broadcast_to(covariance_tables.fixed_sum, (len(candidate_numbers), 3))
+
+    if len(covariance_tables.shape) > 0:
+        digits = np.unravel_index(candidate_numbers - 1, covariance_tables.shape)
+        for (selection_sums, selection_covariances, digit) in zip(covariance_tables.selection_sums, covariance_tables.selection_covariances, digits):
+            C, sums = C + selection_covariances[digit], sums + selection_sums[digit]
+
+    return C, sums / covariance_tables.n_anchors + covariance_tables.origin
+
+def symmetry_image_tables(permutation_arrays: Sequence[Array], symmetries: Sequence[Array]) -> List[Array]:
+    '''
+    For every group, the (n_symmetries, len(permutation_array)) table of the row indexes of the images of its selections
+    by every symmetry (a flavour preserving permutation of the points, mapping every group onto itself).
+    '''
+    image_tables = []
+    for permutation_array in permutation_arrays:
+        n_selections, N = permutation_array.shape
+        atom_indexes = np.unique(permutation_array)
+        position = lambda indexes: np.searchsorted(atom_indexes, indexes)
+        # Selections are encoded in base len(atom_indexes), so that images can be found by sorted search
+        key = lambda selections: np.dot(position(selections), len(atom_indexes) ** np.arange(N - 1, -1, -1, dtype=np.int64))
+
+        keys = key(permutation_array)
+        order = np.argsort(keys)
+        image_tables.append(np.array(
+            [order[np.searchsorted(keys[order], key(symmetry[permutation_array]))] for symmetry in symmetries],
+            dtype=int,
+        ).reshape(len(symmetries), n_selections))
+
+    return image_tables
+
+def orbit_representatives(digits: Sequence[Array], shape: Tuple[int, ...], image_tables: Sequence[Array]) -> Array:
+    '''
+    Mask of the candidates (given by their digits, one array of selection indexes per group) that come first in their
+    orbit under the symmetries, i.e. whose candidate number is lower than the one of all their images.
+    '''
+    candidate_numbers = np.ravel_multi_index(tuple(digits), shape)
+    if len(image_tables) == 0 or len(image_tables[0]) == 0:
+        return np.ones(len(candidate_numbers), dtype=bool)
+
+    image_numbers = np.ravel_multi_index(tuple(image_table[:, digit] for (image_table, digit) in zip(image_tables, digits)), shape)
+    return candidate_numbers <= image_numbers.min(axis=0)
+
+def candidate_chunks(
+    permutation_arrays: Sequence[Array],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    image_tables: Optional[Sequence[Array]] = None,
+) -> Iterator[Tuple[Array, Array]]:
+    '''
+    Chunks of the cartesian product of permutation_arrays, in itertools.product() order, as (candidate_numbers, chunk).
+    Each chunk is a (K, sum of N) array; each row concatenates one selection of every group.
+    With image_tables (see symmetry_image_tables()), only the first candidate of every orbit is kept.
+    '''
+    shape = tuple(len(permutation_array) for permutation_array in permutation_arrays)
+    total = total_number_candidates(permutation_arrays)
+
+    for start in range(0, total, chunk_size):
+        candidate_numbers = np.arange(start, min(start + chunk_size, total))
+        digits = np.unravel_index(candidate_numbers, shape)
+
+        if image_tables is not None:
+            is_representative = orbit_representatives(digits, shape, image_tables)
+            candidate_numbers, digits = candidate_numbers[is_representative], [digit[is_representative] for digit in digits]
+
+        if len(candidate_numbers) > 0:
+            yield (
+                candidate_numbers + 1,
+                np.concatenate(
+                    [permutation_array[digit] for (permutation_array, digit) in zip(permutation_arrays, digits)],
+                    axis=1,
+                ),
+            )
+
+def evaluate_candidates(
+    point_array: Array,
+    reference_array: Array,
+    reference_anchor_array: Array,
+    anchor_indexes: Array,
+    candidate_numbers: Array,
+    best_result: Search_Result,
+    batch_distance_array_function: Callable[[Array, Array], Array],
+    score_tolerance: float,
+    on_candidate: Optional[Callable[[int, Array, Any], None]] = None,
+    verbosity: int = 0,
+    stats: Optional[Any] = None,
+    covariance_tables: Optional[Covariance_Tables] = None,
+) -> Tuple[Optional[Search_Result], Search_Result]:
+    '''
+    Fit point_array on reference_array for a (K, n) stack of candidate anchor_indexes (mapped onto reference_anchor_array,
+    numbered by candidate_numbers),
+    with stacked (K, 3, 3) covariance matrices, one batched SVD and one vectorized scoring call.
+    With covariance_tables (see covariance_tables_for()), the covariance matrices and anchor centroids are assembled
+    from the candidate numbers instead of the anchor coordinates.
+    batch_distance_array_function(point_arrays, reference_array, bound=None, tolerance=0.) may return INFINITE_RMSD for
+    the scores above max(tolerance, min(bound, lowest score)) (see Flavoured_Scorer.bounded_batch()).
+    Returns (final_result, best_result), where final_result is not None if the search should stop
+    (a candidate scored below score_tolerance, or a degenerate candidate was reached).
+    '''
+    Qc = reference_anchor_array.mean(axis=0)
+
+    if covariance_tables is not None:
+        C, Pc = candidate_covariances(covariance_tables, candidate_numbers)
+        U, degenerate = kabsch_from_covariances(C)
+    else:
+        P = point_array[anchor_indexes]
+        Pc = P.mean(axis=1)
+        U, degenerate = kabsch_batch(P - Pc[:, np.newaxis, :], reference_anchor_array - Qc)
+    # All of them are decomposed (in one batched call), including the ones after a degenerate candidate
+    if stats is not None:
+        stats.n_svd_calls += len(anchor_indexes)
+
+    # Only the candidates up to (excluding) the first degenerate one would have been reached sequentially
+    n_reached = int(np.argmax(degenerate)) if np.any(degenerate) else len(anchor_indexes)
+
+    kabsched_arrays = np.matmul(point_array[np.newaxis, :, :] - Pc[:n_reached, np.newaxis, :], U[:n_reached]) + Qc
+    # Only the scores of the candidates that can end the search or become the best one are needed exactly
+    scores = batch_distance_array_function(kabsched_arrays, reference_array, bound=best_result.score, tolerance=score_tolerance) if n_reached > 0 else np.array([])
+
+    below_tolerance = np.flatnonzero(scores <= score_tolerance)
+    n_evaluated = below_tolerance[0] + 1 if len(below_tolerance) > 0 else n_reached
+    if stats is not None:
+        stats.n_evaluated_permutations += int(n_evaluated)
+
+    if on_candidate is not None:
+        for i in range(n_evaluated):
+            on_candidate(candidate_numbers[i], kabsched_arrays[i], (U[i], Pc[i], Qc))
+
+    if len(below_tolerance) > 0:
+        i = below_tolerance[0]
+        return (
+            Search_Result(SEARCH_EARLY_SUCCESS, candidate_numbers[i], kabsched_arrays[i], scores[i], (U[i], Pc[i], Qc)),
+            best_result,
+        )
+
+    if n_reached < len(anchor_indexes):
+        if verbosity >= 1:
+            log.error("ERROR: Kabsch points are either coplanar or colinear (candidate {0}). Algorithm won't work".format(candidate_numbers[n_reached]))
+        return (
+            Search_Result(SEARCH_KABSCH_ERROR, candidate_numbers[n_reached], None, INFINITE_RMSD, None),
+            best_result,
+        )
+
+    # Ties are resolved in favour of the last candidate, like the sequential search
+    i = len(scores) - 1 - int(np.argmin(scores[::-1]))
+    if best_result.score is None or scores[i] <= best_result.score:
+        best_result = Search_Result(SEARCH_SUCCESS, candidate_numbers[i], kabsched_arrays[i], scores[i], (U[i], Pc[i], Qc))
+
+        if verbosity >= 5:
+            log.debug("Best score so far with batched Kabsch fitting: {0} (candidate {1})".format(best_result.score, best_result.candidate_number))
+
+    return (None, best_result)
+
+def with_fixed_anchors(fixed_anchor_indexes: Array, chunk: Array) -> Array:
+    return np.concatenate(
+        (np.broadcast_to(fixed_anchor_indexes, (len(chunk), len(fixed_anchor_indexes))), chunk),
+        axis=1,
+    )
+
+def batched_kabsch_search(
+    point_array: Array,
+    reference_array: Array,
+    fixed_anchor_indexes: Sequence[int],
+    reference_anchor_array: Array,
+    permutation_arrays: Sequence[Array],
+    batch_distance_array_function: Callable[[Array, Array], Array],
+    score_tolerance: float,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    on_candidate: Optional[Callable[[int, Array, Any], None]] = None,
+    symmetries: Sequence[Array] = (),
+    verbosity: int = 0,
+    stats: Optional[Any] = None,
+) -> Search_Result:
+    '''
+    Fit point_array on reference_array using every candidate set of anchors:
+    fixed_anchor_indexes followed by one row of the cartesian product of permutation_arrays,
+    mapped onto reference_anchor_array (in that order).
+
+    Candidates are evaluated chunk_size at a time (see evaluate_candidates()).
+    The result is the one of the sequential search: the first candidate scoring below score_tolerance,
+    or the last candidate with the lowest score, or a Kabsch error if a degenerate candidate comes first.
+
+    symmetries (see helpers.symmetry) map candidates onto candidates with the same score (their anchors are the image
+    of each other by a rotation of point_array): only the first candidate of every orbit is evaluated, and the orbit
+    of the best one is searched at the end for the candidate the exhaustive search would have returned.
+    '''
+    fixed_anchor_indexes = np.array(fixed_anchor_indexes, dtype=int)
+    image_tables = symmetry_image_tables(permutation_arrays, symmetries) if len(symmetries) > 0 else None
+    covariance_tables = covariance_tables_for(point_array, reference_anchor_array, fixed_anchor_indexes, permutation_arrays)
+
+    best_result = Search_Result(SEARCH_SUCCESS, None, None, None, None)
+
+    for (candidate_numbers, chunk) in candidate_chunks(permutation_arrays, chunk_size=chunk_size, image_tables=image_tables):
+        final_result, best_result = evaluate_candidates(
+            point_array,
+            reference_array,
+            reference_anchor_array,
+            with_fixed_anchors(fixed_anchor_indexes, chunk),
+            candidate_numbers,
+            best_result,
+            batch_distance_array_function,
+            score_tolerance,
+            on_candidate=on_candidate,
+            verbosity=verbosity,
+            stats=stats,
+            covariance_tables=covariance_tables,
+        )
+
+        if final_result is not None:
+            return final_result
+
+    if image_tables is not None:
+        return best_in_orbit(
+            point_array,
+            reference_array,
+            fixed_anchor_indexes,
+            reference_anchor_array,
+            permutation_arrays,
+            image_tables,
+            best_result,
+            batch_distance_array_function,
+            score_tolerance,
+            verbosity=verbosity,
+            stats=stats,
+            covariance_tables=covariance_tables,
+        )
+
+    return best_result
+
+def selection_kabsch_search(
+    point_array: Array,
+    reference_array: Array,
+    reference_anchor_array: Array,
+    anchor_selections: Iterable[Sequence[int]],
+    batch_distance_array_function: Callable[[Array, Array], Array],
+    score_tolerance: float,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    on_candidate: Optional[Callable[[int, Array, Any], None]] = None,
+    verbosity: int = 0,
+    stats: Optional[Any] = None,
+) -> Search_Result:
+    '''
+    Same as batched_kabsch_search(), for candidates given as an iterable (e.g. a lazy generator) of anchor_selections
+    of point_array, mapped onto reference_anchor_array: only chunk_size of them are ever held in memory.
+    '''
+    anchor_selections = iter(anchor_selections)
+    best_result = Search_Result(SEARCH_SUCCESS, None, None, None, None)
+
+    start = 0
+    while True:
+        chunk = np.array(list(islice(anchor_selections, chunk_size)), dtype=int).reshape(-1, len(reference_anchor_array))
+        if len(chunk) == 0:
+            return best_result
+
+        final_result, best_result = evaluate_candidates(
+            point_array,
+            reference_array,
+            reference_anchor_array,
+            chunk,
+            # Numbered from 1, like the candidates of the other searches
+            np.arange(start + 1, start + 1 + len(chunk)),
+            best_result,
+            batch_distance_array_function,
+            score_tolerance,
+            on_candidate=on_candidate,
+            verbosity=verbosity,
+            stats=stats,
+        )
+        if final_result is not None:
+            return final_result
+
+        start += len(chunk)
+
+def best_in_orbit(
+    point_array: Array,
+    reference_array: Array,
+    fixed_anchor_indexes: Array,
+    reference_anchor_array: Array,
+    permutation_arrays: Sequence[Array],
+    image_tables: Sequence[Array],
+    best_result: Search_Result,
+    batch_distance_array_function: Callable[[Array, Array], Array],
+    score_tolerance: float,
+    verbosity: int = 0,
+    stats: Optional[Any] = None,
+    covariance_tables: Optional[Covariance_Tables] = None,
+) -> Search_Result:
+    '''Re-evaluate the orbit of the best (representative) candidate, resolving ties like the exhaustive search.'''
+    if best_result.candidate_number is None:
+        return best_result
+
+    shape = tuple(len(permutation_array) for permutation_array in permutation_arrays)
+    digits = np.unravel_index(best_result.candidate_number - 1, shape)
+    image_numbers = np.ravel_multi_index(tuple(image_table[:, digit] for (image_table, digit) in zip(image_tables, digits)), shape)
+    candidate_numbers = np.unique(image_numbers[image_numbers != best_result.candidate_number - 1])
+
+    if len(candidate_numbers) == 0:
+        return best_result
+
+    final_result, best_result = evaluate_candidates(
+        point_array,
+        reference_array,
+        reference_anchor_array,
+        with_fixed_anchors(
+            fixed_anchor_indexes,
+            np.concatenate(
+                [permutation_array[digit] for (permutation_array, digit) in zip(permutation_arrays, np.unravel_index(candidate_numbers, shape))],
+                axis=1,
+            ),
+        ),
+        candidate_numbers + 1,
+        best_result,
+        batch_distance_array_function,
+        score_tolerance,
+        verbosity=verbosity,
+        stats=stats,
+        covariance_tables=covariance_tables,
+    )
+
+    return final_result if final_result is not None else best_result
+
+# Number of candidates (with the lowest anchor RMSD) fully scored by shortlisted_kabsch_search()
+DEFAULT_SHORTLIST_SIZE = 64
+
+def shortlisted_kabsch_search(
+    point_array: Array,
+    reference_array: Array,
+    fixed_anchor_indexes: Sequence[int],
+    reference_anchor_array: Array,
+    permutation_arrays: Sequence[Array],
+    batch_distance_array_function: Callable[[Array, Array], Array],
+    score_tolerance: float,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    on_candidate: Optional[Callable[[int, Array, Any], None]] = None,
+    symmetries: Sequence[Array] = (),
+    verbosity: int = 0,
+    stats: Optional[Any] = None,
+    shortlist_size: int = DEFAULT_SHORTLIST_SIZE,
+) -> Search_Result:
+    '''
+    Heuristic version of batched_kabsch_search(): every candidate is first ranked by the RMSD of its anchors after the
+    optimal rotation, computed with QCP (helpers.qcp) without building rotation matrices or moving the whole
+    structure. Only the shortlist_size best ranked candidates are then fitted and scored (in candidate order, with the
+    same early exit and tie rules as batched_kabsch_search()).
+    Degenerate candidates are left out of the shortlist instead of making the search fail.
+    '''
+    fixed_anchor_indexes = np.array(fixed_anchor_indexes, dtype=int)
+    image_tables = symmetry_image_tables(permutation_arrays, symmetries) if len(symmetries) > 0 else None
+
+    centered_reference_anchor_array = reference_anchor_array - reference_anchor_array.mean(axis=0)
+    covariance_tables = covariance_tables_for(point_array, reference_anchor_array, fixed_anchor_indexes, permutation_arrays)
+
+    shortlist_numbers, shortlist_anchors, shortlist_rmsds = np.zeros(0, dtype=int), np.zeros((0, len(reference_anchor_array)), dtype=int), np.zeros(0)
+    for (candidate_numbers, chunk) in candidate_chunks(permutation_arrays, chunk_size=chunk_size, image_tables=image_tables):
+        anchor_indexes = with_fixed_anchors(fixed_anchor_indexes, chunk)
+        P = point_array[anchor_indexes]
+        P = P - P.mean(axis=1)[:, np.newaxis, :]
+
+        is_valid = ~qcp_degenerate(P, centered_reference_anchor_array)
+
+        shortlist_numbers = np.concatenate((shortlist_numbers, candidate_numbers[is_valid]))
+        shortlist_anchors = np.concatenate((shortlist_anchors, anchor_indexes[is_valid]))
+        shortlist_rmsds = np.concatenate((shortlist_rmsds, qcp_rmsd(P[is_valid], centered_reference_anchor_array)))
+
+        if len(shortlist_numbers) > shortlist_size:
+            kept = np.argpartition(shortlist_rmsds, shortlist_size - 1)[:shortlist_size]
+            shortlist_numbers, shortlist_anchors, shortlist_rmsds = shortlist_numbers[kept], shortlist_anchors[kept], shortlist_rmsds[kept]
+
+    if verbosity >= 3:
+        log.debug('Shortlisted {0} candidates (anchor RMSD <= {1})'.format(len(shortlist_numbers), shortlist_rmsds.max() if len(shortlist_rmsds) > 0 else None))
+
+    order = np.argsort(shortlist_numbers)
+    shortlist_numbers, shortlist_anchors = shortlist_numbers[order], shortlist_anchors[order]
+
+    best_result = Search_Result(SEARCH_SUCCESS, None, None, None, None)
+    for start in range(0, len(shortlist_numbers), chunk_size):
+        final_result, best_result = evaluate_candidates(
+            point_array,
+            reference_array,
+            reference_anchor_array,
+            shortlist_anchors[start:start + chunk_size],
+            shortlist_numbers[start:start + chunk_size],
+            best_result,
+            batch_distance_array_function,
+            score_tolerance,
+            on_candidate=on_candidate,
+            verbosity=verbosity,
+            stats=stats,
+            covariance_tables=covariance_tables,
+        )
+
+        if final_result is not None:
+            return final_result
+
+    if image_tables is not None:
+        return best_in_orbit(
+            point_array,
+            reference_array,
+            fixed_anchor_indexes,
+            reference_anchor_array,
+            permutation_arrays,
+            image_tables,
+            best_result,
+            batch_distance_array_function,
+            score_tolerance,
+            verbosity=verbosity,
+            stats=stats,
+            covariance_tables=covariance_tables,
+        )
+
+    return best_result
@@ -1,11 +1,9 @@
-from functools import reduce
-from typing import Optional, List, Tuple
+from typing import Any, Optional, List, Tuple, Union
 
 from scipy.spatial.distance import cdist, pdist
 
 from Blind_RMSD.helpers.log import log, pformat
 from Blind_RMSD.helpers.numpy_helpers import *
-from Blind_RMSD.helpers.moldata import group_by
 from Blind_RMSD.helpers.exceptions import Permutation_Not_Found_Error
 
 BYPASS_SILENT = False
@@ -79,93 +77,87 @@ def assert_blind_rmsd_symmetry(array_1, array_2, distance_function, verbosity=1)
         soft_fail=True,
     )
 
-def assert_found_permutation_array(array1, array2, chemical_points_lists=None, mask_array=None, hard_fail=False, verbosity=0) -> Optional[List[Tuple[int, int]]]:
+def assert_found_permutation_array(
+    array1: Array,
+    array2: Array,
+    point_sets: Optional[Any] = None,
+    mask_array: Optional[Array] = None,
+    flavour_scorer: Optional[Any] = None,
+    hard_fail: bool = False,
+    as_tuples: bool = False,
+    verbosity: int = 0,
+) -> Optional[Union[Array, List[Tuple[int, int]]]]:
+    '''
+    Permutation mapping every point of array1 to its closest (same-flavour) point of array2, if that mapping is one to one.
+    Returns an int array (point index in the second structure for every point of the first structure), or the list of
+    (point index in the first structure, point index in the second structure) pairs if as_tuples.
+    Returns None (or raises Permutation_Not_Found_Error if hard_fail) if some point of array2 is the closest to several
+    points of array1.
+    '''
     from Blind_RMSD.align import FIRST_STRUCTURE, SECOND_STRUCTURE
 
-    distance_matrix = get_distance_matrix(array1, array2)
+    # Points are identified by their (integer) index in their structure
+    if point_sets is not None:
+        point_indexes = [point_set.indexes for point_set in point_sets]
+    else:
+        point_indexes = [np.arange(len(array1)), np.arange(len(array2))]
 
-    if mask_array is not None:
-        distance_matrix += mask_array
+    if flavour_scorer is not None:
+        # Closest same-flavour points, without building the (masked) distance matrix
+        _, closest_indices = flavour_scorer.nearest(array1, array2)
+        dim = (len(array1), len(array2))
+    else:
+        distance_matrix = get_distance_matrix(array1, array2)
 
-    if verbosity >= 5:
-        log.debug('Distance matrix for permutation array:')
-        log.debug(distance_matrix)
+        if mask_array is not None:
+            distance_matrix += mask_array
 
-    dim = distance_matrix.shape
-    assert dim[0] == dim[1]
+        if verbosity >= 5:
+            log.debug('Distance matrix for permutation array:')
+            log.debug(distance_matrix)
 
-    def closest_point_in_second_structure_to(i):
-        min_j = 0
-        min_dist = distance_matrix[i, min_j]
-        for j in range(1, dim[1]):
-            distance = distance_matrix[i, j]
-            if distance < min_dist:
-                min_dist, min_j = distance, j
-            elif distance == min_dist:
-                if False:
-                    if distance != INF:
-                        raise Exception('ERROR: equal distance clash (i={0}, j={1})'.format(i, j))
-        return (
-            chemical_points_lists[FIRST_STRUCTURE][i],
-            chemical_points_lists[SECOND_STRUCTURE][min_j],
-            min_dist,
-        )
+        dim = distance_matrix.shape
+        # First closest point of every row
+        closest_indices = np.argmin(distance_matrix, axis=1)
+
+    assert dim[0] == dim[1]
 
-    point_mapping = [closest_point_in_second_structure_to(i) for i in range(dim[0])]
+    closest_indices = np.asarray(closest_indices, dtype=int)
+    mapping_counts = np.bincount(closest_indices, minlength=dim[1])
+    mapped_several_times = np.flatnonzero(mapping_counts >= 2)
 
     if verbosity >= 5:
         log.debug('point_mapping:')
-        log.debug(pformat(point_mapping))
-
-    def mapped_with_condition(condition = lambda group: len(group) == 1):
-        return set(
-            reduce(
-                lambda acc, e: acc + e,
-                [
-                    group
-                    for (key, group) in list(group_by(
-                        [point_2 for (_, point_2, _) in point_mapping],
-                        key=lambda x: x,
-                    ).items())
-                    if condition(group)
-                ],
-                [],
-            ),
-        )
-
-    mapped_several_times = mapped_with_condition(condition=lambda group: (len(group) >= 2))
-    mapped_exactly_once = mapped_with_condition(condition=lambda group: (len(group) == 1))
-
-    not_mapped = set(chemical_points_lists[SECOND_STRUCTURE]) - mapped_several_times - mapped_exactly_once
+        log.debug(pformat(list(zip(point_indexes[FIRST_STRUCTURE].tolist(), point_indexes[SECOND_STRUCTURE][closest_indices].tolist()))))
 
     if verbosity >= 3:
         log.error('Points of reference structure mapped several times: {0}'.format(
-            mapped_several_times,
+            set(point_indexes[SECOND_STRUCTURE][mapped_several_times].tolist()),
         ))
 
-    for point in mapped_several_times:
-        if verbosity >= 3:
+        for j in mapped_several_times:
             log.error('Point {0} from reference structure was mapped to the following points of the aligned structure: {1}'.format(
-                point,
-                [point_1 for (point_1, point_2, _) in point_mapping if point_2 == point],
+                point_indexes[SECOND_STRUCTURE][j],
+                point_indexes[FIRST_STRUCTURE][closest_indices == j].tolist(),
             ))
 
-    if verbosity >= 3:
         log.error('Points of reference structure not mapped at all: {0}'.format(
-            not_mapped,
+            set(point_indexes[SECOND_STRUCTURE][mapping_counts == 0].tolist()),
         ))
 
-    try:
-        assert mapped_several_times == set(), mapped_several_times
-    except AssertionError:
+    if len(mapped_several_times) > 0:
         if hard_fail:
-            raise Permutation_Not_Found_Error(mapped_several_times)
+            raise Permutation_Not_Found_Error(set(point_indexes[SECOND_STRUCTURE][mapped_several_times].tolist()))
         else:
             return None
 
-    index_permutation = [(point_1.index, point_2.index) for (point_1, point_2, _) in point_mapping]
+    permutation = np.empty(dim[0], dtype=int)
+    permutation[point_indexes[FIRST_STRUCTURE]] = point_indexes[SECOND_STRUCTURE][closest_indices]
 
     if verbosity >= 3:
-        log.debug('INFO: Found a permutation between points of the aligned structure and points of the reference structure: {0} and {1}'.format(*list(zip(*index_permutation))))
+        log.debug('INFO: Found a permutation between points of the aligned structure and points of the reference structure: {0}'.format(permutation))
 
-    return index_permutation
+    if as_tuples:
+        return list(zip(point_indexes[FIRST_STRUCTURE].tolist(), point_indexes[SECOND_STRUCTURE][closest_indices].tolist()))
+    else:
+        return permutation
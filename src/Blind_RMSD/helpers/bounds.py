@@ -0,0 +1,45 @@
+from typing import Any, Sequence
+
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.flavour_index import flavour_codes_for
+from Blind_RMSD.helpers.scoring import INFINITE_RMSD
+
+def nearest_sorted_gaps(values: Array, sorted_values: Array) -> Array:
+    '''|v - s| for the closest s of sorted_values (non-empty) to every v of values.'''
+    positions = np.searchsorted(sorted_values, values)
+    lower = sorted_values[np.clip(positions - 1, 0, len(sorted_values) - 1)]
+    upper = sorted_values[np.clip(positions, 0, len(sorted_values) - 1)]
+    return np.minimum(np.abs(values - lower), np.abs(values - upper))
+
+def radial_lower_bound(
+    point_array: Array,
+    flavours: Sequence[Any],
+    reference_array: Array,
+    reference_flavours: Sequence[Any],
+) -> float:
+    '''
+    Lower bound on the flavoured closest point RMSD of any alignment of point_array on reference_array that maps its
+    centroid onto the centroid of reference_array (which all the alignments of pointsOnPoints() do), found without
+    any search.
+    A point at distance r from its centroid stays at distance r from the reference centroid under any such alignment,
+    so it is at least min |r - r'| away from every reference point of the same flavour at distance r' from the
+    reference centroid.
+    INFINITE_RMSD if a flavour of point_array is missing from reference_array.
+
+    NB: bounds comparing inertia tensors or intra-distance profiles do not apply, since the closest point score does
+    not match points one to one.
+    '''
+    point_array, reference_array = array(point_array, dtype=float), array(reference_array, dtype=float)
+    codes, reference_codes = flavour_codes_for([flavours, reference_flavours])
+
+    radii = np.linalg.norm(point_array - point_array.mean(axis=0), axis=1)
+    reference_radii = np.linalg.norm(reference_array - reference_array.mean(axis=0), axis=1)
+
+    gaps = np.empty(len(radii))
+    for code in np.unique(codes):
+        on_code, on_reference_code = codes == code, reference_codes == code
+        if not np.any(on_reference_code):
+            return INFINITE_RMSD
+        gaps[on_code] = nearest_sorted_gaps(radii[on_code], np.sort(reference_radii[on_reference_code]))
+
+    return float(sqrt(mean(square(gaps))))
@@ -0,0 +1,118 @@
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+
+class Union_Find:
+    '''Disjoint sets over 0..n-1 (path halving), whose roots are always the smallest element of their set.'''
+    def __init__(self, n: int):
+        self.parents = list(range(n))
+
+    def find(self, i: int) -> int:
+        while self.parents[i] != i:
+            self.parents[i] = self.parents[self.parents[i]]
+            i = self.parents[i]
+        return i
+
+    def union(self, i: int, j: int) -> int:
+        root_i, root_j = self.find(i), self.find(j)
+        root = min(root_i, root_j)
+        self.parents[root_i] = self.parents[root_j] = root
+        return root
+
+    def sets(self) -> List[List[int]]:
+        sets = {}
+        for i in range(len(self.parents)):
+            sets.setdefault(self.find(i), []).append(i)
+        return [members for (_, members) in sorted(sets.items())]
+
+Clustering = NamedTuple(
+    'Clustering',
+    [
+        ('clusters', List[List[int]]),
+        ('representatives', List[int]),
+        ('scores', Dict[Tuple[int, int], float]),
+        ('n_skipped_merged', int),
+        ('n_skipped_triangle', int),
+    ],
+)
+
+def transitive_clusters(
+    n: int,
+    score_function: Callable[[int, int], float],
+    threshold: float,
+    use_triangle_bounds: bool = False,
+    verbosity: int = 0,
+) -> Clustering:
+    '''
+    Clusters of 0..n-1 under the transitive closure of score_function(i, j) <= threshold (for j < i), with the smallest
+    index of every cluster as its canonical representative.
+
+    Pairs are visited row by row (i ascending, then j ascending, so representatives come first). A pair is skipped when
+    i and j already belong to the same cluster, or when the scores computed so far give |score(i, k) - score(j, k)| >
+    threshold for some k, i.e. when the triangle inequality says i and j are far apart.
+    The closest point RMSD is not a metric (it is not symmetric, nor bound by the triangle inequality), so the
+    triangle skip (use_triangle_bounds=True) is a heuristic which can miss merges; by default, only merged pairs are
+    skipped.
+    Non-finite scores (failed or skipped alignments) never merge and are not used in bounds.
+    Members join clusters through any of their pairs, as the first or the second index: use duplicate_links() rather
+    than the individual scores to find every duplicate.
+    '''
+    union_find = Union_Find(n)
+    known = np.full((n, n), np.nan)
+    scores = {}
+    n_skipped_merged, n_skipped_triangle = 0, 0
+
+    for i in range(n):
+        for j in range(i):
+            if union_find.find(i) == union_find.find(j):
+                n_skipped_merged += 1
+                continue
+
+            if use_triangle_bounds:
+                gaps = np.abs(known[i] - known[j])
+                if np.any(gaps[np.isfinite(gaps)] > threshold):
+                    n_skipped_triangle += 1
+                    continue
+
+            score = score_function(i, j)
+            scores[(i, j)] = score
+            if np.isfinite(score):
+                known[i, j] = known[j, i] = score
+                if score <= threshold:
+                    union_find.union(i, j)
+
+    clusters = union_find.sets()
+
+    if verbosity >= 1:
+        log.debug(
+            'Found {0} clusters with {1} alignments (skipped {2} merged pairs and {3} pairs by triangle inequality)'.format(
+                len(clusters),
+                len(scores),
+                n_skipped_merged,
+                n_skipped_triangle,
+            ),
+        )
+
+    return Clustering(
+        clusters=clusters,
+        representatives=[cluster[0] for cluster in clusters],
+        scores=scores,
+        n_skipped_merged=n_skipped_merged,
+        n_skipped_triangle=n_skipped_triangle,
+    )
+
+def duplicate_links(clustering: Clustering, threshold: float) -> Dict[int, Tuple[Tuple[int, int], float]]:
+    '''
+    Every member of clustering that is not a representative (i.e. a duplicate), with the pair (i > j) of its cluster it
+    belongs to and its lowest score within threshold, linking it to the cluster.
+    '''
+    cluster_of = {member: c for (c, cluster) in enumerate(clustering.clusters) for member in cluster}
+    links = {}
+    for ((i, j), score) in clustering.scores.items():
+        if not (np.isfinite(score) and score <= threshold and cluster_of[i] == cluster_of[j]):
+            continue
+        for member in (i, j):
+            if member != clustering.representatives[cluster_of[member]] and (member not in links or score < links[member][1]):
+                links[member] = ((i, j), score)
+    return links
@@ -0,0 +1,84 @@
+from typing import Any, Dict, List, NamedTuple, Sequence, Set, Tuple
+
+from scipy.spatial import cKDTree
+
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.flavour_index import flavour_codes_for
+
+Fingerprint = NamedTuple(
+    'Fingerprint',
+    [
+        ('topology', Tuple[Any, ...]),
+        ('vector', Array),
+    ],
+)
+
+def fingerprint_for(point_list: Sequence[Sequence[float]], flavour_list: Sequence[Any]) -> Fingerprint:
+    '''
+    Rotation and permutation invariant descriptor of a structure: its sorted flavours (the topology, which has to match
+    for an alignment to exist) and the distances of its points to their centroid, sorted within every flavour and
+    concatenated in flavour order, divided by sqrt(N).
+
+    The euclidean distance between the vectors of two structures of the same topology is the RMSD of the best
+    flavour-preserving one to one matching of their radii, hence at most their best one to one flavoured RMSD.
+    The closest point score of pointsOnPoints() is also at most that one to one RMSD, but neither bounds the other:
+    the fingerprint distance is only a heuristic proxy for the score (close for near duplicates, which are usually
+    matched one to one), and retrieving by it can miss pairs within a score threshold.
+    '''
+    point_array = array(point_list, dtype=float)
+    codes, = flavour_codes_for([flavour_list])
+    radii = np.linalg.norm(point_array - point_array.mean(axis=0), axis=1)
+
+    order = np.lexsort((radii, codes))
+    flavours = [flavour_list[i] for i in order]
+    return Fingerprint(tuple(sorted(flavours)), radii[order] / sqrt(len(radii)))
+
+class Fingerprint_Index:
+    '''
+    Fingerprints of a collection of structures, with one cKDTree per topology, answering "which structures are within
+    a fingerprint distance of this one" without aligning anything. A heuristic prefilter: candidates have to be
+    confirmed by an alignment, and structures within a score threshold may not be candidates (see
+    pdb.near_duplicate_pairs()).
+    '''
+    def __init__(self, fingerprints: Sequence[Fingerprint]):
+        self.fingerprints = list(fingerprints)
+
+        members = {}
+        for (i, fingerprint) in enumerate(self.fingerprints):
+            members.setdefault(fingerprint.topology, []).append(i)
+
+        self.members = {topology: np.array(indexes, dtype=int) for (topology, indexes) in members.items()}
+        self.trees = {
+            topology: cKDTree(np.array([self.fingerprints[i].vector for i in indexes]))
+            for (topology, indexes) in self.members.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
+
+    def query(self, fingerprint: Fingerprint, radius: float) -> List[int]:
+        '''Indexes of the structures of the same topology whose fingerprints are within radius, in increasing order.'''
+        if fingerprint.topology not in self.trees:
+            return []
+        neighbours = self.trees[fingerprint.topology].query_ball_point(fingerprint.vector, r=radius)
+        return sorted(self.members[fingerprint.topology][neighbours].tolist())
+
+    def topology_pairs(self) -> List[Tuple[int, int]]:
+        '''All pairs (i < j) of structures of the same topology (the only ones that can be aligned).'''
+        return sorted(
+            (int(indexes[a]), int(indexes[b]))
+            for indexes in self.members.values()
+            for b in range(len(indexes))
+            for a in range(b)
+        )
+
+    def pairs_within(self, radius: float) -> List[Tuple[int, int]]:
+        '''All pairs (i < j) of structures of the same topology whose fingerprints are within radius.'''
+        pairs = set()
+        for (topology, tree) in self.trees.items():
+            indexes = self.members[topology]
+            pairs.update(
+                (min(indexes[a], indexes[b]), max(indexes[a], indexes[b]))
+                for (a, b) in tree.query_pairs(r=radius)
+            )
+        return sorted((int(i), int(j)) for (i, j) in pairs)
@@ -0,0 +1,292 @@
+from copy import copy
+from threading import RLock
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from scipy.spatial import cKDTree
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.scoring import INFINITE_RMSD
+
+# Flavour groups (of the reference structure) larger than this are searched with a cKDTree, smaller ones by brute force
+MAX_BRUTE_FORCE_GROUP_SIZE = 16
+
+NO_MATCH = -1
+
+# Number of points in the first block of bounded_batch(); every following block is twice as large
+FIRST_SCORING_BLOCK_SIZE = 8
+
+# Batches of fewer structures are scored completely by bounded_batch(), since the blocks would cost more than they save
+MIN_BOUNDED_BATCH_SIZE = 64
+
+# Relative safety margin on the score bound of bounded_batch(), against rounding errors in the partial sums
+SCORING_BOUND_MARGIN = 1E-9
+
+def flavour_ranks(flavour_lists: Sequence[Sequence[Any]]) -> Dict[Any, int]:
+    '''Rank of every flavour of several structures, in sorted order.'''
+    return {flavour: rank for (rank, flavour) in enumerate(sorted(set(flavour for flavour_list in flavour_lists for flavour in flavour_list)))}
+
+def flavour_codes_for(flavour_lists: Sequence[Sequence[Any]], ranks: Optional[Dict[Any, int]] = None) -> List[Array]:
+    '''
+    Encode the flavours of several structures as integer codes shared by all structures.
+    Codes are the ranks of the flavours in sorted order (flavour_ranks() of flavour_lists, unless given), so that codes
+    compare like the flavours themselves.
+    '''
+    if ranks is None:
+        ranks = flavour_ranks(flavour_lists)
+    return [
+        np.array([ranks[flavour] for flavour in flavour_list], dtype=np.int32)
+        for flavour_list in flavour_lists
+    ]
+
+def group_indices(codes: Array) -> Dict[int, Array]:
+    '''Indices of the points sharing the same flavour code, for each flavour code.'''
+    order = np.argsort(codes, kind='stable')
+    unique_codes, starts = np.unique(codes[order], return_index=True)
+    return dict(zip(unique_codes.tolist(), np.split(order, starts[1:])))
+
+class Flavour_Partition:
+    '''
+    Partition of the points of a query structure by the flavour group they can be matched to in a reference structure.
+    Only depends on the flavour codes, so it is computed once per pair of structures.
+
+    Small reference groups are stored as brute force blocks, bucketed by group size k:
+    k -> (query_indices (n,), reference_indices (n, k)).
+    Large reference groups are stored as (query_indices, reference_indices) to be searched with a cKDTree.
+    '''
+    def __init__(self, query_codes: Array, reference_codes: Array, max_brute_force_group_size: int = MAX_BRUTE_FORCE_GROUP_SIZE):
+        self.n_query_points = len(query_codes)
+
+        query_groups, reference_groups = group_indices(query_codes), group_indices(reference_codes)
+
+        brute_force_blocks = {}
+        self.large_groups = []
+        unmatched_query_indices = []
+
+        for (code, query_indices) in query_groups.items():
+            if code not in reference_groups:
+                unmatched_query_indices.append(query_indices)
+                continue
+
+            reference_indices = reference_groups[code]
+            if len(reference_indices) > max_brute_force_group_size:
+                self.large_groups.append((query_indices, reference_indices))
+            else:
+                brute_force_blocks.setdefault(len(reference_indices), []).append((query_indices, reference_indices))
+
+        self.brute_force_blocks = {
+            k: (
+                np.concatenate([query_indices for (query_indices, _) in block]),
+                np.concatenate([np.tile(reference_indices, (len(query_indices), 1)) for (query_indices, reference_indices) in block]),
+            )
+            for (k, block) in brute_force_blocks.items()
+        }
+
+        self.unmatched_query_indices = np.concatenate(unmatched_query_indices) if unmatched_query_indices else np.array([], dtype=int)
+
+class Flavour_Index:
+    '''Nearest same-flavour point queries against a fixed reference point array.'''
+    def __init__(self, reference_array: Array, partition: Flavour_Partition, prepared_reference: Any = None):
+        self.reference_array = reference_array
+        self.partition = partition
+
+        def tree_for(reference_indices):
+            # Trees of a PreparedReference are shared by all the structures aligned on it
+            tree = prepared_reference.tree_for(reference_array, reference_indices) if prepared_reference is not None else None
+            return tree if tree is not None else cKDTree(reference_array[reference_indices])
+
+        self.trees = [
+            tree_for(reference_indices)
+            for (_, reference_indices) in partition.large_groups
+        ]
+
+    def query(self, point_array: Array) -> Tuple[Array, Array]:
+        '''
+        For every point of point_array (shape (..., N, 3), leading dimensions are batched),
+        return the distance to its closest same-flavour point of the reference array, and the index of that point.
+        '''
+        batch_shape = point_array.shape[:-2]
+        distances = np.empty(batch_shape + (self.partition.n_query_points,))
+        indices = np.empty(batch_shape + (self.partition.n_query_points,), dtype=int)
+
+        for (query_indices, reference_indices) in self.partition.brute_force_blocks.values():
+            differences = point_array[..., query_indices, np.newaxis, :] - self.reference_array[reference_indices]
+            squared_distances = np.einsum('...ij,...ij->...i', differences, differences)
+            closest = np.argmin(squared_distances, axis=-1)
+            distances[..., query_indices] = sqrt(np.take_along_axis(squared_distances, closest[..., np.newaxis], axis=-1)[..., 0])
+            indices[..., query_indices] = reference_indices[np.arange(len(query_indices)), closest]
+
+        for ((query_indices, reference_indices), tree) in zip(self.partition.large_groups, self.trees):
+            group_distances, closest = tree.query(point_array[..., query_indices, :])
+            distances[..., query_indices] = group_distances
+            indices[..., query_indices] = reference_indices[closest]
+
+        distances[..., self.partition.unmatched_query_indices] = INFINITE_RMSD
+        indices[..., self.partition.unmatched_query_indices] = NO_MATCH
+
+        return distances, indices
+
+class Flavoured_Scorer:
+    '''
+    Flavour-constrained closest point RMSD between two structures, i.e. rmsd_array() with a 0/inf flavour mask_array,
+    without building the N x N distance and mask matrices.
+    Called as a distance_array_function: scorer(array_1, array_2, transpose_mask_array=False),
+    where array_1 has the flavours of the first structure (the second one if transpose_mask_array).
+
+    flavour_codes (integer codes shared by both structures) can be given instead of computing them from flavour_lists,
+    and the spatial indexes of a PreparedReference (second structure) are reused.
+    stats (helpers.stats.Alignment_Stats) counts the structures scored (and the ones bounded_batch() gave up on).
+
+    Thread safe: the cached partitions and spatial indexes are built and read under a lock, and counting_into() gives
+    every thread a view of the scorer counting into stats of its own.
+    '''
+    def __init__(
+        self,
+        flavour_lists: Sequence[Sequence[Any]],
+        max_brute_force_group_size: int = MAX_BRUTE_FORCE_GROUP_SIZE,
+        flavour_codes: Optional[Sequence[Array]] = None,
+        prepared_reference: Any = None,
+        stats: Any = None,
+    ):
+        self.stats = stats
+        self.flavour_codes = list(flavour_codes) if flavour_codes is not None else flavour_codes_for(flavour_lists)
+        self.max_brute_force_group_size = max_brute_force_group_size
+        self.prepared_reference = prepared_reference
+        self.partitions = {}
+        self.indexes = {}
+        self.scoring_blocks = {}
+        self._lock = RLock()
+
+    def counting_into(self, stats: Any) -> 'Flavoured_Scorer':
+        '''Same scorer (sharing the cached partitions and spatial indexes), counting into stats instead.'''
+        scorer = copy(self)
+        scorer.stats = stats
+        return scorer
+
+    def partition(self, transpose: bool = False) -> Flavour_Partition:
+        with self._lock:
+            if transpose not in self.partitions:
+                query_codes, reference_codes = reversed(self.flavour_codes) if transpose else self.flavour_codes
+                self.partitions[transpose] = Flavour_Partition(
+                    query_codes,
+                    reference_codes,
+                    max_brute_force_group_size=self.max_brute_force_group_size,
+                )
+            return self.partitions[transpose]
+
+    def index_for(self, reference_array: Array, transpose: bool = False) -> Flavour_Index:
+        # Only the last reference array is cached; it is almost always the (constant) reference structure
+        with self._lock:
+            if transpose not in self.indexes or self.indexes[transpose].reference_array is not reference_array:
+                self.indexes[transpose] = Flavour_Index(
+                    reference_array,
+                    self.partition(transpose),
+                    prepared_reference=self.prepared_reference if not transpose else None,
+                )
+            return self.indexes[transpose]
+
+    def scoring_blocks_for(self, point_array: Array, reference_array: Array, transpose: bool = False) -> List[Tuple[Array, Flavour_Index]]:
+        '''
+        Blocks of query points, as (point indexes, Flavour_Index of these points only), ordered by decreasing distance
+        to the centroid of point_array (the points moving the most under a change of rotation come first), with sizes
+        FIRST_SCORING_BLOCK_SIZE, twice that, and so on.
+        The order only affects how early bounded_batch() gives up, so it is computed from the first structure scored.
+        '''
+        with self._lock:
+            if transpose not in self.scoring_blocks or self.scoring_blocks[transpose][0] is not reference_array:
+                query_codes, reference_codes = reversed(self.flavour_codes) if transpose else self.flavour_codes
+                order = np.argsort(-np.linalg.norm(point_array - point_array.mean(axis=0), axis=1), kind='stable')
+
+                blocks, start, block_size = [], 0, FIRST_SCORING_BLOCK_SIZE
+                while start < len(order):
+                    point_indexes = order[start:start + block_size]
+                    blocks.append((
+                        point_indexes,
+                        Flavour_Index(
+                            reference_array,
+                            Flavour_Partition(query_codes[point_indexes], reference_codes, max_brute_force_group_size=self.max_brute_force_group_size),
+                            prepared_reference=self.prepared_reference if not transpose else None,
+                        ),
+                    ))
+                    start, block_size = start + block_size, 2 * block_size
+
+                self.scoring_blocks[transpose] = (reference_array, blocks)
+            return self.scoring_blocks[transpose][1]
+
+    def nearest(self, point_array: Array, reference_array: Array, transpose: bool = False) -> Tuple[Array, Array]:
+        if self.stats is not None:
+            self.stats.n_score_evaluations += len(point_array) if point_array.ndim == 3 else 1
+        return self.index_for(reference_array, transpose).query(point_array)
+
+    def __call__(self, point_array1: Array, point_array2: Array, transpose_mask_array: bool = False, verbosity: int = 0) -> float:
+        assert point_array1.shape == point_array2.shape, "Error: Won't compute RMSD on arrays with different sizes: {0} and {1}".format(*[x.shape for x in [point_array1, point_array2]])
+
+        distances, _ = self.nearest(point_array1, point_array2, transpose=transpose_mask_array)
+
+        rmsd = sqrt( mean( square( distances ) ) )
+
+        assert rmsd != INFINITE_RMSD
+
+        if verbosity >= 4:
+            log.debug("New RMSD: {0}".format(rmsd))
+
+        return rmsd
+
+    def batch(self, point_arrays: Array, reference_array: Array, transpose_mask_array: bool = False) -> Array:
+        '''Scores of a (K, N, 3) stack of point arrays against the same reference array.'''
+        distances, _ = self.nearest(point_arrays, reference_array, transpose=transpose_mask_array)
+
+        return sqrt( mean( square( distances ), axis=-1 ) )
+
+    def bounded_batch(
+        self,
+        point_arrays: Array,
+        reference_array: Array,
+        bound: Optional[float] = None,
+        tolerance: float = 0.,
+        transpose_mask_array: bool = False,
+    ) -> Array:
+        '''
+        Same as batch(), except that the scores above max(tolerance, min(bound, lowest score of the batch)) are
+        INFINITE_RMSD (i.e. "cannot be the best one").
+        Squared distances are accumulated by blocks of points (see scoring_blocks_for()), and a structure is dropped as
+        soon as its partial sum exceeds N times the squared bound. After the first block, the structure with the lowest
+        partial sum is scored completely to tighten the bound. The scores of the other structures are exactly the ones
+        of batch().
+        '''
+        if len(point_arrays) < MIN_BOUNDED_BATCH_SIZE:
+            return self.batch(point_arrays, reference_array, transpose_mask_array=transpose_mask_array)
+
+        blocks = self.scoring_blocks_for(point_arrays[0], reference_array, transpose=transpose_mask_array)
+        if len(blocks) == 1:
+            return self.batch(point_arrays, reference_array, transpose_mask_array=transpose_mask_array)
+
+        K, N = point_arrays.shape[:2]
+        if self.stats is not None:
+            self.stats.n_score_evaluations += K
+
+        bound = INFINITE_RMSD if bound is None else bound
+        distances, squared_sums, alive = np.empty((K, N)), np.zeros(K), np.arange(K)
+
+        for (block_number, (point_indexes, index)) in enumerate(blocks):
+            block_distances, _ = index.query(point_arrays[alive[:, np.newaxis], point_indexes])
+            distances[alive[:, np.newaxis], point_indexes] = block_distances
+            squared_sums[alive] += np.sum(square(block_distances), axis=-1)
+
+            if block_number == 0:
+                best_guess = alive[np.argmin(squared_sums[alive])]
+                bound = min(
+                    bound,
+                    sqrt(
+                        (squared_sums[best_guess] + sum(np.sum(square(index.query(point_arrays[best_guess, point_indexes])[0])) for (point_indexes, index) in blocks[1:])) / N,
+                    ),
+                )
+
+            alive = alive[squared_sums[alive] <= N * square(max(bound, tolerance)) * (1. + SCORING_BOUND_MARGIN) + SCORING_BOUND_MARGIN]
+
+        if self.stats is not None:
+            self.stats.n_aborted_score_evaluations += K - len(alive)
+
+        scores = np.full(K, INFINITE_RMSD)
+        scores[alive] = sqrt( mean( square( distances[alive] ), axis=-1 ) )
+        return scores
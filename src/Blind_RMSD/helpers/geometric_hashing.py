@@ -0,0 +1,177 @@
+from itertools import product
+from typing import Any, NamedTuple, Optional, Tuple
+
+from scipy.spatial import cKDTree
+from scipy.spatial.transform import Rotation
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.kabsch import kabsch_from_covariances
+from Blind_RMSD.helpers.ransac import refitted_on_inliers, DEFAULT_RANSAC_INLIER_THRESHOLD
+
+# Every point forms triplets with the pairs of its DEFAULT_HASHING_NEIGHBOURS nearest neighbours
+DEFAULT_HASHING_NEIGHBOURS = 4
+# Width (in Angstrom) of the bins of the triplet side lengths in the hash keys
+DEFAULT_HASHING_BIN_WIDTH = 0.25
+# Width of the bins of the (unit quaternion) components of the rotations voted for (about 0.1 radian)
+DEFAULT_ROTATION_BIN_WIDTH = 0.05
+# Number of the most voted rotations that are scored
+DEFAULT_HASHING_CANDIDATES = 16
+# At most this many (randomly chosen, seeded) triplet matches vote
+DEFAULT_HASHING_MAX_VOTES = 50000
+DEFAULT_HASHING_SEED = 0
+
+Hashing_Result = NamedTuple(
+    'Hashing_Result',
+    [
+        ('aligned_array', Array),
+        ('score', float),
+        ('matrices', Tuple[Array, Array, Array]),
+        ('n_votes', int),
+        ('n_winning_votes', int),
+    ],
+)
+
+def local_triplets(point_array: Array, n_neighbours: int = DEFAULT_HASHING_NEIGHBOURS) -> Array:
+    '''(T, 3) array of the distinct triplets made of every point and two of its n_neighbours nearest neighbours.'''
+    n_neighbours = min(n_neighbours, len(point_array) - 1)
+    if n_neighbours < 2:
+        return np.zeros((0, 3), dtype=int)
+
+    _, neighbours = cKDTree(point_array).query(point_array, k=n_neighbours + 1)
+    neighbours = neighbours[:, 1:]
+
+    a, b = np.triu_indices(n_neighbours, k=1)
+    triplets = np.sort(np.stack([np.repeat(np.arange(len(point_array)), len(a)), neighbours[:, a].ravel(), neighbours[:, b].ravel()], axis=1), axis=1)
+    return np.unique(triplets, axis=0)
+
+def canonical_triplets(point_array: Array, codes: Array, triplets: Array) -> Tuple[Array, Array]:
+    '''
+    Triplets with their vertices in canonical order (by flavour code, then by decreasing length of the opposite side),
+    and the lengths of the sides opposite to each vertex, as ((T, 3) indexes, (T, 3) lengths).
+    Equally flavoured vertices with (almost) equal opposite sides may come in either order: such triplets are only
+    found by some of their matches.
+    '''
+    vertices = point_array[triplets]
+    opposite_lengths = np.linalg.norm(vertices[:, [1, 2, 0]] - vertices[:, [2, 0, 1]], axis=-1)
+
+    order = np.lexsort((-opposite_lengths, codes[triplets]), axis=-1)
+    return np.take_along_axis(triplets, order, axis=1), np.take_along_axis(opposite_lengths, order, axis=1)
+
+class Triplet_Hash_Table:
+    '''
+    Local triplets of a (reference) structure, hashed by the flavours of their canonically ordered vertices and the
+    quantized lengths of the opposite sides. Every triplet is stored under all the keys of the bins its lengths could
+    fall in with an error of bin_width / 2, so that a query only looks up the key of its rounded lengths.
+    '''
+    def __init__(
+        self,
+        point_array: Array,
+        codes: Array,
+        n_neighbours: int = DEFAULT_HASHING_NEIGHBOURS,
+        bin_width: float = DEFAULT_HASHING_BIN_WIDTH,
+    ):
+        self.bin_width = bin_width
+        self.triplets, lengths = canonical_triplets(point_array, codes, local_triplets(point_array, n_neighbours))
+
+        self.table = {}
+        for (t, (triplet, triplet_lengths)) in enumerate(zip(self.triplets, lengths)):
+            triplet_codes = tuple(codes[triplet].tolist())
+            bins = [
+                sorted(set([int(np.round((length - bin_width / 2.) / bin_width)), int(np.round((length + bin_width / 2.) / bin_width))]))
+                for length in triplet_lengths
+            ]
+            for length_bins in product(*bins):
+                self.table.setdefault(triplet_codes + length_bins, []).append(t)
+
+    def __len__(self) -> int:
+        return len(self.triplets)
+
+    def key_for(self, triplet_codes: Array, lengths: Array) -> Tuple[int, ...]:
+        return tuple(triplet_codes.tolist()) + tuple(np.round(lengths / self.bin_width).astype(int).tolist())
+
+    def matches(self, codes: Array, triplets: Array, lengths: Array) -> Tuple[Array, Array]:
+        '''(query triplet numbers, reference triplet numbers) of all the matches of canonical query triplets.'''
+        query_numbers, reference_numbers = [], []
+        for (t, (triplet, triplet_lengths)) in enumerate(zip(triplets, lengths)):
+            matches = self.table.get(self.key_for(codes[triplet], triplet_lengths), ())
+            query_numbers.extend([t] * len(matches))
+            reference_numbers.extend(matches)
+        return np.array(query_numbers, dtype=int), np.array(reference_numbers, dtype=int)
+
+def voted_rotations(U: Array, n_candidates: int, bin_width: float = DEFAULT_ROTATION_BIN_WIDTH) -> Tuple[Array, Array]:
+    '''
+    The n_candidates rotations with the most votes amongst the (V, 3, 3) stack U (same convention as kabsch()), binned
+    by their unit quaternion (with a non-negative real part), as (mean rotation of each bin, number of votes).
+    '''
+    quaternions = Rotation.from_matrix(np.swapaxes(U, -1, -2)).as_quat()
+    quaternions[quaternions[:, 3] < 0.] *= -1.
+
+    bins, inverse, counts = np.unique(np.round(quaternions / bin_width).astype(int), axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    winners = np.argsort(-counts, kind='stable')[:n_candidates]
+
+    sums = np.zeros((len(bins), 4))
+    np.add.at(sums, inverse, quaternions)
+    rotations = Rotation.from_quat(sums[winners] / np.linalg.norm(sums[winners], axis=1)[:, np.newaxis]).as_matrix()
+
+    return np.swapaxes(rotations, -1, -2), counts[winners]
+
+def hashing_alignment(
+    point_array: Array,
+    reference_array: Array,
+    flavour_scorer: Any,
+    hash_table: Optional[Triplet_Hash_Table] = None,
+    n_neighbours: int = DEFAULT_HASHING_NEIGHBOURS,
+    n_candidates: int = DEFAULT_HASHING_CANDIDATES,
+    max_votes: int = DEFAULT_HASHING_MAX_VOTES,
+    inlier_threshold: float = DEFAULT_RANSAC_INLIER_THRESHOLD,
+    seed: int = DEFAULT_HASHING_SEED,
+    verbosity: int = 0,
+    stats: Any = None,
+) -> Optional[Hashing_Result]:
+    '''
+    Alignment of point_array on reference_array by geometric hashing: every local triplet of point_array is looked up in
+    the Triplet_Hash_Table of reference_array (built if not given, with the centered reference_array), every match
+    proposes the rotation about the centroids mapping one triplet onto the other, and the n_candidates most voted
+    rotations (see voted_rotations()) are scored. The best one is refitted on its inliers (see
+    helpers.ransac.refitted_on_inliers()).
+    Proportional to the number of triplets (O(N * n_neighbours^2)), independently of the number of equivalent points.
+    Returns None if no triplet matched.
+    '''
+    Pc, Qc = point_array.mean(axis=0), reference_array.mean(axis=0)
+    P, Q = point_array - Pc, reference_array - Qc
+    codes, reference_codes = flavour_scorer.flavour_codes
+
+    if hash_table is None:
+        hash_table = Triplet_Hash_Table(Q, reference_codes, n_neighbours=n_neighbours)
+
+    triplets, lengths = canonical_triplets(P, codes, local_triplets(P, n_neighbours))
+    query_numbers, reference_numbers = hash_table.matches(codes, triplets, lengths)
+    if len(query_numbers) > max_votes:
+        kept = np.sort(np.random.default_rng(seed).choice(len(query_numbers), size=max_votes, replace=False))
+        query_numbers, reference_numbers = query_numbers[kept], reference_numbers[kept]
+
+    if len(query_numbers) == 0:
+        return None
+
+    # No centering: the centroids are matched, and the triplets are relative to them
+    U, degenerate = kabsch_from_covariances(np.matmul(np.swapaxes(P[triplets[query_numbers]], -1, -2), Q[hash_table.triplets[reference_numbers]]))
+    if stats is not None:
+        stats.n_svd_calls += len(U)
+    U = U[~degenerate]
+    if len(U) == 0:
+        return None
+
+    rotations, votes = voted_rotations(U, n_candidates)
+
+    distances, _ = flavour_scorer.nearest(np.matmul(P, rotations) + Qc, reference_array)
+    scores = sqrt(mean(square(distances), axis=-1))
+    i = int(np.argmin(scores))
+
+    if verbosity >= 3:
+        log.debug('Geometric hashing: {0} votes, scores of the {1} most voted rotations: {2}'.format(len(U), len(rotations), list(zip(votes.tolist(), scores.tolist()))))
+
+    best_U, aligned_array, score = refitted_on_inliers(P, Q, reference_array, rotations[i], float(scores[i]), flavour_scorer, inlier_threshold, stats=stats)
+
+    return Hashing_Result(aligned_array, score, (best_U, Pc, Qc), len(U), int(votes[i]))
@@ -0,0 +1,74 @@
+from typing import Any, NamedTuple, Optional, Tuple
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.kabsch import kabsch_batch
+
+# Stop refining when an iteration improves the score by less than this (in Angstrom)
+DEFAULT_ICP_CONVERGENCE = 1E-6
+DEFAULT_ICP_MAX_ITERATIONS = 50
+
+ICP_Result = NamedTuple(
+    'ICP_Result',
+    [
+        ('aligned_array', Array),
+        ('score', float),
+        ('matrices', Tuple[Array, Array, Array]),
+        ('n_iterations', int),
+    ],
+)
+
+def icp_refinement(
+    point_array: Array,
+    reference_array: Array,
+    initial_array: Array,
+    flavour_scorer: Any,
+    max_iterations: int = DEFAULT_ICP_MAX_ITERATIONS,
+    convergence: float = DEFAULT_ICP_CONVERGENCE,
+    verbosity: int = 0,
+    stats: Any = None,
+) -> Optional[ICP_Result]:
+    '''
+    Iterative closest point refinement of an alignment of point_array on reference_array, starting from initial_array
+    (a rigid motion of point_array).
+    Every iteration matches each point to its closest same-flavour reference point (flavour_scorer.nearest(), see
+    helpers.flavour_index), then fits the whole of point_array on its matches with a single Kabsch rotation.
+
+    The centroid of point_array is always mapped onto the centroid of reference_array (like the final alignment of
+    pointsOnPoints()), and the rotation minimises the squared distances to the current matches, so the closest point
+    RMSD never increases from one iteration to the next.
+    Returns None if no iteration improved on initial_array.
+    '''
+    Pc, Qc = point_array.mean(axis=0), reference_array.mean(axis=0)
+    P = point_array - Pc
+
+    current_array = initial_array - initial_array.mean(axis=0) + Qc
+    distances, indices = flavour_scorer.nearest(current_array, reference_array)
+    current_score = sqrt(mean(square(distances)))
+
+    result = None
+    for iteration in range(1, max_iterations + 1):
+        U, degenerate = kabsch_batch(P[np.newaxis], reference_array[indices] - Qc)
+        if stats is not None:
+            stats.n_svd_calls += 1
+        if degenerate[0]:
+            break
+
+        new_array = np.dot(P, U[0]) + Qc
+        distances, indices = flavour_scorer.nearest(new_array, reference_array)
+        new_score = sqrt(mean(square(distances)))
+
+        if verbosity >= 5:
+            log.debug('ICP iteration {0}: score {1} -> {2}'.format(iteration, current_score, new_score))
+
+        if not new_score < current_score:
+            break
+
+        result = ICP_Result(new_array, new_score, (U[0], Pc, Qc), iteration)
+
+        if current_score - new_score <= convergence:
+            break
+
+        current_score = new_score
+
+    return result
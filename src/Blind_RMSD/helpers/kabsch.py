@@ -70,3 +70,38 @@ def centroid(X):
     Calculate the centroid from a vectorset X
     """
     return X.mean(axis=0)
+
+def kabsch_batch(P, Q):
+    """
+    Batched version of kabsch().
+
+    Parameters:
+    P -- (K, N, D) stack of centered matrices
+    Q -- (K, N, D) stack of centered matrices, or a single (N, D) matrix shared by all K
+
+    Returns:
+    U -- (K, D, D) stack of rotation matrices
+    degenerate -- (K,) boolean array, True where kabsch() would have raised a Kabsch_Error
+    """
+    return kabsch_from_covariances(np.matmul(np.swapaxes(P, -1, -2), Q))
+
+def kabsch_from_covariances(C):
+    """
+    Same as kabsch_batch(), from the (K, D, D) stack of covariance matrices of the centered point sets.
+    """
+    return kabsch_from_svd(*np.linalg.svd(C))
+
+def kabsch_from_svd(V, S, W):
+    """
+    Same as kabsch_batch(), from the (batched) singular value decomposition V, S, W of the covariance matrices, for
+    callers that also need the singular values (V is modified in place).
+    """
+    # Vectorized is_close(x, 0.0)
+    degenerate = np.any(np.abs(S) <= 1E-8 + 1E-5 * np.abs(S), axis=-1)
+
+    d = (np.linalg.det(V) * np.linalg.det(W)) < 0.0
+    V[d, :, -1] = -V[d, :, -1]
+
+    U = np.matmul(V, W)
+
+    return U, degenerate
@@ -96,6 +96,19 @@ def connect_lines(data):
 def pdb_str(data, united=False):
     return '\n'.join(pdb_lines(data, united))
 
+def bond_list(data, united=False):
+    '''Bonds between the kept atoms, as pairs of indexes in point_list().'''
+    point_indexes = {
+        index: point_index
+        for (point_index, index) in enumerate(index for (index, atom) in list(data['atoms'].items()) if should_keep_atom(atom, united))
+    }
+    return [
+        (point_indexes[index], point_indexes[other_index])
+        for (index, atom) in list(data['atoms'].items())
+        for other_index in atom['conn']
+        if index in point_indexes and other_index in point_indexes and index < other_index
+    ]
+
 def nm_to_A(x):
     return 10*x
 
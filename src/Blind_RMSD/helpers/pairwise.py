@@ -0,0 +1,109 @@
+from multiprocessing import get_context, get_all_start_methods
+from multiprocessing.sharedctypes import RawArray
+from os import cpu_count
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+
+# Number of consecutive condensed matrix entries handed to a worker at once
+DEFAULT_PAIRWISE_CHUNK_SIZE = 64
+
+Pair_Function = Callable[[int, int], float]
+
+# State inherited by the forked workers of parallel_condensed_matrix() (nothing is pickled but the chunk bounds)
+_PAIR_FUNCTION, _RESULTS = None, None
+
+def condensed_size(n: int) -> int:
+    return n * (n - 1) // 2
+
+def condensed_pairs(n: int, start: int, stop: int) -> Tuple[Array, Array]:
+    '''
+    Row and column indexes (i < j) of the entries start:stop of the condensed form (see scipy's squareform()) of an
+    n x n distance matrix, where row i starts at k_i = i (2n - i - 1) / 2.
+    '''
+    k = np.arange(start, stop)
+    b = 2 * n - 1
+    i = np.floor((b - sqrt(b * b - 8. * k)) / 2.).astype(int)
+    # Guard against rounding at the row boundaries
+    row_starts = lambda i: i * (2 * n - i - 1) // 2
+    i = np.where(row_starts(i) > k, i - 1, i)
+    i = np.where(row_starts(i + 1) <= k, i + 1, i)
+    j = k - row_starts(i) + i + 1
+    return i, j
+
+def chunk_bounds(size: int, chunk_size: int) -> Iterator[Tuple[int, int]]:
+    return ((start, min(start + chunk_size, size)) for start in range(0, size, chunk_size))
+
+def resolved_n_jobs(n_jobs: Optional[int]) -> int:
+    '''Number of worker processes for n_jobs (None: 1, negative: all CPUs but -n_jobs - 1).'''
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
+
+def _fill_chunk(n: int, start: int, stop: int) -> int:
+    for (k, i, j) in zip(range(start, stop), *condensed_pairs(n, start, stop)):
+        _RESULTS[k] = _PAIR_FUNCTION(int(i), int(j))
+    return stop - start
+
+def parallel_condensed_matrix(
+    n: int,
+    pair_function: Pair_Function,
+    n_jobs: Optional[int] = 1,
+    chunk_size: int = DEFAULT_PAIRWISE_CHUNK_SIZE,
+    verbosity: int = 0,
+) -> Array:
+    '''
+    Condensed matrix (see scipy's squareform()) of pair_function(i, j) for all 0 <= i < j < n.
+
+    With n_jobs > 1, chunks of consecutive entries are spread over a pool of forked processes. pair_function (and
+    whatever it refers to, e.g. preprocessed molecules) is inherited by the workers rather than pickled, and every
+    worker writes its values straight into a shared preallocated array.
+    Falls back to a serial loop where fork is unavailable.
+    '''
+    global _PAIR_FUNCTION, _RESULTS
+
+    size = condensed_size(n)
+    n_jobs = resolved_n_jobs(n_jobs)
+
+    if n_jobs > 1 and 'fork' not in get_all_start_methods():
+        if verbosity >= 1:
+            log.debug('fork start method unavailable: computing the {0} pairs serially'.format(size))
+        n_jobs = 1
+
+    if n_jobs == 1 or size <= chunk_size:
+        results = np.empty(size)
+        for (k, i, j) in zip(range(size), *condensed_pairs(n, 0, size)):
+            results[k] = pair_function(int(i), int(j))
+        return results
+
+    shared_results = RawArray('d', size)
+    _PAIR_FUNCTION, _RESULTS = pair_function, shared_results
+    try:
+        with get_context('fork').Pool(processes=n_jobs) as pool:
+            done = 0
+            for n_done in pool.starmap(_fill_chunk, ((n, start, stop) for (start, stop) in chunk_bounds(size, chunk_size)), chunksize=1):
+                done += n_done
+            assert done == size, (done, size)
+    finally:
+        _PAIR_FUNCTION, _RESULTS = None, None
+
+    if verbosity >= 1:
+        log.debug('Computed {0} pairs with {1} processes'.format(size, n_jobs))
+
+    return np.frombuffer(shared_results, dtype=np.float64).copy()
+
+def ordered_imap(function: Callable[[Any], Any], iterable: Iterable[Any], n_jobs: Optional[int] = 1, chunk_size: int = 1) -> Iterator[Any]:
+    '''
+    map(function, iterable) over a pool of n_jobs forked processes, yielding results in order as they become available.
+    The pool is forked on the first next(), so module state set before then is inherited by the workers.
+    Serial where fork is unavailable.
+    '''
+    n_jobs = resolved_n_jobs(n_jobs)
+    if n_jobs == 1 or 'fork' not in get_all_start_methods():
+        yield from map(function, iterable)
+    else:
+        with get_context('fork').Pool(processes=n_jobs) as pool:
+            yield from pool.imap(function, iterable, chunksize=chunk_size)
@@ -0,0 +1,216 @@
+from functools import lru_cache
+from hashlib import sha256
+from importlib import import_module
+from inspect import getsourcefile
+from json import dumps, loads
+from os import environ, listdir, makedirs, remove, replace, stat, utime, getpid
+from os.path import join, expanduser, exists
+from typing import Any, Dict, List, Optional, Sequence
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.moldata import FLAVOUR_LIST_SHELL_NUMBER
+
+# Bump whenever the content of PDB_Data changes (flavour_list(), symmetry_permutations(), ...): entries written with
+# another version are treated as misses and deleted
+PDB_DATA_CACHE_VERSION = 2
+
+# Anything else the cached results depend on, hashed into the keys alongside PDB_DATA_CACHE_VERSION (the version of
+# chemical_equivalence, which produces the molecular data and hence the flavours, is added by pdb_data_key())
+PDB_DATA_CACHE_ALGORITHM_STAMP = 'v{0}|shells={1}'.format(PDB_DATA_CACHE_VERSION, FLAVOUR_LIST_SHELL_NUMBER)
+
+DEFAULT_PDB_DATA_CACHE_DIR = environ.get('BLIND_RMSD_CACHE_DIR', join(expanduser('~'), '.cache', 'Blind_RMSD', 'pdb_data'))
+DEFAULT_PDB_DATA_CACHE_MAX_SIZE = 512 * 1024 * 1024 # bytes
+
+CACHE_FILE_EXTENSION = '.npz'
+
+# Fields of PDB_Data stored as float64 arrays rather than in the JSON metadata
+ARRAY_FIELDS = ('point_lists', 'extra_points_lists')
+
+# Keys of the JSON objects standing for the values JSON cannot represent as such
+TUPLE_TAG, DICT_TAG = '__tuple__', '__dict__'
+
+@lru_cache(maxsize=None)
+def chemical_equivalence_stamp() -> str:
+    '''
+    sha256 of the source of chemical_equivalence.calcChemEquivalency, which produces the molecular data (and hence the
+    flavours) of pdb_data_for(), so that cache entries computed with another version are never read.
+    If it cannot be found, its changes are not tracked: bump PDB_DATA_CACHE_VERSION manually when updating it.
+    '''
+    try:
+        with open(getsourcefile(import_module('chemical_equivalence.calcChemEquivalency')), 'rb') as fh:
+            return sha256(fh.read()).hexdigest()
+    except (ImportError, OSError, TypeError):
+        return 'unknown'
+
+def pdb_data_key(
+    pdb_str: str,
+    united_atom_fit: bool,
+    enforce_single_molecule: bool,
+    exception_searching_keywords: Sequence[str],
+) -> str:
+    '''Content address of the result of pdb_data_for() (sha256 of its inputs and of the algorithm stamps).'''
+    hasher = sha256()
+    for part in (
+        PDB_DATA_CACHE_ALGORITHM_STAMP,
+        'chemical_equivalence={0}'.format(chemical_equivalence_stamp()),
+        'united={0}'.format(bool(united_atom_fit)),
+        'single={0}'.format(bool(enforce_single_molecule)),
+        'keywords={0}'.format('\x1f'.join(map(str, exception_searching_keywords))),
+    ):
+        hasher.update(part.encode())
+        hasher.update(b'\x00')
+    hasher.update(pdb_str.encode())
+    return hasher.hexdigest()
+
+def encoded(value: Any) -> Any:
+    '''
+    JSON representation of value that decoded() turns back into value: tuples (e.g. flavours) and dictionaries with
+    keys that are not strings (e.g. atom ids) are tagged. Raises TypeError for anything else JSON cannot represent.
+    '''
+    if isinstance(value, tuple):
+        return {TUPLE_TAG: [encoded(item) for item in value]}
+    if isinstance(value, list):
+        return [encoded(item) for item in value]
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value) and TUPLE_TAG not in value and DICT_TAG not in value:
+            return {key: encoded(item) for (key, item) in value.items()}
+        return {DICT_TAG: [[encoded(key), encoded(item)] for (key, item) in value.items()]}
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError('Cannot cache values of type {0}'.format(type(value).__name__))
+
+def decoded(value: Any) -> Any:
+    if isinstance(value, list):
+        return [decoded(item) for item in value]
+    if isinstance(value, dict):
+        if TUPLE_TAG in value:
+            return tuple(decoded(item) for item in value[TUPLE_TAG])
+        if DICT_TAG in value:
+            return {decoded(key): decoded(item) for (key, item) in value[DICT_TAG]}
+        return {key: decoded(item) for (key, item) in value.items()}
+    return value
+
+class PDB_Data_Cache:
+    '''
+    On-disk cache of pdb_data_for() results, one file per entry named after pdb_data_key().
+    Entries are compressed .npz files of plain arrays (coordinates as float64, the other fields as UTF-8 JSON, see
+    encoded()), loaded without pickle support: a cache directory shared with others cannot run code, and any entry that
+    does not decode (corrupted, or written by another version) is a miss.
+    The total size of the entries is bounded by max_size: least recently used entries (by modification time, bumped on
+    every hit) are evicted first.
+    Writes go through a temporary file and an atomic rename, so concurrent processes can share a cache directory.
+    '''
+    def __init__(self, directory: str = DEFAULT_PDB_DATA_CACHE_DIR, max_size: int = DEFAULT_PDB_DATA_CACHE_MAX_SIZE, verbosity: int = 0):
+        self.directory = directory
+        self.max_size = max_size
+        self.verbosity = verbosity
+        self._size = None
+
+    def path_for(self, key: str) -> str:
+        return join(self.directory, key + CACHE_FILE_EXTENSION)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        '''Cached fields of PDB_Data for key (without pdb_str), or None.'''
+        path = self.path_for(key)
+        if not exists(path):
+            return None
+
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                version = int(entry['version'])
+                if version != PDB_DATA_CACHE_VERSION:
+                    raise ValueError('Stale cache entry (version {0})'.format(version))
+                fields = decoded(loads(entry['metadata'].tobytes().decode('utf-8')))
+                for field in ARRAY_FIELDS:
+                    fields[field] = entry[field].tolist()
+        except Exception as e:
+            if self.verbosity >= 1:
+                log.debug('Discarding cache entry {0}: {1!r}'.format(path, e))
+            self._remove(path)
+            return None
+
+        try:
+            utime(path)
+        except OSError:
+            pass
+
+        if self.verbosity >= 3:
+            log.debug('Cache hit: {0}'.format(path))
+
+        return fields
+
+    def put(self, key: str, fields: Dict[str, Any]) -> None:
+        '''Store fields (of PDB_Data, without pdb_str) for key, unless they hold values JSON cannot represent.'''
+        try:
+            metadata = dumps(encoded({field: value for (field, value) in fields.items() if field not in ARRAY_FIELDS}))
+        except TypeError as e:
+            if self.verbosity >= 1:
+                log.debug('Not caching {0}: {1}'.format(key, e))
+            return
+
+        makedirs(self.directory, exist_ok=True)
+        path = self.path_for(key)
+        temporary_path = '{0}.{1}.tmp'.format(path, getpid())
+        with open(temporary_path, 'wb') as fh:
+            np.savez_compressed(
+                fh,
+                version=np.array(PDB_DATA_CACHE_VERSION),
+                metadata=np.frombuffer(metadata.encode('utf-8'), dtype=np.uint8),
+                **{field: np.array(fields[field], dtype=np.float64).reshape(-1, 3) for field in ARRAY_FIELDS},
+            )
+        replace(temporary_path, path)
+
+        if self._size is None:
+            self._size = self.total_size()
+        else:
+            self._size += stat(path).st_size
+
+        if self._size > self.max_size:
+            self.evict()
+
+    def entries(self) -> List[Any]:
+        '''(modification time, size, path) of every entry, least recently used first.'''
+        if not exists(self.directory):
+            return []
+
+        entries = []
+        for file_name in listdir(self.directory):
+            if not file_name.endswith(CACHE_FILE_EXTENSION):
+                continue
+            path = join(self.directory, file_name)
+            try:
+                file_stat = stat(path)
+            except OSError:
+                continue
+            entries.append((file_stat.st_mtime, file_stat.st_size, path))
+        return sorted(entries)
+
+    def total_size(self) -> int:
+        return sum(size for (_, size, _) in self.entries())
+
+    def evict(self) -> None:
+        '''Remove least recently used entries until the cache fits in max_size.'''
+        entries = self.entries()
+        size = sum(size for (_, size, _) in entries)
+        for (_, entry_size, path) in entries:
+            if size <= self.max_size:
+                break
+            if self.verbosity >= 3:
+                log.debug('Evicting cache entry: {0}'.format(path))
+            self._remove(path)
+            size -= entry_size
+        self._size = size
+
+    def clear(self) -> None:
+        for (_, _, path) in self.entries():
+            self._remove(path)
+        self._size = 0
+
+    def _remove(self, path: str) -> None:
+        try:
+            remove(path)
+        except OSError:
+            pass
@@ -1,9 +1,16 @@
-from itertools import product
-
 def N_amongst_array(point_array, N=3):
-    def all_different(the_list):
-        for a in the_list:
-            if the_list.count(a) > 1 : return False
-        return True
+    '''
+    Lazily yields the tuples of N distinct indexes (i_0, ..., i_{N-1}) with i_k < len(point_array) - k, in
+    lexicographic order, without building (and filtering) their whole cartesian product.
+    '''
     N_points = point_array.shape[0]
-    return [perm for perm in product(*[list(range(x)) for x in range(N_points, N_points - N, -1)]) if all_different(perm)] # Selecting three points at random amongst N
+
+    def selections(prefix):
+        if len(prefix) == N:
+            yield tuple(prefix)
+            return
+        for i in range(N_points - len(prefix)):
+            if i not in prefix:
+                yield from selections(prefix + [i])
+
+    return selections([])
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence
+
+# Run every method, then keep the best result (reproducible, and what pointsOnPoints() has always done)
+PORTFOLIO_RUN_ALL = 'run_all'
+# Stop as soon as a method scores within the score tolerance
+PORTFOLIO_EARLY_EXIT = 'early_exit'
+PORTFOLIO_POLICIES = (PORTFOLIO_RUN_ALL, PORTFOLIO_EARLY_EXIT)
+DEFAULT_PORTFOLIO_POLICY = PORTFOLIO_RUN_ALL
+
+STOP_ALL_METHODS_RUN, STOP_SCORE_TOLERANCE = 'all_methods_run', 'score_tolerance'
+
+Scheduled_Method = NamedTuple(
+    'Scheduled_Method',
+    [
+        ('name', str),
+        ('run', Callable[[], Any]),
+    ],
+)
+
+Portfolio_Result = NamedTuple(
+    'Portfolio_Result',
+    [
+        ('stop_reason', str),
+        # Name of the method whose result stopped the portfolio (None if all methods were run)
+        ('stopping_method', Optional[str]),
+        # Names of the methods that were not run (or whose results were discarded)
+        ('skipped_methods', List[str]),
+    ],
+)
+
+def run_portfolio(
+    methods: Sequence[Scheduled_Method],
+    score_of: Callable[[Any], float],
+    on_result: Callable[[Any], None],
+    score_tolerance: float,
+    policy: str = DEFAULT_PORTFOLIO_POLICY,
+    n_threads: int = 1,
+) -> Portfolio_Result:
+    '''
+    Run methods (cheapest first) and pass each of their results to on_result(), always from the calling thread.
+    With policy PORTFOLIO_EARLY_EXIT, stop as soon as score_of() a result is within score_tolerance.
+
+    With n_threads > 1, the methods (which must not depend on each other) are run concurrently, in the order of methods,
+    which pays off when they spend their time in NumPy (e.g. SVDs), which releases the GIL. Results are still passed
+    on in the order of methods with PORTFOLIO_RUN_ALL, but in order of completion with PORTFOLIO_EARLY_EXIT: the first
+    result within tolerance wins, and the methods still running are abandoned: the ones not started yet are cancelled,
+    but the ones already started cannot be interrupted, and keep running (and using CPU) in the background after
+    run_portfolio() returns, until they complete. Their results are discarded, so methods must only write to state of
+    their own (e.g. return their counters along with their result rather than update shared ones).
+    '''
+    early_exit = policy == PORTFOLIO_EARLY_EXIT
+
+    def is_within_tolerance(result: Any) -> bool:
+        return early_exit and score_of(result) <= score_tolerance
+
+    if n_threads <= 1 or len(methods) <= 1:
+        for (i, method) in enumerate(methods):
+            result = method.run()
+            on_result(result)
+            if is_within_tolerance(result):
+                return Portfolio_Result(STOP_SCORE_TOLERANCE, method.name, [skipped.name for skipped in methods[i + 1:]])
+        return Portfolio_Result(STOP_ALL_METHODS_RUN, None, [])
+
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    try:
+        futures = [executor.submit(method.run) for method in methods]
+
+        if not early_exit:
+            for future in futures:
+                on_result(future.result())
+            return Portfolio_Result(STOP_ALL_METHODS_RUN, None, [])
+
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            stopping = None
+            for i in sorted(futures.index(future) for future in done):
+                result = futures[i].result()
+                on_result(result)
+                if stopping is None and is_within_tolerance(result):
+                    stopping = i
+            if stopping is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+                return Portfolio_Result(
+                    STOP_SCORE_TOLERANCE,
+                    methods[stopping].name,
+                    [method.name for (method, future) in zip(methods, futures) if future in pending],
+                )
+        return Portfolio_Result(STOP_ALL_METHODS_RUN, None, [])
+    finally:
+        executor.shutdown(wait=False)
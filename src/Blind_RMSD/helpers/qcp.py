@@ -0,0 +1,96 @@
+from typing import Tuple
+
+from Blind_RMSD.helpers.numpy_helpers import *
+
+# Newton iterations on the characteristic polynomial (converges in a handful of iterations from the upper bound)
+QCP_MAX_ITERATIONS = 50
+QCP_PRECISION = 1E-11
+
+# Smallest singular value of the covariance matrix below which a fit is degenerate (coplanar or colinear points),
+# matching the threshold of kabsch()
+DEGENERACY_THRESHOLD = 1E-8
+
+def covariance_matrices(P: Array, Q: Array) -> Array:
+    '''(K, 3, 3) covariance matrices of a (K, n, 3) stack of centered point arrays P and a (K, n, 3) or (n, 3) Q.'''
+    return np.matmul(np.swapaxes(P, -1, -2), Q)
+
+def key_matrices(C: Array) -> Array:
+    '''(K, 4, 4) symmetric quaternion key matrices of Theobald (2005) for (K, 3, 3) covariance matrices.'''
+    (Sxx, Sxy, Sxz), (Syx, Syy, Syz), (Szx, Szy, Szz) = [[C[..., i, j] for j in range(3)] for i in range(3)]
+
+    return np.stack(
+        [
+            np.stack([Sxx + Syy + Szz, Syz - Szy, Szx - Sxz, Sxy - Syx], axis=-1),
+            np.stack([Syz - Szy, Sxx - Syy - Szz, Sxy + Syx, Szx + Sxz], axis=-1),
+            np.stack([Szx - Sxz, Sxy + Syx, -Sxx + Syy - Szz, Syz + Szy], axis=-1),
+            np.stack([Sxy - Syx, Szx + Sxz, Syz + Szy, -Sxx - Syy + Szz], axis=-1),
+        ],
+        axis=-2,
+    )
+
+def largest_eigenvalues(C: Array, inner_products: Array) -> Array:
+    '''
+    Largest eigenvalues of the key matrices of C, by Newton iterations on their characteristic polynomial
+    x^4 + c2 x^2 + c1 x + c0, starting from the upper bound inner_products / 2 = (|P|^2 + |Q|^2) / 2.
+    '''
+    c2 = -2. * np.sum(np.square(C), axis=(-2, -1))
+    c1 = -8. * np.linalg.det(C)
+    c0 = np.linalg.det(key_matrices(C))
+
+    eigenvalues = inner_products / 2.
+    for _ in range(QCP_MAX_ITERATIONS):
+        squared = eigenvalues * eigenvalues
+        polynomial = (squared + c2) * squared + c1 * eigenvalues + c0
+        derivative = 4. * squared * eigenvalues + 2. * c2 * eigenvalues + c1
+
+        step = np.divide(polynomial, derivative, out=np.zeros_like(polynomial), where=derivative != 0.)
+        eigenvalues = eigenvalues - step
+
+        if np.all(np.abs(step) <= QCP_PRECISION * np.abs(eigenvalues)):
+            break
+
+    return eigenvalues
+
+def qcp_rmsd(P: Array, Q: Array) -> Array:
+    '''
+    Minimal RMSD over proper rotations between a (K, n, 3) stack of centered point arrays P and the centered
+    Q ((n, 3), or (K, n, 3)), without building the rotation matrices. Same value as the RMSD after a Kabsch fit.
+    '''
+    C = covariance_matrices(P, Q)
+    inner_products = np.sum(np.square(P), axis=(-2, -1)) + np.sum(np.square(Q), axis=(-2, -1))
+
+    eigenvalues = largest_eigenvalues(C, inner_products)
+
+    return sqrt(np.maximum(inner_products - 2. * eigenvalues, 0.) / P.shape[-2])
+
+def qcp_degenerate(P: Array, Q: Array) -> Array:
+    '''
+    (K,) boolean array, True where the fit is degenerate (coplanar or colinear points) and kabsch() would raise.
+    The smallest singular value of C is estimated from its invariants as |det(C)| / sqrt(sigma_1^2 sigma_2^2 + ...),
+    which avoids an SVD.
+    '''
+    C = covariance_matrices(P, Q)
+    CtC = np.matmul(np.swapaxes(C, -1, -2), C)
+    second_invariant = (np.square(np.trace(CtC, axis1=-2, axis2=-1)) - np.sum(np.square(CtC), axis=(-2, -1))) / 2.
+
+    return np.abs(np.linalg.det(C)) <= DEGENERACY_THRESHOLD * sqrt(np.maximum(second_invariant, 0.))
+
+def qcp_rotation(P: Array, Q: Array) -> Array:
+    '''
+    (K, 3, 3) optimal rotation matrices U (P U ~ Q, same convention as kabsch()), built from the quaternion
+    eigenvector of the largest eigenvalue of the key matrices. Meant for the few winners of a qcp_rmsd() ranking.
+    '''
+    _, eigenvectors = np.linalg.eigh(key_matrices(covariance_matrices(P, Q)))
+    q0, q1, q2, q3 = [eigenvectors[..., i, -1] for i in range(4)]
+
+    rotations = np.stack(
+        [
+            np.stack([q0 * q0 + q1 * q1 - q2 * q2 - q3 * q3, 2. * (q1 * q2 - q0 * q3), 2. * (q1 * q3 + q0 * q2)], axis=-1),
+            np.stack([2. * (q1 * q2 + q0 * q3), q0 * q0 - q1 * q1 + q2 * q2 - q3 * q3, 2. * (q2 * q3 - q0 * q1)], axis=-1),
+            np.stack([2. * (q1 * q3 - q0 * q2), 2. * (q2 * q3 + q0 * q1), q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3], axis=-1),
+        ],
+        axis=-2,
+    )
+
+    # rotations act on column vectors
+    return np.swapaxes(rotations, -1, -2)
@@ -0,0 +1,200 @@
+from time import perf_counter
+from typing import Any, NamedTuple, Optional, Tuple
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.kabsch import kabsch_batch, kabsch_from_covariances
+
+# Points closer than this (in Angstrom) to their closest same-flavour reference point are inliers
+DEFAULT_RANSAC_INLIER_THRESHOLD = 0.5
+# Stop once a sample made of correct correspondences has been drawn with this probability (under the inlier ratio of
+# the best hypothesis so far), or after DEFAULT_RANSAC_MAX_HYPOTHESES hypotheses, or after DEFAULT_RANSAC_TIME_BUDGET s
+DEFAULT_RANSAC_CONFIDENCE = 0.999
+DEFAULT_RANSAC_MAX_HYPOTHESES = 20000
+DEFAULT_RANSAC_TIME_BUDGET = 2.
+# Number of hypotheses proposed (and scored) at once
+DEFAULT_RANSAC_BATCH_SIZE = 256
+DEFAULT_RANSAC_SEED = 0
+
+# Number of correspondences per sample (with the centroids, which are always matched, 2 would define a rotation)
+RANSAC_SAMPLE_SIZE = 3
+
+STOP_CONFIDENCE, STOP_MAX_HYPOTHESES, STOP_TIME_BUDGET, STOP_SCORE_TOLERANCE = 'confidence', 'max_hypotheses', 'time_budget', 'score_tolerance'
+
+Ransac_Result = NamedTuple(
+    'Ransac_Result',
+    [
+        ('aligned_array', Array),
+        ('score', float),
+        ('matrices', Tuple[Array, Array, Array]),
+        ('n_inliers', int),
+        ('n_hypotheses', int),
+        ('stop_reason', str),
+    ],
+)
+
+def compatible_reference_points(P: Array, Q: Array, flavour_scorer: Any, inlier_threshold: float) -> Tuple[Array, Array, Array]:
+    '''
+    Flattened lists of the reference points each point could be matched to: same flavour, and same distance to the
+    centroid (within inlier_threshold), since rotations about the centroid preserve it.
+    Returns (starts, counts, reference_indexes), the ones of point i being reference_indexes[starts[i]:starts[i] + counts[i]].
+    '''
+    query_codes, reference_codes = flavour_scorer.flavour_codes
+    radii, reference_radii = np.linalg.norm(P, axis=1), np.linalg.norm(Q, axis=1)
+
+    compatible = [
+        np.flatnonzero((reference_codes == code) & (np.abs(reference_radii - radius) <= inlier_threshold))
+        for (code, radius) in zip(query_codes, radii)
+    ]
+    counts = np.array([len(reference_indexes) for reference_indexes in compatible], dtype=int)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(int)
+    return starts, counts, np.concatenate(compatible).astype(int) if len(compatible) > 0 else np.zeros(0, dtype=int)
+
+def required_hypotheses(correct_probability: float, confidence: float) -> float:
+    '''Number of samples needed to draw one made of correct correspondences only, with probability confidence.'''
+    sample_probability = correct_probability ** RANSAC_SAMPLE_SIZE
+    if sample_probability <= 0.:
+        return np.inf
+    if sample_probability >= 1.:
+        return 1.
+    return np.log(1. - confidence) / np.log(1. - sample_probability)
+
+def refitted_on_inliers(
+    P: Array,
+    Q: Array,
+    reference_array: Array,
+    U: Array,
+    score: float,
+    flavour_scorer: Any,
+    inlier_threshold: float,
+    stats: Any = None,
+) -> Tuple[Array, Array, float]:
+    '''
+    (U, aligned_array, score) of the rotation U of the centered P, refitted on the points within inlier_threshold of
+    their closest same-flavour point of reference_array (Q is reference_array centered), unless that makes things worse.
+    '''
+    Qc = reference_array.mean(axis=0)
+    aligned_array = np.dot(P, U) + Qc
+
+    distances, indices = flavour_scorer.nearest(aligned_array, reference_array)
+    is_inlier = distances <= inlier_threshold
+    if np.sum(is_inlier) >= RANSAC_SAMPLE_SIZE:
+        # Not centered on the inliers: the rotation is about the centroids
+        refitted_U, degenerate = kabsch_batch(P[is_inlier][np.newaxis], Q[indices[is_inlier]])
+        if stats is not None:
+            stats.n_svd_calls += 1
+        if not degenerate[0]:
+            refitted_array = np.dot(P, refitted_U[0]) + Qc
+            refitted_score = flavour_scorer(refitted_array, reference_array)
+            if refitted_score <= score:
+                return refitted_U[0], refitted_array, refitted_score
+
+    return U, aligned_array, score
+
+def ransac_alignment(
+    point_array: Array,
+    reference_array: Array,
+    flavour_scorer: Any,
+    inlier_threshold: float = DEFAULT_RANSAC_INLIER_THRESHOLD,
+    confidence: float = DEFAULT_RANSAC_CONFIDENCE,
+    max_hypotheses: int = DEFAULT_RANSAC_MAX_HYPOTHESES,
+    time_budget: float = DEFAULT_RANSAC_TIME_BUDGET,
+    score_tolerance: float = 0.,
+    batch_size: int = DEFAULT_RANSAC_BATCH_SIZE,
+    seed: int = DEFAULT_RANSAC_SEED,
+    verbosity: int = 0,
+    stats: Any = None,
+) -> Optional[Ransac_Result]:
+    '''
+    Randomized alignment of point_array on reference_array that does not enumerate permutations of ambiguous points:
+    repeatedly sample RANSAC_SAMPLE_SIZE points with a random compatible reference point each (see
+    compatible_reference_points()), keep the samples whose inter-point distances match (within 2 * inlier_threshold)
+    and which are not coplanar with the centroid, fit a rotation about the centroids on them, and count the points
+    within inlier_threshold of their closest same-flavour reference point (flavour_scorer.nearest()).
+    The rotation of the hypothesis with the most inliers (then the lowest RMSD) is finally refitted on its inliers.
+
+    Points are sampled with a probability inversely proportional to their number of compatible reference points, and
+    the search stops after enough hypotheses for the requested confidence (estimating the probability of drawing a
+    correct correspondence from the best inlier ratio), after max_hypotheses or time_budget, or when a hypothesis
+    scores below score_tolerance.
+    Like icp_refinement(), the centroid of point_array is mapped onto the one of reference_array.
+    Seeded, so that alignments are reproducible. Returns None if no valid sample could be drawn.
+    '''
+    start_time = perf_counter()
+    rng = np.random.default_rng(seed)
+
+    Pc, Qc = point_array.mean(axis=0), reference_array.mean(axis=0)
+    P, Q = point_array - Pc, reference_array - Qc
+
+    starts, counts, reference_indexes = compatible_reference_points(P, Q, flavour_scorer, inlier_threshold)
+    samplable = np.flatnonzero(counts > 0)
+    if len(samplable) < RANSAC_SAMPLE_SIZE:
+        return None
+
+    weights = 1. / counts[samplable]
+    weights /= weights.sum()
+    # Probability that a sampled point is given its correct reference point, if it is an inlier
+    match_probability = float(np.sum(weights / counts[samplable]))
+
+    best = None
+    n_hypotheses, stop_reason = 0, STOP_MAX_HYPOTHESES
+    while n_hypotheses < max_hypotheses:
+        if perf_counter() - start_time > time_budget:
+            stop_reason = STOP_TIME_BUDGET
+            break
+
+        n_samples = min(batch_size, max_hypotheses - n_hypotheses)
+        n_hypotheses += n_samples
+
+        point_indexes = samplable[rng.choice(len(samplable), size=(n_samples, RANSAC_SAMPLE_SIZE), p=weights)]
+        sample_reference_indexes = reference_indexes[starts[point_indexes] + (rng.random(point_indexes.shape) * counts[point_indexes]).astype(int)]
+
+        sample_P, sample_Q = P[point_indexes], Q[sample_reference_indexes]
+        pairs = [(a, b) for a in range(RANSAC_SAMPLE_SIZE) for b in range(a + 1, RANSAC_SAMPLE_SIZE)]
+        is_valid = np.all(
+            [
+                (point_indexes[:, a] != point_indexes[:, b])
+                & (np.abs(np.linalg.norm(sample_P[:, a] - sample_P[:, b], axis=-1) - np.linalg.norm(sample_Q[:, a] - sample_Q[:, b], axis=-1)) <= 2. * inlier_threshold)
+                for (a, b) in pairs
+            ],
+            axis=0,
+        )
+        if not np.any(is_valid):
+            continue
+
+        # No centering: the centroids are matched, and sample points are relative to them
+        U, degenerate = kabsch_from_covariances(np.matmul(np.swapaxes(sample_P[is_valid], -1, -2), sample_Q[is_valid]))
+        if stats is not None:
+            stats.n_svd_calls += len(U)
+        U = U[~degenerate]
+        if len(U) == 0:
+            continue
+
+        distances, _ = flavour_scorer.nearest(np.matmul(P, U) + Qc, reference_array)
+        n_inliers = np.sum(distances <= inlier_threshold, axis=-1)
+        scores = sqrt(mean(square(distances), axis=-1))
+
+        i = int(np.lexsort((scores, -n_inliers))[0])
+        if best is None or (n_inliers[i], -scores[i]) > (best[1], -best[2]):
+            best = (U[i], int(n_inliers[i]), float(scores[i]))
+            if verbosity >= 5:
+                log.debug('RANSAC: best hypothesis so far has {0}/{1} inliers (score {2}) after {3} hypotheses'.format(best[1], len(P), best[2], n_hypotheses))
+
+        if best[2] <= score_tolerance:
+            stop_reason = STOP_SCORE_TOLERANCE
+            break
+
+        if n_hypotheses >= required_hypotheses(best[1] / len(P) * match_probability, confidence):
+            stop_reason = STOP_CONFIDENCE
+            break
+
+    if best is None:
+        return None
+
+    U, n_inliers, score = best
+    U, aligned_array, score = refitted_on_inliers(P, Q, reference_array, U, score, flavour_scorer, inlier_threshold, stats=stats)
+
+    if verbosity >= 2:
+        log.debug('RANSAC: stopped ({0}) after {1} hypotheses with {2}/{3} inliers (score {4})'.format(stop_reason, n_hypotheses, n_inliers, len(P), score))
+
+    return Ransac_Result(aligned_array, score, (U, Pc, Qc), n_inliers, n_hypotheses, stop_reason)
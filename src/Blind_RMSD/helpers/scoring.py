@@ -8,9 +8,14 @@ INFINITE_RMSD = float('inf')
 def rmsd(point_list1, point_list2, mask_array=None):
     point_array1 = np.array(point_list1)
     point_array2 = np.array(point_list2)
-    return rmsd_array_for_loop(point_array1, point_array2, mask_array=mask_array)
+    return rmsd_array(point_array1, point_array2, mask_array=mask_array)
 
 def rmsd_array(point_array1, point_array2, mask_array = None, verbosity=0):
+    '''
+    Root mean square of the distance between each point of point_array1 and its closest (unmasked) point in point_array2.
+    mask_array[i, j] is added to the distance between point_array1[i] and point_array2[j] (0. or float('inf')).
+    Vectorized equivalent of rmsd_array_for_loop.
+    '''
     do_assert(
         point_array1.shape == point_array2.shape,
         "Won't compute RMSD on arrays with different sizes: {0} and {1}".format(*[x.shape for x in [point_array1, point_array2]]),
@@ -26,22 +31,25 @@ def rmsd_array(point_array1, point_array2, mask_array = None, verbosity=0):
                 distance_matrix.shape,
             ),
         )
-    else:
-        mask_array = np.zeros((point_array1.shape[0], point_array1.shape[0]))
+        distance_matrix += mask_array
 
-    if verbosity >= 3:
+    if verbosity >= 5:
         log.debug("Number of contact points: {0}/{1}".format(count_contact_points(distance_matrix), point_array1.shape[0]))
 
-    rmsd = sqrt( mean( square( np.min( distance_matrix + np.transpose(mask_array), axis=0 ) ) ) )
+    rmsd = sqrt( mean( square( np.min( distance_matrix, axis=1 ) ) ) )
+
+    do_assert(
+        rmsd != INFINITE_RMSD,
+        'A point of point_array1 has no unmasked partner in point_array2 (all its mask_array entries are infinite)',
+    )
 
     if verbosity >= 4:
         log.debug("New RMSD: {0}".format(rmsd))
 
-    raise Exception() # Wrong until proven otherwise
-
     return rmsd
 
 def rmsd_array_for_loop(point_array1, point_array2, mask_array = None, verbosity=0):
+    '''Reference (pure Python) implementation of rmsd_array. Slow; only kept to validate rmsd_array.'''
     assert point_array1.shape == point_array2.shape, "Error: Won't compute RMSD on arrays with different sizes: {0} and {1}".format(*[x.shape for x in [point_array1, point_array2]])
 
     distance_matrix = get_distance_matrix(point_array1, point_array2)
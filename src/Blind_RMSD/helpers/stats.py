@@ -0,0 +1,80 @@
+from time import perf_counter
+from typing import Any, Dict
+
+class Alignment_Stats:
+    '''
+    Performance counters of one pointsOnPoints() call, filled in only when an instance is passed as its stats argument
+    (every counting site is behind an "if stats is not None" test, so nothing is paid otherwise).
+
+    stage_times: wall time (in seconds) of 'preprocessing', 'symmetries', every method of method_results (by name) and
+    'validation' (choice of the best method, isometry checks and permutation extraction).
+    n_svd_calls: number of (3 x 3) singular value decompositions computed, batched or not; batches are decomposed as
+    a whole, so candidates past a degenerate one (which are then dropped) count too.
+    exit_reason: why the alignment stopped where it did (see pointsOnPoints()).
+    skipped_methods: the methods that were not run because an earlier one scored within tolerance.
+
+    Not thread safe: every method of pointsOnPoints() counts into Alignment_Stats of its own, merge()d into the ones of
+    the alignment in the calling thread.
+    '''
+    def __init__(self):
+        self.n_points = 0
+        self.n_unique_points = 0
+        self.n_ambiguous_points = 0
+        self.total_number_permutation = 0
+        self.n_evaluated_permutations = 0
+        self.n_svd_calls = 0
+        self.n_score_evaluations = 0
+        self.n_aborted_score_evaluations = 0
+        self.search_status = None
+        self.exit_reason = None
+        self.best_method = None
+        self.skipped_methods = []
+        self.stage_times = {}
+        self._last_lap = perf_counter()
+
+    def __repr__(self) -> str:
+        return 'Alignment_Stats({0})'.format(', '.join('{0}={1!r}'.format(key, value) for (key, value) in self.as_dict().items()))
+
+    def start(self) -> None:
+        self._last_lap = perf_counter()
+
+    def lap(self, stage: str) -> None:
+        '''Add the time elapsed since the previous lap (or start()) to stage.'''
+        now = perf_counter()
+        self.stage_times[stage] = self.stage_times.get(stage, 0.) + now - self._last_lap
+        self._last_lap = now
+
+    def merge(self, other: 'Alignment_Stats') -> None:
+        '''Add the counters of other (e.g. the ones of a single method), and take the outcome of its search, if any.'''
+        self.n_evaluated_permutations += other.n_evaluated_permutations
+        self.n_svd_calls += other.n_svd_calls
+        self.n_score_evaluations += other.n_score_evaluations
+        self.n_aborted_score_evaluations += other.n_aborted_score_evaluations
+        if other.total_number_permutation:
+            self.total_number_permutation = other.total_number_permutation
+        if other.search_status is not None:
+            self.search_status = other.search_status
+        if other.exit_reason is not None:
+            self.exit_reason = other.exit_reason
+
+    def total_time(self) -> float:
+        return sum(self.stage_times.values())
+
+    def as_dict(self) -> Dict[str, Any]:
+        '''Flat, JSON serializable record (e.g. for aggregation in dashboards).'''
+        return {
+            'n_points': self.n_points,
+            'n_unique_points': self.n_unique_points,
+            'n_ambiguous_points': self.n_ambiguous_points,
+            'total_number_permutation': self.total_number_permutation,
+            'n_evaluated_permutations': self.n_evaluated_permutations,
+            'n_svd_calls': self.n_svd_calls,
+            'n_score_evaluations': self.n_score_evaluations,
+            'n_aborted_score_evaluations': self.n_aborted_score_evaluations,
+            'search_status': self.search_status,
+            'exit_reason': self.exit_reason,
+            'best_method': self.best_method,
+            'skipped_methods': list(self.skipped_methods),
+            'stage_times': dict(self.stage_times),
+            'total_time': self.total_time(),
+        }
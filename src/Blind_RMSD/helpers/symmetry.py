@@ -0,0 +1,147 @@
+from typing import Any, List, Optional, Sequence, Tuple
+
+from Blind_RMSD.helpers.log import log
+from Blind_RMSD.helpers.numpy_helpers import *
+from Blind_RMSD.helpers.flavour_index import flavour_codes_for
+from Blind_RMSD.helpers.kabsch import kabsch_batch
+from Blind_RMSD.helpers.scoring import INFINITE_RMSD
+
+# Maximum deviation (in Angstrom) of a point from the image of its symmetric point, for a permutation to count as a symmetry
+DEFAULT_SYMMETRY_TOLERANCE = 1E-3
+
+# Point groups of molecules have at most 120 elements (I_h)
+MAX_SYMMETRY_ORDER = 120
+
+# Structures with more points are not searched for symmetries (the search needs an N x N distance matrix)
+MAX_SYMMETRY_SEARCH_POINTS = 500
+
+Bond = Tuple[int, int]
+
+def rigid_fit_deviation(point_array: Array, permutation: Array) -> float:
+    '''Largest distance between the points of point_array[permutation] and the best proper rigid motion of point_array.'''
+    P, Q = point_array - point_array.mean(axis=0), point_array[permutation] - point_array[permutation].mean(axis=0)
+    U, degenerate = kabsch_batch(P[np.newaxis], Q)
+    if degenerate[0]:
+        return INFINITE_RMSD
+    return float(np.max(np.linalg.norm(np.dot(P, U[0]) - Q, axis=1)))
+
+def symmetry_permutations(
+    point_array: Array,
+    flavours: Sequence[Any],
+    bonds: Sequence[Bond] = (),
+    tolerance: float = DEFAULT_SYMMETRY_TOLERANCE,
+    max_order: int = MAX_SYMMETRY_ORDER,
+    max_points: int = MAX_SYMMETRY_SEARCH_POINTS,
+    verbosity: int = 0,
+) -> List[Array]:
+    '''
+    Non-trivial permutations g of the points of point_array that preserve flavours (and bonds), and are realised by a
+    proper rotation of the structure: point_array[g] ~ R(point_array), up to tolerance.
+    These are the automorphisms of the molecular graph that are also symmetries of the conformation, i.e. the ones
+    under which Kabsch fits and closest point RMSDs are invariant.
+
+    Found by backtracking: points are mapped in decreasing order of rarity of their flavour, and every image has to
+    preserve the distances to the centroid and to the points mapped before it.
+    Structures of more than max_points points are not searched (returns []).
+    '''
+    point_array = array(point_array, dtype=float)
+    N = len(point_array)
+    if N > max_points:
+        if verbosity >= 3:
+            log.debug('Not searching symmetry permutations of {0} points (more than {1})'.format(N, max_points))
+        return []
+    codes, = flavour_codes_for([flavours])
+
+    centered_array = point_array - point_array.mean(axis=0)
+    radii = np.linalg.norm(centered_array, axis=1)
+    distance_matrix = get_distance_matrix(point_array, point_array)
+
+    bonded = np.zeros((N, N), dtype=bool)
+    for (i, j) in bonds:
+        bonded[i, j] = bonded[j, i] = True
+
+    class_sizes = np.bincount(codes)
+    order = sorted(range(N), key=lambda i: (class_sizes[codes[i]], -radii[i], i))
+    candidates = [
+        np.flatnonzero((codes == codes[i]) & (np.abs(radii - radii[i]) <= 2 * tolerance))
+        for i in order
+    ]
+
+    found, image, used = [], np.full(N, -1, dtype=int), np.zeros(N, dtype=bool)
+
+    def is_compatible(level: int, i: int, j: int) -> bool:
+        if used[j]:
+            return False
+        mapped = order[:level]
+        return level == 0 or (
+            not np.any(np.abs(distance_matrix[j, image[mapped]] - distance_matrix[i, mapped]) > 2 * tolerance)
+            and not np.any(bonded[j, image[mapped]] != bonded[i, mapped])
+        )
+
+    def unmap(level: int) -> None:
+        i = order[level]
+        used[image[i]], image[i] = False, -1
+
+    # Depth first search with an explicit stack (one level per point, far more than Python's recursion limit allows)
+    # of the next candidate to try at every level
+    next_candidates, level = np.zeros(N + 1, dtype=int), 0
+    while level >= 0 and len(found) < max_order - 1:
+        if level == N:
+            if np.any(image != np.arange(N)) and rigid_fit_deviation(point_array, image) <= tolerance:
+                found.append(image.copy())
+            level -= 1
+            if level >= 0:
+                unmap(level)
+            continue
+
+        i, j = order[level], None
+        while next_candidates[level] < len(candidates[level]):
+            candidate = candidates[level][next_candidates[level]]
+            next_candidates[level] += 1
+            if is_compatible(level, i, candidate):
+                j = candidate
+                break
+
+        if j is None:
+            next_candidates[level] = 0
+            level -= 1
+            if level >= 0:
+                unmap(level)
+            continue
+
+        image[i], used[j] = j, True
+        level += 1
+
+    if verbosity >= 3:
+        log.debug('Found {0} symmetry permutations (besides the identity)'.format(len(found)))
+
+    return found
+
+def is_symmetry_permutation(point_array: Array, flavours: Sequence[Any], permutation: Sequence[int], tolerance: float = DEFAULT_SYMMETRY_TOLERANCE) -> bool:
+    permutation = np.array(permutation, dtype=int)
+    return (
+        sorted(permutation.tolist()) == list(range(len(point_array)))
+        and all(flavours[i] == flavours[j] for (i, j) in enumerate(permutation))
+        and rigid_fit_deviation(array(point_array, dtype=float), permutation) <= tolerance
+    )
+
+def symmetry_group(permutations: Sequence[Sequence[int]], max_order: int = MAX_SYMMETRY_ORDER) -> Optional[List[Array]]:
+    '''Non-trivial elements of the group generated by permutations (None if it has more than max_order elements).'''
+    permutations = [np.array(permutation, dtype=int) for permutation in permutations]
+    if len(permutations) == 0:
+        return []
+
+    identity = tuple(range(len(permutations[0])))
+    seen, queue = {identity}, [np.array(identity)]
+    while queue:
+        element = queue.pop()
+        for permutation in permutations:
+            product = element[permutation]
+            key = tuple(product.tolist())
+            if key not in seen:
+                if len(seen) >= max_order:
+                    return None
+                seen.add(key)
+                queue.append(product)
+
+    return [np.array(element) for element in sorted(seen) if element != identity]
@@ -3,18 +3,29 @@ from collections import namedtuple
 from os.path import abspath, join, dirname, exists
 from os import mkdir
 from scipy.spatial.distance import squareform
-from functools import reduce
-from typing import NamedTuple, Any, List, Optional, Tuple, Dict
+from typing import NamedTuple, Any, List, Optional, Tuple, Dict, Iterable, Iterator, Sequence, Union
 
 from Blind_RMSD.helpers.log import log
-from Blind_RMSD.helpers.moldata import flavour_list, point_list, aligned_pdb_str, united_hydrogens_point_list
-from Blind_RMSD.align import pointsOnPoints, FAILED_ALIGNMENT, NULL_PDB_WRITING_FCT
+from Blind_RMSD.helpers.moldata import flavour_list, point_list, aligned_pdb_str, united_hydrogens_point_list, bond_list
+from Blind_RMSD.helpers.symmetry import symmetry_permutations
+from Blind_RMSD.helpers.PreparedReference import PreparedReference
+from Blind_RMSD.helpers.pdb_cache import PDB_Data_Cache, pdb_data_key
+from Blind_RMSD.helpers.bounds import radial_lower_bound
+from Blind_RMSD.helpers.fingerprint import Fingerprint_Index, fingerprint_for
+from Blind_RMSD.helpers.scoring import INFINITE_RMSD
+from Blind_RMSD.helpers.stats import Alignment_Stats
+from Blind_RMSD.helpers.pairwise import parallel_condensed_matrix, DEFAULT_PAIRWISE_CHUNK_SIZE
+from Blind_RMSD.align import pointsOnPoints, FAILED_ALIGNMENT, NULL_PDB_WRITING_FCT, DEFAULT_VALIDATION
 from Blind_RMSD.helpers.exceptions import Topology_Error, Permutation_Not_Found_Error
 
 from chemical_equivalence.calcChemEquivalency import partial_mol_data_for_pdbstr, ALL_EXCEPTION_SEARCHING_KEYWORDS, MolDataFailure
 
 UNITED_RMSD_FIT = True
 
+# Candidates of near_duplicate_pairs() are retrieved within slack times the RMSD threshold of fingerprint distance,
+# which is only a heuristic proxy of the score (see helpers.fingerprint): an empirical margin, not a bound
+DEFAULT_FINGERPRINT_SLACK = 1.5
+
 PDB, RMSD = str, float
 
 PDB_Data = NamedTuple(
@@ -26,6 +37,8 @@ PDB_Data = NamedTuple(
         ('extra_points_lists', Any),
         ('pdb_str', PDB),
         ('united_atom_fit', bool),
+        # None unless requested (see automorphisms_for())
+        ('automorphisms', Optional[List[List[int]]]),
     ],
 )
 
@@ -40,6 +53,7 @@ Alignment_Results = NamedTuple(
         ('atom_names_permutation', Dict[int, int]),
         ('total_fit_points', int),
         ('kabsch_fit_point', int),
+        ('stats', Optional[Alignment_Stats]),
     ],
 )
 
@@ -50,20 +64,71 @@ def pdb_data_for(
     exception_searching_keywords: List[str] = ALL_EXCEPTION_SEARCHING_KEYWORDS,
     united_atom_fit: bool = UNITED_RMSD_FIT,
     enforce_single_molecule: bool = True,
+    cache: Optional[PDB_Data_Cache] = None,
+    find_automorphisms: bool = False,
 ) -> PDB_Data:
+    '''
+    Molecular data, points and flavours of a PDB string.
+    If cache is given (see helpers.pdb_cache), results are looked up and stored by content address.
+    find_automorphisms: also search the automorphisms of the molecule (see automorphisms_for()), which is only worth it
+    for the symmetry pruning of align_pdb_on_pdb(use_automorphisms=True).
+    '''
+    if cache is not None:
+        key = pdb_data_key(pdb_str, united_atom_fit, enforce_single_molecule, exception_searching_keywords)
+        fields = cache.get(key)
+        if fields is not None:
+            pdb_data = PDB_Data(pdb_str=pdb_str, **fields)
+            if find_automorphisms and pdb_data.automorphisms is None:
+                pdb_data = pdb_data._replace(automorphisms=automorphisms_for(pdb_data))
+            return pdb_data
+
     data = partial_mol_data_for_pdbstr(
         pdb_str,
         exception_searching_keywords=exception_searching_keywords,
         enforce_single_molecule=enforce_single_molecule,
     ).__dict__
 
-    return PDB_Data(
+    point_lists, flavour_lists = point_list(data, united_atom_fit), flavour_list(data, united_atom_fit)
+
+    pdb_data = PDB_Data(
         data=data,
-        point_lists=point_list(data, united_atom_fit),
-        flavour_lists=flavour_list(data, united_atom_fit),
+        point_lists=point_lists,
+        flavour_lists=flavour_lists,
         extra_points_lists=united_hydrogens_point_list(data, united_atom_fit),
         pdb_str=pdb_str,
         united_atom_fit=united_atom_fit,
+        automorphisms=None,
+    )
+    if find_automorphisms:
+        pdb_data = pdb_data._replace(automorphisms=automorphisms_for(pdb_data))
+
+    if cache is not None:
+        cache.put(key, {field: value for (field, value) in pdb_data._asdict().items() if field != 'pdb_str'})
+
+    return pdb_data
+
+def automorphisms_for(pdb_data: PDB_Data) -> List[List[int]]:
+    '''
+    Automorphisms of the molecular graph (coloured by flavour) that are also symmetries of the conformation of pdb_data
+    (pdb_data.automorphisms if they were already searched). Empty for large molecules (see helpers.symmetry).
+    '''
+    if pdb_data.automorphisms is not None:
+        return pdb_data.automorphisms
+    return [
+        automorphism.tolist()
+        for automorphism in symmetry_permutations(
+            pdb_data.point_lists,
+            pdb_data.flavour_lists,
+            bonds=bond_list(pdb_data.data, pdb_data.united_atom_fit),
+        )
+    ]
+
+def prepare_reference(reference_pdb_data: PDB_Data) -> PreparedReference:
+    '''Reference-side preprocessing of align_pdb_on_pdb(), shared by all the alignments on reference_pdb_data.'''
+    return PreparedReference(
+        reference_pdb_data.point_lists,
+        reference_pdb_data.flavour_lists,
+        data=reference_pdb_data,
     )
 
 def align_pdb_on_pdb(
@@ -71,9 +136,13 @@ def align_pdb_on_pdb(
     other_pdb_str: Optional[str] = None,
     reference_pdb_data: Optional[PDB_Data] = None,
     other_pdb_data: Optional[PDB_Data] = None,
+    prepared_reference: Optional[PreparedReference] = None,
     io: Any = None,
     soft_fail: bool = True,
     assert_is_isometry: bool = False,
+    validation: str = DEFAULT_VALIDATION,
+    collect_stats: bool = False,
+    use_automorphisms: bool = False,
     verbosity: int = 0,
     debug: bool = False,
     test_id: str = '',
@@ -81,6 +150,9 @@ def align_pdb_on_pdb(
     exception_searching_keywords: List[str] = ALL_EXCEPTION_SEARCHING_KEYWORDS,
     **kwargs: Dict[str, Any]
 ) -> Tuple[PDB, RMSD, Alignment_Results]:
+    if reference_pdb_data is None and prepared_reference is not None:
+        reference_pdb_data = prepared_reference.data
+
     assert reference_pdb_str is not None or reference_pdb_data is not None
     if reference_pdb_data is None:
         reference_pdb_data = pdb_data_for(reference_pdb_str, united_atom_fit=united_atom_fit, exception_searching_keywords=exception_searching_keywords)
@@ -110,6 +182,8 @@ def align_pdb_on_pdb(
     else:
         pdb_writing_fct = NULL_PDB_WRITING_FCT
 
+    stats = Alignment_Stats() if collect_stats else None
+
     try:
         alignment = pointsOnPoints(
             [other_pdb_data.point_lists, reference_pdb_data.point_lists],
@@ -118,7 +192,11 @@ def align_pdb_on_pdb(
             verbosity=verbosity,
             soft_fail=soft_fail,
             assert_is_isometry=assert_is_isometry,
+            validation=validation,
+            stats=stats,
             pdb_writing_fct=pdb_writing_fct,
+            automorphisms=automorphisms_for(other_pdb_data) if use_automorphisms else None,
+            prepared_reference=prepared_reference,
             **kwargs,
         )
     except (Topology_Error, AssertionError) as e:
@@ -160,35 +238,144 @@ def align_pdb_on_pdb(
             ),
             total_fit_points=None,
             kabsch_fit_point=None,
+            stats=stats,
         ),
     )
 
-def rmsd_matrix_for(list_of_pdb_str: List[str]) -> Any:
+def rmsd_lower_bound(reference_pdb_data: PDB_Data, other_pdb_data: PDB_Data) -> RMSD:
+    '''Lower bound on the score of align_pdb_on_pdb(), without any search (see helpers.bounds.radial_lower_bound()).'''
+    return radial_lower_bound(
+        other_pdb_data.point_lists,
+        other_pdb_data.flavour_lists,
+        reference_pdb_data.point_lists,
+        reference_pdb_data.flavour_lists,
+    )
+
+def is_within_rmsd(
+    reference_pdb_data: PDB_Data,
+    other_pdb_data: PDB_Data,
+    threshold: RMSD,
+    verbosity: int = 0,
+    **kwargs: Dict[str, Any]
+) -> bool:
+    '''
+    Whether align_pdb_on_pdb() aligns other_pdb_data on reference_pdb_data within threshold.
+    The full alignment only runs if rmsd_lower_bound() does not already rule the pair out, and stops as soon as a
+    score below threshold is found.
+    '''
+    lower_bound = rmsd_lower_bound(reference_pdb_data, other_pdb_data)
+    # An infinite bound means mismatching flavours: leave it to the alignment to raise a Topology_Error
+    if threshold < lower_bound < INFINITE_RMSD:
+        if verbosity >= 1:
+            log.debug('Skipping alignment: RMSD lower bound {0:.3f} > {1:.3f}'.format(lower_bound, threshold))
+        return False
+
+    kwargs.setdefault('score_tolerance', threshold)
+    _, score, _ = align_pdb_on_pdb(
+        reference_pdb_data=reference_pdb_data,
+        other_pdb_data=other_pdb_data,
+        verbosity=verbosity,
+        **kwargs,
+    )
+    return score <= threshold
+
+def fingerprint_index_for(list_of_pdb_data: Sequence[PDB_Data]) -> Fingerprint_Index:
+    return Fingerprint_Index([
+        fingerprint_for(pdb_data.point_lists, pdb_data.flavour_lists)
+        for pdb_data in list_of_pdb_data
+    ])
+
+def near_duplicate_pairs(
+    list_of_pdb_data: Sequence[PDB_Data],
+    threshold: RMSD,
+    slack: Optional[float] = DEFAULT_FINGERPRINT_SLACK,
+    verbosity: int = 0,
+    **kwargs: Dict[str, Any]
+) -> List[Tuple[int, int, RMSD]]:
+    '''
+    Pairs (i < j, score) of list_of_pdb_data aligning within threshold. Every returned pair is confirmed by a full
+    alignment.
+    Only the pairs whose fingerprints are within slack * threshold (see helpers.fingerprint) are aligned, which
+    replaces the all-pairs scan with a near-linear retrieval and a few confirmations. The fingerprint distance does not
+    bound the score, so this heuristic prefilter can miss pairs within threshold: with slack=None, all the pairs of the
+    same topology are aligned instead (exhaustive, e.g. before deleting duplicates).
+    '''
+    fingerprint_index = fingerprint_index_for(list_of_pdb_data)
+    candidate_pairs = fingerprint_index.topology_pairs() if slack is None else fingerprint_index.pairs_within(slack * threshold)
+
+    if verbosity >= 1:
+        log.debug('Confirming {0} candidate pairs (out of {1})'.format(len(candidate_pairs), len(list_of_pdb_data) * (len(list_of_pdb_data) - 1) // 2))
+
+    kwargs.setdefault('score_tolerance', threshold)
+    confirmed_pairs = []
+    for (i, j) in candidate_pairs:
+        _, score, _ = align_pdb_on_pdb(
+            reference_pdb_data=list_of_pdb_data[i],
+            other_pdb_data=list_of_pdb_data[j],
+            verbosity=verbosity,
+            **kwargs,
+        )
+        if score <= threshold:
+            confirmed_pairs.append((i, j, score))
+    return confirmed_pairs
+
+def align_many(
+    prepared_reference: PreparedReference,
+    others: Iterable[Union[str, PDB_Data]],
+    exception_searching_keywords: List[str] = ALL_EXCEPTION_SEARCHING_KEYWORDS,
+    **kwargs: Dict[str, Any]
+) -> Iterator[Tuple[PDB, RMSD, Alignment_Results]]:
+    '''
+    Align every structure of others (PDB strings or PDB_Data) on the prepared reference (see prepare_reference()),
+    yielding the results of align_pdb_on_pdb() in order. Only the moving structures are processed for every alignment.
+    '''
+    for other in others:
+        if isinstance(other, str):
+            other = pdb_data_for(
+                other,
+                united_atom_fit=prepared_reference.data.united_atom_fit,
+                exception_searching_keywords=exception_searching_keywords,
+            )
+
+        yield align_pdb_on_pdb(
+            other_pdb_data=other,
+            prepared_reference=prepared_reference,
+            exception_searching_keywords=exception_searching_keywords,
+            **kwargs,
+        )
+
+def rmsd_matrix_for(
+    list_of_pdb_str: List[str],
+    n_jobs: Optional[int] = 1,
+    chunk_size: int = DEFAULT_PAIRWISE_CHUNK_SIZE,
+    verbosity: int = 0,
+) -> Any:
+    '''
+    Square matrix of the alignment RMSDs of all pairs of list_of_pdb_str (inf for topology mismatches).
+    Pairs are aligned over n_jobs processes (see helpers.pairwise.parallel_condensed_matrix()).
+    '''
     list_of_pdb_data = list(map(
         pdb_data_for,
         list_of_pdb_str,
     ))
 
-    def get_alignment_score(reference_pdb_data, other_pdb_data):
+    def get_alignment_score(i: int, j: int) -> RMSD:
         try:
             alignment = align_pdb_on_pdb(
-                reference_pdb_data=reference_pdb_data,
-                other_pdb_data=other_pdb_data,
+                reference_pdb_data=list_of_pdb_data[i],
+                other_pdb_data=list_of_pdb_data[j],
                 soft_fail=True,
             )
             return alignment[1]
         except Topology_Error:
             return float('inf')
 
-    rmsds = [
-        [
-            get_alignment_score(
-                pdb_data_1,
-                pdb_data_2,
-            )
-            for pdb_data_2 in list_of_pdb_data[i + 1:]
-        ]
-        for (i, pdb_data_1) in enumerate(list_of_pdb_data)
-    ]
-
-    return squareform(reduce(lambda acc, e: acc + e, rmsds, []))
+    return squareform(
+        parallel_condensed_matrix(
+            len(list_of_pdb_data),
+            get_alignment_score,
+            n_jobs=n_jobs,
+            chunk_size=chunk_size,
+            verbosity=verbosity,
+        ),
+    )
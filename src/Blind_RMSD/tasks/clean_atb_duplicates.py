@@ -9,6 +9,8 @@ from yaml import load, dump
 import urllib.request, urllib.error, urllib.parse
 from os.path import exists, dirname, join
 from copy import deepcopy
+from functools import partial
+from typing import NamedTuple, Optional
 import shutil
 import numpy
 numpy.set_printoptions(precision=3, linewidth=300)
@@ -17,7 +19,10 @@ from Blind_RMSD.align import pointsOnPoints
 from Blind_RMSD.helpers.scoring import rmsd, ad, INFINITE_RMSD
 from API_client.api import API
 from Blind_RMSD.helpers.moldata import group_by, split_equivalence_group, point_list, flavour_list, element_list, pdb_str
-from Blind_RMSD.pdb import pdb_data_for, align_pdb_on_pdb
+from Blind_RMSD.pdb import pdb_data_for, align_pdb_on_pdb, rmsd_lower_bound
+from Blind_RMSD.helpers.pdb_cache import PDB_Data_Cache
+from Blind_RMSD.helpers.pairwise import ordered_imap
+from Blind_RMSD.helpers.clustering import transitive_clusters, duplicate_links
 from Blind_RMSD.helpers.exceptions import Topology_Error
 
 numerical_tolerance = 1e-5
@@ -44,6 +49,15 @@ UNITED = True
 
 faulty_inchis = []
 
+# Re-parsing unchanged molecules dominates reruns of the duplicate scan
+PDB_DATA_CACHE = PDB_Data_Cache()
+
+# Marker of the pairs skipped by their RMSD lower bound (next to the _aligned_on_ PDB files of the aligned ones)
+SKIPPED_PAIR_EXTENSION = 'skipped'
+
+# Number of pairs handed to an alignment worker at once
+PAIR_CHUNK_SIZE = 4
+
 def download_molecule_files(molecule_name, inchi):
     def sorted_mols_for_InChI(inchi):
         matches = api.Molecules.search(InChI=inchi)
@@ -124,7 +138,54 @@ def molecule_test_alignment_generator(test_datum, verbosity=0):
         self.assertLessEqual( best_score, expected_rmsd)
     return test
 
-def get_distance_matrix(test_datum, debug=False, no_delete=False, max_matrix_size=None, verbosity=0):
+Pair_Alignment = NamedTuple(
+    'Pair_Alignment',
+    [
+        ('i', int),
+        ('j', int),
+        ('score', Optional[float]),
+        ('aligned_pdb_str', Optional[str]),
+        ('topology_error', bool),
+        ('error_msg', Optional[str]),
+        ('skipped', bool),
+    ],
+)
+
+# Molecules of the InChI being processed, inherited by the forked alignment workers
+_PARSED_MOLECULES = None
+
+def parse_molecule_file(file_name):
+    with open(file_name) as fh:
+        return pdb_data_for(fh.read(), cache=PDB_DATA_CACHE)
+
+def align_molecule_pair(pair, debug=False, verbosity=0):
+    i, j = pair
+    # Pairs that cannot be aligned point to faulty InChIs: check them before the lower bound, which would skip them too
+    if sorted(_PARSED_MOLECULES[i].flavour_lists) != sorted(_PARSED_MOLECULES[j].flavour_lists):
+        return Pair_Alignment(i, j, None, None, True, None, False)
+
+    # Only pairs within DELETION_THRESHOLD matter: skip the ones provably further apart
+    if rmsd_lower_bound(_PARSED_MOLECULES[i], _PARSED_MOLECULES[j]) > DELETION_THRESHOLD:
+        return Pair_Alignment(i, j, None, None, False, None, True)
+
+    try:
+        aligned_pdb_str, alignment_score, alignment_results = align_pdb_on_pdb(
+            reference_pdb_data=_PARSED_MOLECULES[i],
+            other_pdb_data=_PARSED_MOLECULES[j],
+            soft_fail=False,
+            verbosity=verbosity,
+        )
+        assert alignment_score is not INFINITE_RMSD
+    except Topology_Error:
+        return Pair_Alignment(i, j, None, None, True, None, False)
+    except Exception as e:
+        if debug:
+            # This will throw errors outside of the try block in debug mode
+            raise
+        return Pair_Alignment(i, j, None, None, False, str(e), False)
+    return Pair_Alignment(i, j, alignment_score, aligned_pdb_str, False, None, False)
+
+def get_distance_matrix(test_datum, debug=False, no_delete=False, max_matrix_size=None, verbosity=0, n_jobs=1, cluster=False):
     OVERWRITE_RESULTS = True
     ONLY_DO_ONE_ROW = False
     NEXT_TEST_STR = '\n\n'
@@ -153,66 +214,94 @@ def get_distance_matrix(test_datum, debug=False, no_delete=False, max_matrix_siz
     to_delete_molecules, to_delete_NOW_molecules = [], []
     pymol_files = []
 
-    for i, mol1 in enumerate(molecules):
-        with open(FILE_TEMPLATE.format(molecule_name=molecule_name, version=i, extension='pdb_aa')) as fh:
-            data1 = pdb_data_for(fh.read())
-
-        for j, mol2 in enumerate(molecules):
-            if j >= i:
-                continue
-
-            aligned_pdb_file = FILE_TEMPLATE.format(molecule_name=molecule_name, version="{0}_aligned_on_{1}".format(i, j), extension='pdb')
-            if exists(aligned_pdb_file) and not OVERWRITE_RESULTS:
-                continue
-
-            with open(FILE_TEMPLATE.format(molecule_name=molecule_name, version=j, extension='pdb_aa')) as fh:
-                data2 = pdb_data_for(fh.read())
-
-            try:
-                aligned_pdb_str, alignment_score, alignment_results = align_pdb_on_pdb(
-                    reference_pdb_data=data1,
-                    other_pdb_data=data2,
-                    soft_fail=False,
-                    verbosity=verbosity,
-                )
-                assert alignment_score is not INFINITE_RMSD
-            except Topology_Error:
-                print('WARNING: Faulty inchi: {0}'.format(mol1.inchi))
-                faulty_inchis.append(mol1.inchi)
-                continue
-            except Exception as e:
-                print('Error: Failed on matching {0} to {1}; error was {2}'.format(i, j, e))
-                ERROR_LOG.write(
-                    'ERROR: InChI={inchi}, molids={molids}, msg="{msg}"\n'.format(
-                        inchi=mol1.inchi,
-                        msg=e,
-                        molids=[mol1.molid, mol2.molid],
-                    ),
-                )
-
-                if debug:
-                    # This will throw errors outside of the try block in debug mode
-                    raise
-                else:
-                    continue
-
-            matrix[i, j] = alignment_score
-            if alignment_score <= DELETION_THRESHOLD:
-                if not mol1 in to_delete_molecules:
-                    to_delete_molecules.append(mol1)
-                    print('Will delete {0} (canonical_molid: {1})'.format(mol1.molid, mol2.molid))
-
-                    if alignment_score <= TINY_RMSD_SHOULD_DELETE and mol1 not in to_delete_NOW_molecules:
-                        to_delete_NOW_molecules.append(mol1)
-
-                    pymol_files.append(FILE_TEMPLATE.format(molecule_name=molecule_name, version='{0}_aligned_on_{1}'.format(i, j), extension='pdb'))
-                    pymol_files.append(FILE_TEMPLATE.format(molecule_name=molecule_name, version='{0}'.format(j), extension='pdb'))
-
-            with open(aligned_pdb_file, 'w') as fh:
-                fh.write(aligned_pdb_str)
-        if ONLY_DO_ONE_ROW:
-            break
-
+    molecule_files = [FILE_TEMPLATE.format(molecule_name=molecule_name, version=i, extension='pdb_aa') for i in range(mol_number)]
+
+    def result_file(i, j, extension='pdb'):
+        return FILE_TEMPLATE.format(molecule_name=molecule_name, version="{0}_aligned_on_{1}".format(i, j), extension=extension)
+
+    pairs = [
+        (i, j)
+        for i in range(1 if ONLY_DO_ONE_ROW else mol_number)
+        for j in range(i)
+        if OVERWRITE_RESULTS or not (exists(result_file(i, j)) or exists(result_file(i, j, extension=SKIPPED_PAIR_EXTENSION)))
+    ]
+
+    def mark_for_deletion(k, pair, alignment_score):
+        '''Schedule molecule k for deletion, as a duplicate through pair (whose alignment scored alignment_score).'''
+        i, j = pair
+        molecule, canonical_molecule = molecules[k], molecules[j if k == i else i]
+        if not molecule in to_delete_molecules:
+            to_delete_molecules.append(molecule)
+            print('Will delete {0} (canonical_molid: {1})'.format(molecule.molid, canonical_molecule.molid))
+
+            if alignment_score <= TINY_RMSD_SHOULD_DELETE and molecule not in to_delete_NOW_molecules:
+                to_delete_NOW_molecules.append(molecule)
+
+            pymol_files.append(result_file(i, j))
+            pymol_files.append(FILE_TEMPLATE.format(molecule_name=molecule_name, version='{0}'.format(j), extension='pdb'))
+
+    def record(pair_alignment, mark=True):
+        '''
+        Stage 3: record the result of a pair alignment, returning its score.
+        With mark, molecule i is scheduled for deletion if the pair is within DELETION_THRESHOLD.
+        '''
+        i, j = pair_alignment.i, pair_alignment.j
+        mol1, mol2 = molecules[i], molecules[j]
+
+        if pair_alignment.skipped:
+            # Not aligned, so matrix[i, j] stays NaN in the saved matrix; the marker file spares reruns the bound
+            with open(result_file(i, j, extension=SKIPPED_PAIR_EXTENSION), 'w') as fh:
+                fh.write('RMSD lower bound above {0}\n'.format(DELETION_THRESHOLD))
+            return INFINITE_RMSD
+        elif pair_alignment.topology_error:
+            print('WARNING: Faulty inchi: {0}'.format(mol1.inchi))
+            faulty_inchis.append(mol1.inchi)
+            return INFINITE_RMSD
+        elif pair_alignment.error_msg is not None:
+            print('Error: Failed on matching {0} to {1}; error was {2}'.format(i, j, pair_alignment.error_msg))
+            ERROR_LOG.write(
+                'ERROR: InChI={inchi}, molids={molids}, msg="{msg}"\n'.format(
+                    inchi=mol1.inchi,
+                    msg=pair_alignment.error_msg,
+                    molids=[mol1.molid, mol2.molid],
+                ),
+            )
+            return INFINITE_RMSD
+
+        alignment_score = pair_alignment.score
+        matrix[i, j] = alignment_score
+        if mark and alignment_score <= DELETION_THRESHOLD:
+            mark_for_deletion(i, (i, j), alignment_score)
+
+        with open(result_file(i, j), 'w') as fh:
+            fh.write(pair_alignment.aligned_pdb_str)
+        return alignment_score
+
+    global _PARSED_MOLECULES
+    # Stage 1: parse every molecule exactly once
+    _PARSED_MOLECULES = list(ordered_imap(parse_molecule_file, molecule_files, n_jobs=n_jobs))
+    try:
+        if cluster:
+            # Pairs depend on the clusters found so far, so they are aligned one by one
+            clustering = transitive_clusters(
+                mol_number,
+                lambda i, j: record(align_molecule_pair((i, j), debug=debug, verbosity=verbosity), mark=False),
+                DELETION_THRESHOLD,
+                verbosity=verbosity,
+            )
+            print('Clusters (canonical molecule first): {0}'.format([[molecules[i].molid for i in members] for members in clustering.clusters]))
+            # Members may have joined their cluster as either molecule of a pair: mark them from the final clusters
+            for (k, (pair, alignment_score)) in sorted(duplicate_links(clustering, DELETION_THRESHOLD).items()):
+                mark_for_deletion(k, pair, alignment_score)
+        else:
+            # Stage 2: align the pairs over forked workers (which inherit the parsed molecules), streaming the results
+            for pair_alignment in ordered_imap(partial(align_molecule_pair, debug=debug, verbosity=verbosity), pairs, n_jobs=n_jobs, chunk_size=PAIR_CHUNK_SIZE):
+                record(pair_alignment)
+    finally:
+        # Only the molecules of one InChI are ever held in memory
+        _PARSED_MOLECULES = None
+
+    # Pairs that were skipped (RMSD lower bound above DELETION_THRESHOLD), not aligned or failed are NaN
     if not exists(matrix_log_file):
         numpy.savetxt(matrix_log_file, matrix, fmt='%4.3f')
 
@@ -275,6 +364,8 @@ def parse_command_line():
     parser.add_argument('--auto', help="Get the inchis from the API", action='store_true')
     parser.add_argument('--nodelete', help="Do not delete molecules", action='store_true')
     parser.add_argument('--max-matrix-size', help="Maximum size of the distance matrix.", dest='max_matrix_size', default=None, type=int)
+    parser.add_argument('--cluster', help="Only align the pairs needed to find the clusters of duplicates (union-find).", action='store_true')
+    parser.add_argument('--jobs', help="Number of worker processes (-1: all CPUs).", dest='n_jobs', default=1, type=int)
     args = parser.parse_args()
     return args
 
@@ -305,6 +396,8 @@ if __name__ == "__main__":
             debug=args.debug,
             no_delete=args.nodelete,
             max_matrix_size=args.max_matrix_size,
+            n_jobs=args.n_jobs,
+            cluster=args.cluster,
         )
 
     print('Faulty inchis')
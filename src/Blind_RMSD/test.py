@@ -1,4 +1,10 @@
-from os.path import join
+from argparse import ArgumentParser, Namespace
+from json import dump, load
+from os.path import join, exists
+from statistics import median
+from sys import exit
+from time import perf_counter
+from typing import Any, Dict, List
 
 from Blind_RMSD.pdb import pdb_data_for, align_pdb_on_pdb, ALL_EXCEPTION_SEARCHING_KEYWORDS
 
@@ -30,7 +36,115 @@ SHOULD_FAIL = {
     (15, 16): True,
 }
 
+DEFAULT_BENCHMARK_REPEATS = 5
+
+# Relative increase of the median alignment time (over the baseline's) above which a pair is a time regression
+DEFAULT_TIME_TOLERANCE = 0.2
+
+# Absolute difference above which a score is considered changed (i.e. beyond floating point noise)
+SCORE_TOLERANCE = 1E-6
+
+def pair_key(test_pair) -> str:
+    return '{0}_{1}'.format(*test_pair)
+
+def benchmark_pair(test_pair, repeats: int) -> Dict[str, Any]:
+    '''Median and minimum alignment times (in seconds, PDB parsing excluded) and score (None if the alignment failed).'''
+    reference_pdb_data, other_pdb_data = [
+        pdb_data_for(pdb_str(test_ID), exception_searching_keywords=ALL_EXCEPTION_SEARCHING_KEYWORDS)
+        for test_ID in test_pair
+    ]
+
+    times, score = [], None
+    for _ in range(repeats):
+        start = perf_counter()
+        try:
+            _, score, _ = align_pdb_on_pdb(
+                reference_pdb_data=reference_pdb_data,
+                other_pdb_data=other_pdb_data,
+                verbosity=0,
+                soft_fail=False,
+                debug=False,
+            )
+        except Exception:
+            if test_pair not in SHOULD_FAIL:
+                raise
+            score = None
+        times.append(perf_counter() - start)
+
+    return {'median_s': median(times), 'min_s': min(times), 'score': None if score is None else float(score)}
+
+def regressions_for(results: Dict[str, Any], baseline: Dict[str, Any], time_tolerance: float) -> List[str]:
+    '''Human readable description of every time regression (beyond time_tolerance) or score change from baseline.'''
+    regressions = []
+    for (key, result) in results.items():
+        if key not in baseline:
+            continue
+        reference = baseline[key]
+
+        if (result['score'] is None) != (reference['score'] is None) or (
+            result['score'] is not None and abs(result['score'] - reference['score']) > SCORE_TOLERANCE
+        ):
+            regressions.append('{0}: score changed from {1} to {2}'.format(key, reference['score'], result['score']))
+
+        if result['median_s'] > reference['median_s'] * (1. + time_tolerance):
+            regressions.append(
+                '{0}: median time went from {1:.4f} s to {2:.4f} s (x{3:.2f})'.format(
+                    key,
+                    reference['median_s'],
+                    result['median_s'],
+                    result['median_s'] / reference['median_s'],
+                ),
+            )
+    return regressions
+
+def run_benchmark(args: Namespace) -> int:
+    baseline = None
+    if args.baseline is not None and not args.write_baseline:
+        if not exists(args.baseline):
+            print('Missing baseline file: {0} (create it with --write-baseline)'.format(args.baseline))
+            return 2
+        with open(args.baseline) as fh:
+            baseline = load(fh)
+
+    results = {}
+    for test_pair in TEST_PAIRS:
+        results[pair_key(test_pair)] = result = benchmark_pair(test_pair, args.repeats)
+        print('{0:>14}: median {median_s:.4f} s, min {min_s:.4f} s, score {score}'.format(pair_key(test_pair), **result))
+
+    if args.write_baseline:
+        with open(args.baseline, 'w') as fh:
+            dump(results, fh, indent=2, sort_keys=True)
+        print('Baseline written to {0}'.format(args.baseline))
+        return 0
+
+    if baseline is None:
+        return 0
+
+    for key in sorted(set(baseline) - set(results)):
+        print('{0}: in the baseline but not benchmarked'.format(key))
+
+    regressions = regressions_for(results, baseline, args.time_tolerance)
+    for regression in regressions:
+        print('REGRESSION {0}'.format(regression))
+    print('{0} regression(s) compared with {1}'.format(len(regressions), args.baseline))
+    return 1 if regressions else 0
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument('--benchmark', action='store_true', help='Time the test pairs (quietly) instead of running them in debug mode')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_BENCHMARK_REPEATS)
+    parser.add_argument('--baseline', default=None, help='JSON file of benchmark results to compare with (or write to)')
+    parser.add_argument('--write-baseline', action='store_true', help='Write the benchmark results to --baseline instead of comparing')
+    parser.add_argument('--time-tolerance', type=float, default=DEFAULT_TIME_TOLERANCE)
+    return parser.parse_args()
+
 if __name__ == '__main__':
+    args = parse_args()
+
+    if args.benchmark:
+        assert not args.write_baseline or args.baseline is not None, '--write-baseline requires --baseline'
+        exit(run_benchmark(args))
+
     for test_pair in TEST_PAIRS:
         print('Running test: {0}'.format(test_pair))
 
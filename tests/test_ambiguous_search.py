@@ -0,0 +1,137 @@
+from itertools import product
+
+import numpy as np
+import pytest
+
+from Blind_RMSD.helpers.ambiguous_search import batched_kabsch_search, selection_kabsch_search, covariance_tables_for, candidate_covariances, permutation_array_for, total_number_candidates, SEARCH_SUCCESS
+from Blind_RMSD.helpers.flavour_index import Flavoured_Scorer
+from Blind_RMSD.helpers.kabsch import kabsch
+from Blind_RMSD.helpers.scoring import rmsd_array
+
+N_FIXED_ANCHORS = 3
+
+def ambiguous_structures(seed, group_sizes, n_slots):
+    '''
+    A noisy rotated copy (reference_array) of point_array, whose first N_FIXED_ANCHORS points have unique flavours,
+    followed by groups of equivalent points, n_slots of which are used as anchors in every group.
+    '''
+    rng = np.random.default_rng(seed)
+    flavours = list(range(N_FIXED_ANCHORS)) + [N_FIXED_ANCHORS + group for (group, group_size) in enumerate(group_sizes) for _ in range(group_size)]
+    point_array = rng.normal(scale=2., size=(len(flavours), 3))
+
+    rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    rotation *= np.linalg.det(rotation)
+    reference_array = np.dot(point_array, rotation.T) + 1. + rng.normal(scale=0.3, size=point_array.shape)
+
+    fixed_anchor_indexes = np.arange(N_FIXED_ANCHORS)
+    permutation_arrays, reference_anchor_indexes = [], list(fixed_anchor_indexes)
+    for (group, group_size) in enumerate(group_sizes):
+        atom_indexes = N_FIXED_ANCHORS + sum(group_sizes[:group]) + np.arange(group_size)
+        permutation_arrays.append(permutation_array_for(atom_indexes, n_slots))
+        reference_anchor_indexes += list(atom_indexes[:n_slots])
+
+    return point_array, reference_array, [flavours, flavours], fixed_anchor_indexes, reference_array[reference_anchor_indexes], permutation_arrays
+
+@pytest.mark.parametrize('group_sizes, n_slots', [((3, 3), 2), ((2, 2, 3), 2), ((4,), 3), ((3, 3, 4), 1)])
+@pytest.mark.parametrize('seed', range(2))
+def test_batched_search_matches_exhaustive_loop(group_sizes, n_slots, seed):
+    point_array, reference_array, flavour_lists, fixed_anchor_indexes, reference_anchor_array, permutation_arrays = ambiguous_structures(seed, group_sizes, n_slots)
+    mask_array = np.where(np.equal.outer(*flavour_lists), 0., np.inf)
+
+    # One (non batched) Kabsch fit and masked RMSD per candidate, in itertools.product() order
+    scores = []
+    for selections in product(*permutation_arrays):
+        anchor_indexes = np.concatenate([fixed_anchor_indexes] + list(selections))
+        P, Q = point_array[anchor_indexes], reference_anchor_array
+        U = kabsch(P - P.mean(axis=0), Q - Q.mean(axis=0))
+        scores.append(rmsd_array(np.dot(point_array - P.mean(axis=0), U) + Q.mean(axis=0), reference_array, mask_array=mask_array))
+    assert len(scores) == total_number_candidates(permutation_arrays)
+
+    scorer = Flavoured_Scorer(flavour_lists)
+    search_result = batched_kabsch_search(
+        point_array,
+        reference_array,
+        fixed_anchor_indexes,
+        reference_anchor_array,
+        permutation_arrays,
+        scorer.bounded_batch,
+        score_tolerance=0.,
+        chunk_size=5,
+    )
+
+    assert search_result.status == SEARCH_SUCCESS
+    # Candidates are numbered from 1
+    assert search_result.candidate_number == int(np.argmin(scores)) + 1
+    assert search_result.score == pytest.approx(min(scores))
+
+# (group sizes, anchor slots per group): mixed radixes, a single group, and groups of size 1
+COVARIANCE_LAYOUTS = [
+    ((3, 3, 4), (2, 1, 3)),
+    ((5,), (3,)),
+    ((1, 1), (1, 1)),
+    ((1, 4, 2), (1, 2, 2)),
+]
+
+@pytest.mark.parametrize('group_sizes, n_slots', COVARIANCE_LAYOUTS)
+@pytest.mark.parametrize('seed', range(2))
+def test_candidate_covariances_match_gathered_anchors(group_sizes, n_slots, seed):
+    rng = np.random.default_rng(seed)
+    point_array = rng.normal(scale=2., size=(N_FIXED_ANCHORS + sum(group_sizes), 3)) + 10.
+    reference_anchor_array = rng.normal(scale=2., size=(N_FIXED_ANCHORS + sum(n_slots), 3))
+
+    fixed_anchor_indexes = np.arange(N_FIXED_ANCHORS)
+    permutation_arrays = [
+        permutation_array_for(N_FIXED_ANCHORS + sum(group_sizes[:group]) + np.arange(group_size), n)
+        for (group, (group_size, n)) in enumerate(zip(group_sizes, n_slots))
+    ]
+    covariance_tables = covariance_tables_for(point_array, reference_anchor_array, fixed_anchor_indexes, permutation_arrays)
+
+    # Explicitly gathered anchors of every candidate, in itertools.product() order (candidates are numbered from 1)
+    P = point_array[np.array([np.concatenate([fixed_anchor_indexes] + list(selections)) for selections in product(*permutation_arrays)])]
+    Q = reference_anchor_array
+    candidate_numbers = np.arange(1, len(P) + 1)
+
+    C, Pc = candidate_covariances(covariance_tables, candidate_numbers)
+    np.testing.assert_allclose(C, np.einsum('kni,nj->kij', P - P.mean(axis=1)[:, np.newaxis], Q - Q.mean(axis=0)), atol=1E-10)
+    np.testing.assert_allclose(Pc, P.mean(axis=1), atol=1E-10)
+
+    # Any subset of candidates, in any order
+    subset = rng.permutation(candidate_numbers)[:max(1, len(candidate_numbers) // 2)]
+    C_subset, Pc_subset = candidate_covariances(covariance_tables, subset)
+    np.testing.assert_allclose(C_subset, C[subset - 1], atol=1E-10)
+    np.testing.assert_allclose(Pc_subset, Pc[subset - 1], atol=1E-10)
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 256])
+def test_selection_search_numbers_candidates_like_batched_search(chunk_size):
+    point_array, reference_array, flavour_lists, fixed_anchor_indexes, reference_anchor_array, permutation_arrays = ambiguous_structures(0, (3, 3), 2)
+    scorer = Flavoured_Scorer(flavour_lists)
+
+    batched_numbers = []
+    batched_result = batched_kabsch_search(
+        point_array,
+        reference_array,
+        fixed_anchor_indexes,
+        reference_anchor_array,
+        permutation_arrays,
+        scorer.bounded_batch,
+        score_tolerance=0.,
+        on_candidate=lambda candidate_number, *_: batched_numbers.append(candidate_number),
+    )
+
+    # The same candidates, as a lazy iterable of anchor selections
+    selections = (np.concatenate([fixed_anchor_indexes] + list(selection)) for selection in product(*permutation_arrays))
+    selection_numbers = []
+    selection_result = selection_kabsch_search(
+        point_array,
+        reference_array,
+        reference_anchor_array,
+        selections,
+        scorer.bounded_batch,
+        score_tolerance=0.,
+        chunk_size=chunk_size,
+        on_candidate=lambda candidate_number, *_: selection_numbers.append(candidate_number),
+    )
+
+    assert selection_numbers == batched_numbers == list(range(1, total_number_candidates(permutation_arrays) + 1))
+    assert selection_result.candidate_number == batched_result.candidate_number
+    assert selection_result.score == pytest.approx(batched_result.score)
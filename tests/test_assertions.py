@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+# assert_found_permutation_array() imports Blind_RMSD.align: Vector is linked from biopython by `make install`, and
+# helpers.moldata needs chemistry_helpers
+pytest.importorskip('Blind_RMSD.helpers.Vector')
+pytest.importorskip('chemistry_helpers')
+
+from Blind_RMSD.helpers.assertions import assert_found_permutation_array
+from Blind_RMSD.helpers.exceptions import Permutation_Not_Found_Error
+from Blind_RMSD.helpers.flavour_index import Flavoured_Scorer
+from Blind_RMSD.helpers.numpy_helpers import get_distance_matrix
+
+def loop_found_permutation_array(array1, array2, mask_array=None, hard_fail=False):
+    '''The (pure Python) loop assert_found_permutation_array() replaced, on positional indexes.'''
+    distance_matrix = get_distance_matrix(array1, array2)
+    if mask_array is not None:
+        distance_matrix += mask_array
+
+    point_mapping = []
+    for i in range(distance_matrix.shape[0]):
+        min_j, min_dist = 0, distance_matrix[i, 0]
+        for j in range(1, distance_matrix.shape[1]):
+            if distance_matrix[i, j] < min_dist:
+                min_dist, min_j = distance_matrix[i, j], j
+        point_mapping.append((i, min_j))
+
+    mapped_points = [point_2 for (_, point_2) in point_mapping]
+    mapped_several_times = set(point for point in mapped_points if mapped_points.count(point) >= 2)
+    if mapped_several_times:
+        if hard_fail:
+            raise Permutation_Not_Found_Error(mapped_several_times)
+        return None
+    return point_mapping
+
+def permuted_structures(seed, n_points=12):
+    rng = np.random.default_rng(seed)
+    flavours = [i % 4 for i in range(n_points)]
+    array2 = rng.normal(scale=2., size=(n_points, 3))
+    permutation = rng.permutation(n_points)
+    array1 = array2[permutation] + rng.normal(scale=0.01, size=array2.shape)
+    return array1, array2, [[flavours[i] for i in permutation], flavours]
+
+def with_duplicate_index(array1, array2, flavour_lists):
+    # Two points of array1 (of the same flavour) are closest to the same point of array2
+    array1, (i, j) = array1.copy(), [i for i in range(len(array1)) if flavour_lists[0][i] == flavour_lists[0][0]][:2]
+    array1[j] = array1[i] + 0.01
+    return array1, array2, flavour_lists
+
+def with_flavour_mismatch(array1, array2, flavour_lists):
+    # A point of array1 sits on a point of array2 of another flavour, and only matches it without the flavour mask
+    array1, i = array1.copy(), 0
+    j = next(j for j in range(len(array2)) if flavour_lists[1][j] != flavour_lists[0][i])
+    array1[i] = array2[j]
+    return array1, array2, flavour_lists
+
+CASES = {
+    'permutation': lambda seed: permuted_structures(seed),
+    'duplicate_index': lambda seed: with_duplicate_index(*permuted_structures(seed)),
+    'flavour_mismatch': lambda seed: with_flavour_mismatch(*permuted_structures(seed)),
+}
+
+@pytest.mark.parametrize('case', sorted(CASES))
+@pytest.mark.parametrize('masked', [False, True])
+@pytest.mark.parametrize('seed', range(3))
+def test_vectorized_assertion_matches_loop(case, masked, seed):
+    array1, array2, flavour_lists = CASES[case](seed)
+    mask_array = np.where(np.equal.outer(*flavour_lists), 0., np.inf) if masked else None
+
+    expected = loop_found_permutation_array(array1, array2, mask_array=mask_array)
+    assert assert_found_permutation_array(array1, array2, mask_array=mask_array, as_tuples=True) == expected
+    if masked:
+        assert assert_found_permutation_array(array1, array2, flavour_scorer=Flavoured_Scorer(flavour_lists), as_tuples=True) == expected
+
+    if expected is None:
+        with pytest.raises(Permutation_Not_Found_Error):
+            assert_found_permutation_array(array1, array2, mask_array=mask_array, hard_fail=True)
+    else:
+        np.testing.assert_array_equal(
+            assert_found_permutation_array(array1, array2, mask_array=mask_array),
+            [point_2 for (_, point_2) in expected],
+        )
+
+def test_cases_are_accepted_and_rejected():
+    # Without the flavour mask, the mismatched point takes the place of another one (with it, the point maps to the
+    # closest point of its own flavour, which may be free)
+    assert loop_found_permutation_array(*CASES['permutation'](0)[:2]) is not None
+    assert loop_found_permutation_array(*CASES['duplicate_index'](0)[:2]) is None
+    assert loop_found_permutation_array(*CASES['flavour_mismatch'](0)[:2]) is None
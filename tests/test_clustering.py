@@ -0,0 +1,48 @@
+import numpy as np
+
+from Blind_RMSD.helpers.clustering import transitive_clusters, duplicate_links
+
+THRESHOLD = 0.2
+
+def scores_from(matrix):
+    return lambda i, j: matrix[i][j]
+
+def test_members_joining_as_second_molecule_are_duplicates():
+    # d(1, 0) > threshold, d(2, 0) <= threshold, d(2, 1) <= threshold: 1 joins through the pair (2, 1)
+    matrix = [
+        [0., 0., 0.],
+        [0.5, 0., 0.],
+        [0.1, 0.15, 0.],
+    ]
+    clustering = transitive_clusters(3, scores_from(matrix), THRESHOLD)
+
+    assert clustering.clusters == [[0, 1, 2]]
+    assert clustering.representatives == [0]
+    assert duplicate_links(clustering, THRESHOLD) == {1: ((2, 1), 0.15), 2: ((2, 0), 0.1)}
+
+def test_every_non_representative_is_a_duplicate():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(scale=10., size=(4, 2))
+    points = np.concatenate([center + rng.normal(scale=0.03, size=(10, 2)) for center in centers])
+    distances = np.linalg.norm(points[:, np.newaxis] - points[np.newaxis], axis=-1)
+
+    clustering = transitive_clusters(len(points), scores_from(distances), THRESHOLD)
+    links = duplicate_links(clustering, THRESHOLD)
+
+    non_representatives = set(range(len(points))) - set(clustering.representatives)
+    assert set(links) == non_representatives
+    assert all(score <= THRESHOLD and member in pair for (member, (pair, score)) in links.items())
+
+def test_failed_alignments_never_merge():
+    clustering = transitive_clusters(2, lambda i, j: float('inf'), THRESHOLD)
+    assert clustering.clusters == [[0], [1]]
+    assert duplicate_links(clustering, THRESHOLD) == {}
+
+def test_triangle_bounds_are_opt_in():
+    calls = []
+    def score_function(i, j):
+        calls.append((i, j))
+        return 1.
+
+    transitive_clusters(4, score_function, THRESHOLD)
+    assert len(calls) == 6
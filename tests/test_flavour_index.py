@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from Blind_RMSD.helpers.flavour_index import Flavoured_Scorer, MAX_BRUTE_FORCE_GROUP_SIZE, MIN_BOUNDED_BATCH_SIZE, FIRST_SCORING_BLOCK_SIZE
+from Blind_RMSD.helpers.scoring import rmsd_array, INFINITE_RMSD
+
+# Group sizes exercising the brute force blocks only, the cKDTrees only, and both
+GROUP_SIZES = {
+    'brute_force': [1, 2, 5, MAX_BRUTE_FORCE_GROUP_SIZE],
+    'tree': [MAX_BRUTE_FORCE_GROUP_SIZE + 1, 40],
+    'mixed': [1, 3, 8, MAX_BRUTE_FORCE_GROUP_SIZE, MAX_BRUTE_FORCE_GROUP_SIZE + 1, 30],
+}
+
+def flavoured_structures(seed, group_sizes, K=1):
+    rng = np.random.default_rng(seed)
+    flavours = [flavour for (flavour, group_size) in enumerate(group_sizes) for _ in range(group_size)]
+    flavour_list1, flavour_list2 = [flavours[i] for i in rng.permutation(len(flavours))], flavours
+    return rng.normal(scale=3., size=(K, len(flavours), 3)), rng.normal(scale=3., size=(len(flavours), 3)), [flavour_list1, flavour_list2]
+
+def flavour_mask_for(flavour_list1, flavour_list2):
+    return np.where(np.equal.outer(flavour_list1, flavour_list2), 0., np.inf)
+
+@pytest.mark.parametrize('layout', sorted(GROUP_SIZES))
+@pytest.mark.parametrize('seed', range(3))
+def test_scorer_matches_masked_rmsd_array(layout, seed):
+    point_arrays, reference_array, flavour_lists = flavoured_structures(seed, GROUP_SIZES[layout], K=4)
+    scorer = Flavoured_Scorer(flavour_lists)
+    mask_array = flavour_mask_for(*flavour_lists)
+
+    expected = [rmsd_array(point_array, reference_array, mask_array=mask_array) for point_array in point_arrays]
+    assert [scorer(point_array, reference_array) for point_array in point_arrays] == pytest.approx(expected)
+    assert scorer.batch(point_arrays, reference_array) == pytest.approx(expected)
+
+    # Scoring the second structure against the first one
+    assert scorer(reference_array, point_arrays[0], transpose_mask_array=True) == pytest.approx(
+        rmsd_array(reference_array, point_arrays[0], mask_array=mask_array.T.copy()),
+    )
+
+@pytest.mark.parametrize('layout', sorted(GROUP_SIZES))
+def test_bounded_batch_matches_masked_rmsd_array(layout):
+    point_arrays, reference_array, flavour_lists = flavoured_structures(0, GROUP_SIZES[layout], K=100)
+    scorer = Flavoured_Scorer(flavour_lists)
+    mask_array = flavour_mask_for(*flavour_lists)
+
+    expected = np.array([rmsd_array(point_array, reference_array, mask_array=mask_array) for point_array in point_arrays])
+    scores = scorer.bounded_batch(point_arrays, reference_array)
+    assert scores.min() == pytest.approx(expected.min())
+    assert scores[np.isfinite(scores)] == pytest.approx(expected[np.isfinite(scores)])
+
+def noisy_copies(seed, n_points, K):
+    '''K copies of a reference structure, with noise of increasing scales (so that scores spread around any bound).'''
+    rng = np.random.default_rng(seed)
+    flavours = [i % 3 for i in range(n_points)]
+    reference_array = rng.normal(scale=3., size=(n_points, 3))
+    noise_scales = np.linspace(0.01, 2., K)[rng.permutation(K)]
+    point_arrays = reference_array + noise_scales[:, np.newaxis, np.newaxis] * rng.normal(size=(K, n_points, 3))
+    return point_arrays, reference_array, [flavours, flavours]
+
+@pytest.mark.parametrize('K', [MIN_BOUNDED_BATCH_SIZE - 1, MIN_BOUNDED_BATCH_SIZE, 3 * MIN_BOUNDED_BATCH_SIZE])
+@pytest.mark.parametrize('n_points', [FIRST_SCORING_BLOCK_SIZE, FIRST_SCORING_BLOCK_SIZE + 1, 10 * FIRST_SCORING_BLOCK_SIZE])
+@pytest.mark.parametrize('bound, tolerance', [(None, 0.), (0.5, 0.), (0.5, 1.), (0., 0.)])
+def test_bounded_batch_only_aborts_above_the_bound(K, n_points, bound, tolerance):
+    point_arrays, reference_array, flavour_lists = noisy_copies(K + n_points, n_points, K)
+    scorer = Flavoured_Scorer(flavour_lists)
+
+    scores = scorer.batch(point_arrays, reference_array)
+    bounded_scores = scorer.bounded_batch(point_arrays, reference_array, bound=bound, tolerance=tolerance)
+
+    threshold = max(tolerance, min(INFINITE_RMSD if bound is None else bound, scores.min()))
+    kept = bounded_scores != INFINITE_RMSD
+    # Every candidate that can end the search or become the best one is kept, with its exact score
+    assert np.all(kept[scores <= threshold])
+    np.testing.assert_array_equal(bounded_scores[kept], scores[kept])
+    # Only candidates above the bound are aborted
+    assert np.all(scores[~kept] > threshold)
+
+    if K < MIN_BOUNDED_BATCH_SIZE or n_points <= FIRST_SCORING_BLOCK_SIZE:
+        # Scored completely (a single block, or too few candidates for blocks to pay off)
+        assert np.all(kept)
+    elif bound == 0.:
+        assert not np.all(kept)
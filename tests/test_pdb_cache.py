@@ -0,0 +1,56 @@
+from pickle import dumps
+
+import numpy as np
+import pytest
+
+# Needed by helpers.moldata (see the Makefile)
+pytest.importorskip('chemistry_helpers')
+
+from Blind_RMSD.helpers.pdb_cache import PDB_Data_Cache, pdb_data_key
+
+FIELDS = {
+    'data': {'atoms': {1: {'symbol': 'C1', 'conn': [2], 'coord': (0.1, 0.2, 0.3)}, 2: {'symbol': 'H1', 'conn': [1]}}},
+    'point_lists': [[1., 2., 3.], [4., 5., 6.]],
+    'flavour_lists': [('C|H|EQ1',), ('H|C|EQ1',)],
+    'extra_points_lists': [],
+    'united_atom_fit': True,
+    'automorphisms': None,
+}
+
+KEY = pdb_data_key('ATOM      1  C1', True, True, ['keyword'])
+
+def test_round_trip(tmp_path):
+    cache = PDB_Data_Cache(str(tmp_path))
+    assert cache.get(KEY) is None
+    cache.put(KEY, FIELDS)
+    assert cache.get(KEY) == FIELDS
+
+def test_corrupted_entries_are_misses(tmp_path):
+    cache = PDB_Data_Cache(str(tmp_path))
+    cache.put(KEY, FIELDS)
+    with open(cache.path_for(KEY), 'wb') as fh:
+        fh.write(b'not an npz file')
+
+    assert cache.get(KEY) is None
+    assert cache.entries() == []
+
+def test_pickles_are_never_loaded(tmp_path):
+    cache = PDB_Data_Cache(str(tmp_path))
+    with open(cache.path_for(KEY), 'wb') as fh:
+        np.savez(fh, version=np.array(2), metadata=np.array([FIELDS], dtype=object))
+    assert cache.get(KEY) is None
+
+    with open(cache.path_for(KEY), 'wb') as fh:
+        fh.write(dumps(FIELDS))
+    assert cache.get(KEY) is None
+
+def test_other_versions_are_misses(tmp_path, monkeypatch):
+    cache = PDB_Data_Cache(str(tmp_path))
+    cache.put(KEY, FIELDS)
+    monkeypatch.setattr('Blind_RMSD.helpers.pdb_cache.PDB_DATA_CACHE_VERSION', -1)
+    assert cache.get(KEY) is None
+
+def test_unencodable_fields_are_not_cached(tmp_path):
+    cache = PDB_Data_Cache(str(tmp_path))
+    cache.put(KEY, dict(FIELDS, data={'atoms': {1: {'ring': {1, 2}}}}))
+    assert cache.entries() == []
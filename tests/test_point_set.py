@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from Blind_RMSD.helpers.ChemicalPoint import ChemicalPoint, on_flavour
+from Blind_RMSD.helpers.PointSet import point_sets_for
+
+MAX_GROUP_SIZE = 4
+
+def group_by(iterable, key):
+    '''Same as helpers.moldata.group_by() (which needs chemistry_helpers).'''
+    group_dict = {}
+    for obj in iterable:
+        group_dict.setdefault(key(obj), []).append(obj)
+    return group_dict
+
+def chemical_points_groups(point_list, flavour_list, max_group_size=None):
+    '''Unique points (by decreasing flavour) and ambiguous groups (by size and flavour), from lists of ChemicalPoint.'''
+    grouped_chemical_points = group_by(
+        [ChemicalPoint(*zipped_point) for zipped_point in zip(point_list, range(len(point_list)), flavour_list)],
+        on_flavour,
+    )
+    unique_points = sorted(
+        [group[0] for group in grouped_chemical_points.values() if len(group) == 1],
+        key=lambda x: (x.flavour,),
+        reverse=True,
+    )
+    ambiguous_groups = sorted(
+        [group for group in grouped_chemical_points.values() if 1 < len(group) and (max_group_size is None or len(group) <= max_group_size)],
+        key=lambda group: (len(group), group[0].flavour),
+    )
+    return unique_points, ambiguous_groups
+
+def random_flavoured_structure(seed, n_points=20):
+    rng = np.random.default_rng(seed)
+    flavours = ['C', 'H', 'N', 'O', 'S', 'CL', 'H|C', 'O|C|C', 'N|H|H']
+    return rng.normal(size=(n_points, 3)).tolist(), [flavours[i] for i in rng.integers(0, len(flavours), size=n_points)]
+
+@pytest.mark.parametrize('max_group_size', [None, MAX_GROUP_SIZE])
+@pytest.mark.parametrize('seed', range(5))
+def test_point_set_matches_chemical_points(seed, max_group_size):
+    point_list, flavour_list = random_flavoured_structure(seed)
+    # The flavour codes are shared with a second structure, which has extra flavours
+    point_set, _ = point_sets_for([point_list, point_list + [[0., 0., 0.]] * 2], [flavour_list, flavour_list[::-1] + ['A', 'Z']])
+
+    unique_points, ambiguous_groups = chemical_points_groups(point_list, flavour_list, max_group_size=max_group_size)
+
+    unique_positions = point_set.unique_positions()
+    assert point_set.indexes[unique_positions].tolist() == [chemical_point.index for chemical_point in unique_points]
+    assert [flavour_list[i] for i in unique_positions] == [chemical_point.flavour for chemical_point in unique_points]
+    np.testing.assert_array_equal(point_set.coords[unique_positions], np.reshape([chemical_point.x for chemical_point in unique_points], (-1, 3)))
+
+    groups = point_set.ambiguous_groups(max_group_size=max_group_size)
+    assert [point_set.indexes[group].tolist() for group in groups] == [[chemical_point.index for chemical_point in group] for group in ambiguous_groups]
+    assert [[flavour_list[i] for i in group] for group in groups] == [[chemical_point.flavour for chemical_point in group] for group in ambiguous_groups]
@@ -0,0 +1,73 @@
+from threading import Event
+
+import numpy as np
+import pytest
+
+from Blind_RMSD.helpers.flavour_index import Flavoured_Scorer
+from Blind_RMSD.helpers.portfolio import run_portfolio, Scheduled_Method, PORTFOLIO_RUN_ALL, PORTFOLIO_EARLY_EXIT, STOP_SCORE_TOLERANCE
+from Blind_RMSD.helpers.stats import Alignment_Stats
+
+def test_merge_adds_the_counters():
+    stats, method_stats = Alignment_Stats(), Alignment_Stats()
+    stats.n_svd_calls, stats.exit_reason = 2, 'translation'
+    method_stats.n_svd_calls, method_stats.n_score_evaluations = 3, 5
+    stats.merge(method_stats)
+    assert (stats.n_svd_calls, stats.n_score_evaluations, stats.exit_reason) == (5, 5, 'translation')
+
+def test_scorer_views_share_caches_but_not_counters():
+    rng = np.random.default_rng(0)
+    flavours = ['A'] * 40 + ['B'] * 40
+    reference = rng.normal(size=(len(flavours), 3))
+    stats, view_stats = Alignment_Stats(), Alignment_Stats()
+    scorer = Flavoured_Scorer([flavours, flavours], stats=stats)
+    view = scorer.counting_into(view_stats)
+
+    assert view(reference, reference) == scorer(reference, reference) == 0.
+    assert view.index_for(reference) is scorer.index_for(reference)
+    assert (stats.n_score_evaluations, view_stats.n_score_evaluations) == (1, 1)
+
+def test_abandoned_methods_do_not_report():
+    release, results = Event(), []
+    def slow():
+        release.wait(10.)
+        return 1.
+
+    portfolio_result = run_portfolio(
+        [Scheduled_Method('slow', slow), Scheduled_Method('fast', lambda: 0.)],
+        score_of=lambda score: score,
+        on_result=results.append,
+        score_tolerance=0.1,
+        policy=PORTFOLIO_EARLY_EXIT,
+        n_threads=2,
+    )
+    release.set()
+    assert (portfolio_result.stop_reason, portfolio_result.stopping_method, portfolio_result.skipped_methods) == (STOP_SCORE_TOLERANCE, 'fast', ['slow'])
+    assert results == [0.]
+
+def test_threaded_methods_count_like_serial_ones():
+    # Linked from biopython by `make install`
+    pytest.importorskip('Blind_RMSD.helpers.Vector')
+    # Blind_RMSD.align imports helpers.moldata
+    pytest.importorskip('chemistry_helpers')
+    from Blind_RMSD.align import pointsOnPoints
+
+    rng = np.random.default_rng(1)
+    flavours = ['A', 'B', 'C', 'D'] + ['H'] * 6
+    reference = rng.normal(scale=2., size=(len(flavours), 3))
+    rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    rotation *= np.linalg.det(rotation)
+    moving = np.dot(reference, rotation.T) + 1.
+
+    all_stats = []
+    for method_threads in (1, 4):
+        stats = Alignment_Stats()
+        pointsOnPoints(
+            [moving.tolist(), reference.tolist()],
+            flavour_lists=[flavours, flavours],
+            hashing_stage=True,
+            method_policy=PORTFOLIO_RUN_ALL,
+            method_threads=method_threads,
+            stats=stats,
+        )
+        all_stats.append({key: value for (key, value) in stats.as_dict().items() if key not in ('stage_times', 'total_time')})
+    assert all_stats[0] == all_stats[1]
@@ -0,0 +1,65 @@
+from os.path import join, dirname
+
+import numpy as np
+import pytest
+
+# Linked from biopython by `make install`
+pytest.importorskip('Blind_RMSD.helpers.Vector')
+# Blind_RMSD.align imports helpers.moldata
+pytest.importorskip('chemistry_helpers')
+
+from Blind_RMSD.align import pointsOnPoints
+from Blind_RMSD.helpers.PreparedReference import PreparedReference
+from Blind_RMSD.helpers.exceptions import Topology_Error
+
+DATA_DIR = join(dirname(__file__), '..', 'src', 'Blind_RMSD', 'data')
+
+def structures(seed=0):
+    rng = np.random.default_rng(seed)
+    flavours = ['A', 'B', 'C', 'D'] + ['H'] * 4 + ['O'] * 3
+    reference = rng.normal(scale=2., size=(len(flavours), 3))
+    permutation = rng.permutation(len(flavours))
+    rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    rotation *= np.linalg.det(rotation)
+    moving = np.dot(reference[permutation], rotation.T) + 3. + rng.normal(scale=0.01, size=reference.shape)
+    return (moving.tolist(), [flavours[i] for i in permutation]), (reference.tolist(), flavours)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_prepared_reference_gives_the_same_alignment(seed):
+    (moving, flavours), (reference, reference_flavours) = structures(seed)
+    alignment = pointsOnPoints([moving, reference], flavour_lists=[flavours, reference_flavours])
+
+    prepared_reference = PreparedReference(reference, reference_flavours)
+    prepared_alignment = pointsOnPoints([moving, None], flavour_lists=[flavours, None], prepared_reference=prepared_reference)
+
+    assert prepared_alignment.score == pytest.approx(alignment.score)
+    np.testing.assert_allclose(prepared_alignment.aligned_points, alignment.aligned_points)
+    assert prepared_alignment.final_permutation == alignment.final_permutation
+
+def test_prepared_reference_requires_flavours():
+    (moving, _), (reference, reference_flavours) = structures()
+    prepared_reference = PreparedReference(reference, reference_flavours)
+
+    for flavour_lists in (None, [None, None]):
+        with pytest.raises(AssertionError, match='requires the flavours'):
+            pointsOnPoints([moving, None], flavour_lists=flavour_lists, prepared_reference=prepared_reference)
+
+def test_prepared_reference_rejects_other_flavours():
+    (moving, flavours), (reference, reference_flavours) = structures()
+    prepared_reference = PreparedReference(reference, reference_flavours)
+
+    with pytest.raises(Topology_Error):
+        pointsOnPoints([moving, None], flavour_lists=[['Z'] + flavours[1:], None], prepared_reference=prepared_reference)
+
+def test_align_many_matches_align_pdb_on_pdb():
+    pytest.importorskip('chemical_equivalence')
+    from Blind_RMSD.pdb import pdb_data_for, prepare_reference, align_pdb_on_pdb, align_many
+
+    reference_pdb_data, other_pdb_data = [
+        pdb_data_for(open(join(DATA_DIR, '{0}.pdb'.format(test_ID))).read())
+        for test_ID in (1, 2)
+    ]
+    _, score, _ = align_pdb_on_pdb(reference_pdb_data=reference_pdb_data, other_pdb_data=other_pdb_data)
+    (_, prepared_score, _), = list(align_many(prepare_reference(reference_pdb_data), [other_pdb_data]))
+
+    assert prepared_score == pytest.approx(score)
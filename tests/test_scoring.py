@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from Blind_RMSD.helpers.scoring import rmsd_array, rmsd_array_for_loop
+
+def random_arrays(seed, n_points=12):
+    rng = np.random.default_rng(seed)
+    return rng.normal(size=(n_points, 3)), rng.normal(size=(n_points, 3))
+
+def flavour_mask(seed, n_points=12, n_flavours=3):
+    rng = np.random.default_rng(seed)
+    flavours = rng.integers(0, n_flavours, size=n_points)
+    return np.where(flavours[:, np.newaxis] == rng.permutation(flavours)[np.newaxis, :], 0., np.inf)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rmsd_array_matches_for_loop_unmasked(seed):
+    point_array1, point_array2 = random_arrays(seed)
+    assert rmsd_array(point_array1, point_array2) == pytest.approx(rmsd_array_for_loop(point_array1, point_array2))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rmsd_array_matches_for_loop_masked(seed):
+    point_array1, point_array2 = random_arrays(seed)
+    mask_array = flavour_mask(seed)
+    expected = rmsd_array_for_loop(point_array1, point_array2, mask_array=mask_array.copy())
+    assert rmsd_array(point_array1, point_array2, mask_array=mask_array.copy()) == pytest.approx(expected)
+    # The mask actually constrains the matches
+    assert expected >= rmsd_array(point_array1, point_array2)
+
+def test_rmsd_array_does_not_modify_mask():
+    point_array1, point_array2 = random_arrays(0)
+    mask_array = flavour_mask(0)
+    original = mask_array.copy()
+    rmsd_array(point_array1, point_array2, mask_array=mask_array)
+    np.testing.assert_array_equal(mask_array, original)
+
+def test_rmsd_array_all_inf_mask_row():
+    point_array1, point_array2 = random_arrays(1)
+    mask_array = np.zeros((len(point_array1), len(point_array2)))
+    mask_array[3, :] = np.inf
+
+    for function in (rmsd_array, rmsd_array_for_loop):
+        with pytest.raises(AssertionError):
+            function(point_array1, point_array2, mask_array=mask_array.copy())
@@ -0,0 +1,31 @@
+import numpy as np
+
+from Blind_RMSD.helpers.symmetry import symmetry_permutations, is_symmetry_permutation
+
+CUBE = np.array([[x, y, z] for x in (-1., 1.) for y in (-1., 1.) for z in (-1., 1.)])
+
+def random_chain(n_points, seed=0):
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(size=(n_points, 3))
+    return np.cumsum(1.5 * steps / np.linalg.norm(steps, axis=1)[:, np.newaxis], axis=0)
+
+def test_cube_has_the_23_non_trivial_rotations():
+    permutations = symmetry_permutations(CUBE, ['C'] * len(CUBE))
+    assert len(permutations) == 23
+    assert len(set(tuple(permutation.tolist()) for permutation in permutations)) == 23
+    assert all(is_symmetry_permutation(CUBE, ['C'] * len(CUBE), permutation) for permutation in permutations)
+
+def test_flavours_break_symmetries():
+    flavours = ['O'] + ['C'] * (len(CUBE) - 1)
+    permutations = symmetry_permutations(CUBE, flavours)
+    # Rotations about the diagonal through the oxygen
+    assert len(permutations) == 2
+    assert all(permutation[0] == 0 for permutation in permutations)
+
+def test_long_chain_does_not_recurse():
+    point_array = random_chain(1200)
+    bonds = [(i, i + 1) for i in range(len(point_array) - 1)]
+    assert symmetry_permutations(point_array, ['C'] * len(point_array), bonds=bonds, max_points=len(point_array)) == []
+
+def test_large_structures_are_not_searched():
+    assert symmetry_permutations(CUBE, ['C'] * len(CUBE), max_points=len(CUBE) - 1) == []
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+# Linked from biopython by `make install`
+pytest.importorskip('Blind_RMSD.helpers.Vector')
+# Blind_RMSD.align imports helpers.moldata
+pytest.importorskip('chemistry_helpers')
+
+import Blind_RMSD.align
+from Blind_RMSD.align import pointsOnPoints, VALIDATION_LEVELS, VALIDATION_NONE, VALIDATION_CHEAP, VALIDATION_PARANOID
+
+def structures(seed=0):
+    rng = np.random.default_rng(seed)
+    flavours = ['A', 'B', 'C', 'D', 'E'] + ['H'] * 3
+    reference = rng.normal(scale=2., size=(len(flavours), 3))
+    permutation = rng.permutation(len(flavours))
+    rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    rotation *= np.linalg.det(rotation)
+    moving = np.dot(reference[permutation], rotation.T) - 1. + rng.normal(scale=0.01, size=reference.shape)
+    return [moving.tolist(), reference.tolist()], [[flavours[i] for i in permutation], flavours], rng.normal(size=(2, 3)).tolist()
+
+def counting(monkeypatch, name):
+    '''Count the calls of the check name of Blind_RMSD.align (still running it).'''
+    calls = []
+    check = getattr(Blind_RMSD.align, name)
+    def counted(*args, **kwargs):
+        calls.append(name)
+        return check(*args, **kwargs)
+    monkeypatch.setattr(Blind_RMSD.align, name, counted)
+    return calls
+
+@pytest.mark.parametrize('seed', range(3))
+def test_all_levels_give_the_same_alignment(seed):
+    point_lists, flavour_lists, extra_points = structures(seed)
+    alignments = [
+        pointsOnPoints(point_lists, flavour_lists=flavour_lists, extra_points=extra_points, validation=validation)
+        for validation in VALIDATION_LEVELS
+    ]
+    for alignment in alignments[1:]:
+        assert alignment.score == alignments[0].score
+        np.testing.assert_array_equal(alignment.aligned_points, alignments[0].aligned_points)
+        np.testing.assert_array_equal(alignment.extra_points, alignments[0].extra_points)
+        assert alignment.final_permutation == alignments[0].final_permutation
+
+def test_none_skips_the_checks(monkeypatch):
+    calls = []
+    for name in ('assert_array_equal', 'do_assert_is_isometry', 'assert_blind_rmsd_symmetry'):
+        calls += [counting(monkeypatch, name)]
+
+    point_lists, flavour_lists, extra_points = structures()
+    pointsOnPoints(point_lists, flavour_lists=flavour_lists, extra_points=extra_points, validation=VALIDATION_NONE)
+    assert [len(name_calls) for name_calls in calls] == [0, 0, 0]
+
+    pointsOnPoints(point_lists, flavour_lists=flavour_lists, extra_points=extra_points, validation=VALIDATION_PARANOID)
+    assert all(len(name_calls) > 0 for name_calls in calls)
+
+def test_paranoid_catches_corrupted_inputs(monkeypatch):
+    kabsch = Blind_RMSD.align.rotation_matrix_kabsch_on_points
+    def corrupting_kabsch(P, Q):
+        result = kabsch(P, Q)
+        # A bug writing into the arrays it was given
+        P[0] += 1.
+        return result
+    monkeypatch.setattr(Blind_RMSD.align, 'rotation_matrix_kabsch_on_points', corrupting_kabsch)
+
+    point_lists, flavour_lists, _ = structures()
+    pointsOnPoints(point_lists, flavour_lists=flavour_lists, validation=VALIDATION_CHEAP)
+    with pytest.raises(AssertionError):
+        pointsOnPoints(point_lists, flavour_lists=flavour_lists, validation=VALIDATION_PARANOID)
+
+def test_unknown_level_is_rejected():
+    point_lists, flavour_lists, _ = structures()
+    with pytest.raises(AssertionError, match='Unknown validation level'):
+        pointsOnPoints(point_lists, flavour_lists=flavour_lists, validation='thorough')
+
+def test_unknown_ambiguous_search_is_rejected_on_entry(monkeypatch):
+    def point_sets_for(*args, **kwargs):
+        raise RuntimeError('The flavours should not be set up')
+    monkeypatch.setattr(Blind_RMSD.align, 'point_sets_for', point_sets_for)
+
+    point_lists, flavour_lists, _ = structures()
+    with pytest.raises(AssertionError, match='Unknown ambiguous search'):
+        pointsOnPoints(point_lists, flavour_lists=flavour_lists, ambiguous_search='bached')